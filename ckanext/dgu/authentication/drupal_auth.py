@@ -1,7 +1,9 @@
-import Cookie
 import logging
 import datetime
 import hashlib
+import threading
+import time
+from collections import OrderedDict
 
 from ckanext.dgu.drupalclient import DrupalClient, DrupalXmlRpcSetupError, \
      DrupalRequestError
@@ -9,6 +11,151 @@ from xmlrpclib import ServerProxy
 
 log = logging.getLogger(__name__)
 
+
+def scan_cookies(cookie_string, server_name):
+    '''Scans a Cookie header once for the cookies DrupalAuthMiddleware
+    needs. Returns (is_ckan_cookie, drupal_session_id) i.e. whether there is
+    an auth_tkt cookie, and the value of the Drupal session cookie for this
+    server (or None).
+
+    This is run for every request, so avoids the overhead of
+    Cookie.SimpleCookie, and returns quickly for requests (e.g. anonymous
+    ones) that have neither cookie.'''
+    if 'auth_tkt' not in cookie_string and 'SESS' not in cookie_string:
+        return False, None
+    is_ckan_cookie = False
+    drupal_session_id = None
+    session_cookie_names = drupal_session_cookie_names(server_name)
+    similar_cookies = []
+    for cookie in cookie_string.split(';'):
+        name, _, value = cookie.partition('=')
+        name = name.strip()
+        if name == 'auth_tkt':
+            is_ckan_cookie = True
+        elif name in session_cookie_names:
+            value = value.strip()
+            if len(value) > 1 and value[0] == value[-1] == '"':
+                value = value[1:-1]
+            drupal_session_id = value
+        elif name.startswith('SESS') or name.startswith('SSESS'):
+            similar_cookies.append(name)
+    if drupal_session_id:
+        log.debug('Drupal cookie found for server request %s', server_name)
+    elif similar_cookies:
+        log.debug('Drupal cookies ignored with incorrect hash for server %r: %r',
+                  server_name, similar_cookies)
+    return is_ckan_cookie, drupal_session_id
+
+
+# server_name: names of the Drupal session cookies
+_drupal_session_cookie_names = {}
+
+
+def drupal_session_cookie_names(server_name):
+    '''Returns the names of the Drupal session cookies (normal and secure)
+    for the server name.'''
+    names = _drupal_session_cookie_names.get(server_name)
+    if names is None:
+        # Drupal 6 uses md5, Drupal 7 uses sha256
+        server_hash = hashlib.sha256(server_name).hexdigest()[:32]
+        names = ('SESS%s' % server_hash, 'SSESS%s' % server_hash)
+        if len(_drupal_session_cookie_names) > 100:
+            # there should only be a few, but don't let it grow unbounded
+            _drupal_session_cookie_names.clear()
+        _drupal_session_cookie_names[server_name] = names
+    return names
+
+
+class DrupalSessionCache(object):
+    '''Caches what Drupal says about a session ID - (drupal_user_id,
+    drupal_user_properties), or (None, None) if it is not a valid session -
+    for ttl seconds. It holds up to max_size sessions, dropping the least
+    recently used.
+
+    It is shared by the threads of a process. If several threads want the same
+    session at once (e.g. a burst of requests from a new session), only one
+    asks Drupal and the others wait for its answer.
+    '''
+    # How often (in lookups) to log the stats
+    log_every = 1000
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._sessions = OrderedDict()  # session_id: (expires, value)
+        self._in_flight = {}  # session_id: _Lookup
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'errors': 0}
+
+    def get(self, session_id, lookup):
+        '''Returns the cached value for the session_id, or calls
+        lookup(session_id) to get it. Exceptions raised by lookup are passed
+        on (to all the threads waiting for it) and nothing is cached.'''
+        with self._lock:
+            cached = self._sessions.pop(session_id, None)
+            if cached and cached[0] > time.time():
+                self._sessions[session_id] = cached  # most recently used
+                self._count('hits')
+                return cached[1]
+            in_flight = self._in_flight.get(session_id)
+            is_looked_up_elsewhere = bool(in_flight)
+            if is_looked_up_elsewhere:
+                self._count('coalesced')
+            else:
+                in_flight = self._in_flight[session_id] = _Lookup()
+                self._count('misses')
+        if is_looked_up_elsewhere:
+            # another thread is asking Drupal, so wait for its answer
+            return in_flight.wait()
+
+        try:
+            value = lookup(session_id)
+        except Exception, e:
+            with self._lock:
+                del self._in_flight[session_id]
+                self._count('errors')
+            in_flight.set_error(e)
+            raise
+        with self._lock:
+            self._sessions[session_id] = (time.time() + self.ttl, value)
+            while len(self._sessions) > self.max_size:
+                self._sessions.popitem(last=False)
+            del self._in_flight[session_id]
+        in_flight.set_value(value)
+        return value
+
+    def _count(self, stat):
+        # called with the lock held
+        self.stats[stat] += 1
+        if stat != 'errors' and \
+                (self.stats['hits'] + self.stats['misses'] +
+                 self.stats['coalesced']) % self.log_every == 0:
+            log.info('Drupal session cache: %(hits)i hits, %(misses)i misses, '
+                     '%(coalesced)i coalesced, %(errors)i errors', self.stats)
+
+
+class _Lookup(object):
+    '''A lookup of a session that is in progress, that other threads can
+    wait for.'''
+    def __init__(self):
+        self._done = threading.Event()
+        self.value = self.error = None
+
+    def set_value(self, value):
+        self.value = value
+        self._done.set()
+
+    def set_error(self, error):
+        self.error = error
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self.error:
+            raise self.error
+        return self.value
+
+
 class DrupalAuthMiddleware(object):
     '''Allows CKAN user to login via Drupal. It looks for the Drupal cookie
     and gets user details from Drupal using XMLRPC.
@@ -23,58 +170,25 @@ class DrupalAuthMiddleware(object):
         self.seconds_between_checking_drupal_cookie = int(minutes_between_checking_drupal_cookie) * 60
         # if that int() raises a ValueError then the app will not start
 
+        app_conf = app_conf or {}
+        self.session_cache = DrupalSessionCache(
+            ttl=int(app_conf.get('dgu.drupal_session_cache.ttl', 60)),
+            max_size=int(app_conf.get('dgu.drupal_session_cache.size', 10000)))
+
     def _parse_cookies(self, environ):
-        is_ckan_cookie = [False]
-        drupal_session_id = [False]
-        server_name = environ['SERVER_NAME']
-        for k, v in environ.items():
-            key = k.lower()
-            if key == 'http_cookie':
-                is_ckan_cookie[0] = self._is_this_a_ckan_cookie(v)
-                drupal_session_id[0] = self._drupal_cookie_parse(v, server_name)
-        is_ckan_cookie = is_ckan_cookie[0]
-        drupal_session_id = drupal_session_id[0]
-        return is_ckan_cookie, drupal_session_id
+        cookie_string = environ.get('HTTP_COOKIE')
+        if not cookie_string:
+            return False, None
+        return scan_cookies(cookie_string, environ['SERVER_NAME'])
 
     @staticmethod
     def _drupal_cookie_parse(cookie_string, server_name):
         '''Returns the Drupal Session ID from the cookie string.'''
-        cookies = Cookie.SimpleCookie()
-        try:
-            cookies.load(str(cookie_string))
-        except Cookie.CookieError:
-            log.error("Received invalid cookie: %s" % cookie_string)
-            return False
-        similar_cookies = []
-        for cookie in cookies:
-            if cookie.startswith('SESS') or cookie.startswith('SSESS'):
-                # Drupal 6 uses md5, Drupal 7 uses sha256
-                server_hash = hashlib.sha256(server_name).hexdigest()[:32]
-                if cookie == 'SESS%s' % server_hash:
-                    log.debug('Drupal cookie found for server request %s', server_name)
-                    return cookies[cookie].value
-                elif cookie == 'SSESS%s' % server_hash:
-                    log.debug('Drupal cookie (secure) found for server request %s', server_name)
-                    return cookies[cookie].value
-                else:
-                    similar_cookies.append(cookie)
-        if similar_cookies:
-            log.debug('Drupal cookies ignored with incorrect hash for server %r: %r',
-                      server_name, similar_cookies)
-        return None
+        return scan_cookies(cookie_string, server_name)[1]
 
     @staticmethod
     def _is_this_a_ckan_cookie(cookie_string):
-        cookies = Cookie.SimpleCookie()
-        try:
-            cookies.load(str(cookie_string))
-        except Cookie.CookieError:
-            log.warning("Received invalid cookie: %s" % cookie_string)
-            return False
-
-        if not 'auth_tkt' in cookies:
-            return False
-        return True
+        return scan_cookies(cookie_string, '')[0]
 
     def _munge_drupal_id_to_ckan_user_name(self, drupal_id):
         drupal_id.lower().replace(' ', '_')
@@ -187,11 +301,10 @@ class DrupalAuthMiddleware(object):
         the equivalent CKAN user with properties copied from Drupal and log the
         person in with auth_tkt and its cookie.
         '''
-        if self.drupal_client is None:
-            self.drupal_client = DrupalClient()
-        # ask drupal for the drupal_user_id for this session
         try:
-            drupal_user_id = self.drupal_client.get_user_id_from_session_id(drupal_session_id)
+            drupal_user_id, drupal_user_properties = \
+                self.session_cache.get(drupal_session_id,
+                                       self._get_drupal_session)
         except DrupalRequestError, e:
             log.error('Error checking session with Drupal: %s', e)
             return
@@ -199,8 +312,6 @@ class DrupalAuthMiddleware(object):
             log.debug('Drupal said the session ID found in the cookie is not valid.')
             return
 
-        # ask drupal about this user
-        drupal_user_properties = self.drupal_client.get_user_properties(drupal_user_id)
         user_dict = DrupalUserMapping.drupal_user_to_ckan_user(
                 drupal_user_properties)
 
@@ -253,6 +364,21 @@ class DrupalAuthMiddleware(object):
         environ['REMOTE_USER'] = user.name
         log.debug('Set REMOTE_USER = %r', user.name)
 
+    def _get_drupal_session(self, drupal_session_id):
+        '''Asks Drupal for the user of a session, returning (drupal_user_id,
+        drupal_user_properties), or (None, None) if the session is not
+        valid.'''
+        if self.drupal_client is None:
+            self.drupal_client = DrupalClient()
+        # ask drupal for the drupal_user_id for this session
+        drupal_user_id = self.drupal_client.get_user_id_from_session_id(drupal_session_id)
+        if not drupal_user_id:
+            return None, None
+
+        # ask drupal about this user
+        drupal_user_properties = self.drupal_client.get_user_properties(drupal_user_id)
+        return drupal_user_id, drupal_user_properties
+
     def set_roles(self, user_name, drupal_roles):
         '''Sets CKAN user roles based on the drupal roles.
 
@@ -0,0 +1,58 @@
+'''Measures how many dataset count requests per second can be served with
+the dataset counts cache (lib/dataset_counts.py) and without it (a search
+query for every request, as dataset_count used to do).
+
+By default the functions are timed directly. With --url the API is requested
+over HTTP instead, e.g. --url http://localhost/api/util/dataset-count
+(in which case only the "with cache" figure is meaningful).
+'''
+import time
+import urllib2
+from optparse import OptionParser
+
+import common
+
+
+def time_calls(func, count):
+    start = time.time()
+    for i in xrange(count):
+        func()
+    duration = time.time() - start
+    return count / duration if duration else 0
+
+
+def run(options):
+    from ckanext.dgu.lib import dataset_counts
+
+    if options.url:
+        def request_url():
+            urllib2.urlopen(options.url).read()
+        funcs = (('with cache (HTTP)', request_url),)
+    else:
+        funcs = (('without cache', dataset_counts.count_datasets),
+                 ('with cache', dataset_counts.get_dataset_counts))
+    # prime the cache
+    dataset_counts.invalidate_dataset_counts()
+    dataset_counts.get_dataset_counts()
+    print 'Counting datasets %i times' % options.count
+    for name, func in funcs:
+        print '%-20s %8.1f requests/sec' % (name,
+                                            time_calls(func, options.count))
+
+
+usage = __doc__ + '''
+Usage:
+    python dataset_count_benchmark.py <CKAN config.ini> [-n 1000] [--url URL]'''
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=usage)
+    parser.add_option('-n', '--count', dest='count', type='int',
+                      default=1000,
+                      help='Number of times to count the datasets')
+    parser.add_option('--url', dest='url',
+                      help='Time requests to this API URL instead')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Wrong number of arguments')
+    common.load_config(args[0])
+    run(options)
@@ -0,0 +1,84 @@
+'''Times how long DrupalAuthMiddleware takes to find the cookies it needs in
+a request, for realistic Cookie headers, comparing the single-pass scanner
+(drupal_auth.scan_cookies) with the previous way (parsing the header twice
+with Cookie.SimpleCookie and hashing the server name for each cookie).
+'''
+import Cookie
+import hashlib
+import time
+from optparse import OptionParser
+
+SERVER_NAME = 'data.gov.uk'
+SERVER_HASH = hashlib.sha256(SERVER_NAME).hexdigest()[:32]
+GA_COOKIES = '__utma=217959684.1645507268.1266337989.1266337989.1298907782.2; ' \
+    '__utmz=217959684.1298907582.2.1.utmcsr=google|utmccn=(organic)|' \
+    'utmcmd=organic|utmctr=coi%20office%20information; _ga=GA1.3.1817545357.1415030437'
+COOKIE_HEADERS = (
+    ('anonymous, no cookies', ''),
+    ('anonymous, analytics cookies', GA_COOKIES),
+    ('Drupal session', GA_COOKIES + '; SESS%s=ae257e890935e0cc123ccc71797668e4; '
+     'DRXtrArgs=bob' % SERVER_HASH),
+    ('Drupal session and auth_tkt', GA_COOKIES +
+     '; SESS%s=ae257e890935e0cc123ccc71797668e4; '
+     'auth_tkt="a578c4a0d21bdbde7f80cd271d60b66f4ceabc3f4466!"' % SERVER_HASH),
+    )
+
+
+def previous_parse_cookies(environ):
+    is_ckan_cookie = False
+    drupal_session_id = False
+    for k, v in environ.items():
+        if k.lower() == 'http_cookie':
+            cookies = Cookie.SimpleCookie()
+            cookies.load(str(v))
+            is_ckan_cookie = 'auth_tkt' in cookies
+            cookies = Cookie.SimpleCookie()
+            cookies.load(str(v))
+            for cookie in cookies:
+                if cookie.startswith('SESS') or cookie.startswith('SSESS'):
+                    server_hash = hashlib.sha256(
+                        environ['SERVER_NAME']).hexdigest()[:32]
+                    if cookie in ('SESS%s' % server_hash,
+                                  'SSESS%s' % server_hash):
+                        drupal_session_id = cookies[cookie].value
+                        break
+    return is_ckan_cookie, drupal_session_id
+
+
+def run(options):
+    from ckanext.dgu.authentication.drupal_auth import DrupalAuthMiddleware
+    middleware = DrupalAuthMiddleware(None, None)
+
+    # some other typical WSGI environ keys, which the previous way iterated
+    environ_base = dict(('HTTP_HEADER_%i' % i, 'value') for i in range(20))
+    environ_base['SERVER_NAME'] = SERVER_NAME
+    print 'Parsing cookies %i times (microseconds/request)' % options.count
+    print '%-30s %10s %10s' % ('', 'previous', 'scanner')
+    for name, cookie_header in COOKIE_HEADERS:
+        environ = dict(environ_base)
+        if cookie_header:
+            environ['HTTP_COOKIE'] = cookie_header
+        assert bool(previous_parse_cookies(environ)[1]) == \
+            bool(middleware._parse_cookies(environ)[1])
+        timings = []
+        for func in (previous_parse_cookies, middleware._parse_cookies):
+            start = time.time()
+            for i in xrange(options.count):
+                func(environ)
+            timings.append((time.time() - start) * 1000000 / options.count)
+        print '%-30s %10.1f %10.1f' % (name, timings[0], timings[1])
+
+
+usage = __doc__ + '''
+Usage:
+    python drupal_cookie_benchmark.py [-n 100000]'''
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=usage)
+    parser.add_option('-n', '--count', dest='count', type='int',
+                      default=100000,
+                      help='Number of requests to parse the cookies of')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error('Wrong number of arguments')
+    run(options)
@@ -224,10 +224,59 @@ class TxtAnalysisFile(AnalysisFile):
             fileobj.close()
         
 
+def iter_json_packages(f, chunk_size=1024 * 1024):
+    '''Yields the packages in a JSON dump file object, parsing it
+    incrementally, so the whole dump is never held in memory. The dump can
+    be a JSON array of packages or JSON lines (one package per line).'''
+    decoder = json.JSONDecoder()
+    separators = re.compile(r'[\s,]*')
+    buf = f.read(chunk_size)
+    pos = separators.match(buf).end()
+    in_array = buf[pos:pos + 1] == '['
+    if in_array:
+        pos += 1
+    while True:
+        pos = separators.match(buf, pos).end()
+        if in_array and buf[pos:pos + 1] == ']':
+            return
+        try:
+            pkg, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            # the package continues in the next chunk (or the JSON is bad)
+            chunk = f.read(chunk_size)
+            if not chunk:
+                if buf[pos:].strip() or in_array:
+                    raise ValueError('Could not parse JSON at: %r' %
+                                     buf[pos:pos + 100])
+                return
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        yield pkg
+        pos = end
+
+
+class BinCounter(object):
+    '''Counts the packages in each bin of an analysis, keeping the names
+    of the first few as examples.'''
+    def __init__(self, num_examples):
+        self.num_examples = num_examples
+        self.counts = defaultdict(int)
+        self.examples = defaultdict(list)
+
+    def add(self, bin, pkg):
+        self.counts[bin] += 1
+        if len(self.examples[bin]) < self.num_examples:
+            self.examples[bin].append(pkg['name'])
+
+
 class DumpAnalysis(object):
     '''
     Reads a JSON dump file and runs analysis according to the options, and
     saves it in self.analysis_dict
+
+    The dump is read incrementally and all the analyses are done in a single
+    pass, counting the packages, rather than loading them all into memory.
     '''
     def __init__(self, dump_filepath, options):
         log.info('Analysing %s' % dump_filepath)
@@ -238,29 +287,39 @@ class DumpAnalysis(object):
     def run(self):
         self.save_date()
         self.analysis_dict = OrderedDict()
-        packages = self.get_packages()
-        packages = self.filter_out_deleted_packages(packages)
-        self.analysis_dict[total_label] = len(packages)
-
-        if self.options.analyse_by_source:
-            pkg_bins = self.analyse_by_source(packages)
-            for bin, pkgs in pkg_bins.items():
-                self.analysis_dict['Datasets by source: %s' % bin] = len(pkgs)
-        if self.options.analyse_ons_by_published_by:
-            ons_packages = self.filter_by_ons_packages(packages)
-            pkg_bins = self.analyse_by_published_by(ons_packages)
-            for bin, pkgs in pkg_bins.items():
-                self.analysis_dict['National Statistics Pub Hub by published_by: %s' % bin] = len(pkgs)
-        if self.options.analyse_by_theme:
-            pkg_bins = self.analyse_by_theme(packages)
-            for bin, pkgs in pkg_bins.items():
-                self.analysis_dict['Datasets by theme: %s' % bin] = len(pkgs)
-        if self.options.analyse_by_unpublished:
-            pkg_bins = self.analyse_by_unpublished(packages)
-            for bin, pkgs in pkg_bins.items():
-                self.analysis_dict['Datasets by unpublished: %s' % bin] = len(pkgs)
-
-        self.print_analysis(pkg_bins)
+        # (option, label, function returning the bin for a package)
+        analyses = [
+            (self.options.analyse_by_source,
+             'Datasets by source', self.get_source),
+            (self.options.analyse_ons_by_published_by,
+             'National Statistics Pub Hub by published_by',
+             self.get_ons_published_by),
+            (self.options.analyse_by_theme,
+             'Datasets by theme', self.get_theme),
+            (self.options.analyse_by_unpublished,
+             'Datasets by unpublished', self.get_unpublished),
+            ]
+        analyses = [(label, get_bin, BinCounter(int(self.options.examples)))
+                    for option, label, get_bin in analyses if option]
+
+        num_active = num_deleted = 0
+        for pkg in self.get_packages():
+            if not self.is_active(pkg):
+                num_deleted += 1
+                continue
+            num_active += 1
+            for label, get_bin, counter in analyses:
+                bin = get_bin(pkg)
+                if bin is not None:
+                    counter.add(bin, pkg)
+        log.info('Deleted datasets discarded: %i', num_deleted)
+        log.info('Number of active datsets: %i', num_active)
+
+        self.analysis_dict[total_label] = num_active
+        for label, get_bin, counter in analyses:
+            for bin, count in counter.counts.items():
+                self.analysis_dict['%s: %s' % (label, bin)] = count
+            self.print_analysis(label, counter)
 
     def save_date(self):
         try:
@@ -272,118 +331,93 @@ class DumpAnalysis(object):
         log.info('Date of dumpfile: %r', datestr)
 
     def get_packages(self):
-        '''Returns the packages listed in the JSON dump file'''
+        '''Yields the packages listed in the JSON dump file'''
         if zipfile.is_zipfile(self.dump_filepath):
-            log.info('Unzipping...')
             zf = zipfile.ZipFile(self.dump_filepath)
             assert len(zf.infolist()) == 1, 'Archive must contain one file: %r' % zf.infolist()
             f = zf.open(zf.namelist()[0])
-        elif self.dump_filepath.endswith('gz'):            
+        elif self.dump_filepath.endswith('gz'):
             f = gzip.open(self.dump_filepath, 'rb')
         else:
             f = open(self.dump_filepath, 'rb')
-        log.info('Reading file...')
-        json_buf = f.read()
-        log.info('Parsing JSON...')
-        packages = json.loads(json_buf)
-        log.info('Read in packages: %i' % len(packages))
-        return packages
-
-    def filter_out_deleted_packages(self, packages):
-        filtered_pkgs = []
-        for pkg in packages:
-            if pkg.has_key('state'):
-                is_active = pkg['state'] == 'active'
-            else:
-                is_active = pkg['state_id'] == 1
-            if is_active:
-                filtered_pkgs.append(pkg)
-        log.info('Deleted datasets discarded: %i', (len(packages) - len(filtered_pkgs)))
-        log.info('Number of active datsets: %i', (len(filtered_pkgs)))
-        return filtered_pkgs
-
-    def filter_by_ons_packages(self, packages):
-        filtered_pkgs = []
-        ons_prefix = 'ONS'
-        for pkg in packages:
-            import_source = pkg['extras'].get('import_source')
-            if import_source and import_source.startswith(ons_prefix):
-                filtered_pkgs.append(pkg)
-        log.info('Number of Pub Hub packages: %i', (len(filtered_pkgs)))
-        return filtered_pkgs
-
-    def analyse_by_source(self, packages):
-        pkg_bins = defaultdict(list)
-        for pkg in packages:
-            import_source = pkg['extras'].get('import_source')
-            if import_source:
-                for prefix in import_source_prefixes:
-                    if import_source.startswith(prefix):
-                        import_source = import_source_prefixes[prefix]
-                        break
-                pkg_bins[import_source].append(pkg['name'])
-                continue
-            if pkg['extras'].get('UKLP') == 'True':
-                pkg_bins['UKLP'].append(pkg['name'])
-                continue
-            if (pkg.get('url') or '').startswith('http://www.data4nr.net/resources/'):
-                import_source = import_source_prefixes['DATA4NR']
-                pkg_bins[import_source].append(pkg['name'])
-                continue
-            if pkg['extras'].get('co_id'):
-                import_source = import_source_prefixes['COSPREAD']
-                pkg_bins[import_source].append(pkg['name'])
-                continue
-            if asbool(pkg['extras'].get('unpublished')):
-                import_source = unpublished
-                pkg_bins[import_source].append(pkg['name'])
-                continue
-            pkg_bins[manual_creation].append(pkg['name'])
-        return pkg_bins
-
-    def analyse_by_published_by(self, packages):
-        pkg_bins = defaultdict(list)
-        remove_id_regex = re.compile(' \[\d+\]')
-        for pkg in packages:
-            published_by = pkg['extras'].get('published_by')
-            published_by = remove_id_regex.sub('', published_by)
-            if published_by:
-                pkg_bins[published_by].append(pkg['name'])
-                continue
-            pkg_bins['No value'].append(pkg['name'])
-        return pkg_bins
-
-    def analyse_by_theme(self, packages):
-        pkg_bins = defaultdict(list)
-        for pkg in packages:
-            theme = pkg['extras'].get('theme-primary')
-            if (not theme) or (not theme.strip()):
-                pkg_bins['No value'].append(pkg['name'])
-                continue
-            # Fix old names for themes so they are consistent
-            if theme in OLD_THEMES:
-                theme = OLD_THEMES[theme]
-            if theme not in THEMES:
-                theme = 'Other: %s' % theme
-            pkg_bins[theme].append(pkg['name'])
-        return pkg_bins
-
-    def analyse_by_unpublished(self, packages):
-        pkg_bins = defaultdict(list)
-        for pkg in packages:
-            unpublished = pkg['extras'].get('unpublished')
-            pkg_bins[asbool(unpublished)].append(pkg['name'])
-        return pkg_bins
-
-    def print_analysis(self, pkg_bins):
-        log.info('* Analysis by source *')
-        for pkg_bin, pkgs in sorted(pkg_bins.items(), key=lambda (pkg_bin, pkgs): -len(pkgs)):
-            log.info('  %s: %i (e.g. %r)', pkg_bin, len(pkgs), pkgs[:int(self.options.examples)])
+        log.info('Reading and parsing JSON...')
+        try:
+            for pkg in iter_json_packages(f):
+                yield pkg
+        finally:
+            f.close()
+
+    def is_active(self, pkg):
+        if pkg.has_key('state'):
+            return pkg['state'] == 'active'
+        return pkg['state_id'] == 1
+
+    def get_source(self, pkg):
+        import_source = pkg['extras'].get('import_source')
+        if import_source:
+            for prefix in import_source_prefixes:
+                if import_source.startswith(prefix):
+                    return import_source_prefixes[prefix]
+            return import_source
+        if pkg['extras'].get('UKLP') == 'True':
+            return 'UKLP'
+        if (pkg.get('url') or '').startswith('http://www.data4nr.net/resources/'):
+            return import_source_prefixes['DATA4NR']
+        if pkg['extras'].get('co_id'):
+            return import_source_prefixes['COSPREAD']
+        if asbool(pkg['extras'].get('unpublished')):
+            return unpublished
+        return manual_creation
+
+    def get_ons_published_by(self, pkg):
+        '''Returns the published_by of National Statistics Pub Hub
+        packages, or None for other packages.'''
+        import_source = pkg['extras'].get('import_source')
+        if not (import_source and import_source.startswith('ONS')):
+            return None
+        published_by = pkg['extras'].get('published_by')
+        if published_by:
+            published_by = re.sub(' \[\d+\]', '', published_by)
+        return published_by or 'No value'
+
+    def get_theme(self, pkg):
+        theme = pkg['extras'].get('theme-primary')
+        if (not theme) or (not theme.strip()):
+            return 'No value'
+        # Fix old names for themes so they are consistent
+        if theme in OLD_THEMES:
+            theme = OLD_THEMES[theme]
+        if theme not in THEMES:
+            theme = 'Other: %s' % theme
+        return theme
+
+    def get_unpublished(self, pkg):
+        return asbool(pkg['extras'].get('unpublished'))
+
+    def print_analysis(self, label, counter):
+        log.info('* %s *', label)
+        for pkg_bin, count in sorted(counter.counts.items(),
+                                     key=lambda (pkg_bin, count): -count):
+            log.info('  %s: %i (e.g. %r)', pkg_bin, count,
+                     counter.examples[pkg_bin])
+
+
+def analyse_dump(dump_filepath, options):
+    '''Runs DumpAnalysis in a worker process and returns its results as
+    (date, analysis_dict). options is a plain dict, so it can be pickled.'''
+    analysis = DumpAnalysis(dump_filepath, DumpAnalysisOptions(**options))
+    return analysis.date, analysis.analysis_dict
+
+
+def _analyse_dump_star(args):
+    return analyse_dump(*args)
+
 
 class Command(command.Command):
     usage = 'usage: %prog [options] dumpfile.json.zip'
     usage += '\nNB: dumpfile can be gzipped, zipped or json'
     usage += '\n    can be list of files and can be a wildcard.'
+    usage += '\n    can be a JSON array of datasets or JSON lines.'
 
     def add_options(self):
         self.parser.add_option('--csv', dest='csv_filepath',
@@ -404,6 +438,10 @@ class Command(command.Command):
                                action="store_true")
         self.parser.add_option('--analyse-by-unpublished', dest='analyse_by_unpublished',
                                action="store_true")
+        self.parser.add_option('--processes', dest='processes', type='int',
+                               default=1,
+                               help='analyse NUMBER of dump files in parallel',
+                               metavar='NUMBER')
 
     def parse_args(self):
         super(Command, self).parse_args()
@@ -431,19 +469,37 @@ class Command(command.Command):
             if output_filepath:
                 analysis_files[analysis_file_class] = analysis_file_class(output_filepath, run_info)
 
-        for input_filepath in input_filepaths:
-            # Run analysis
-            analysis = DumpAnalysis(input_filepath, self.options)
+        if self.options.processes > 1:
+            # Analyse the dumps in parallel, e.g. when redoing the analysis
+            # for a directory of historic dumps
+            import multiprocessing
+            options = dict(vars(self.options))
+            pool = multiprocessing.Pool(self.options.processes)
+            try:
+                results = pool.map(_analyse_dump_star,
+                                   [(input_filepath, options)
+                                    for input_filepath in input_filepaths])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = []
+            for input_filepath in input_filepaths:
+                analysis = DumpAnalysis(input_filepath, self.options)
+                results.append((analysis.date, analysis.analysis_dict))
 
+        for input_filepath, (date, analysis_dict) in zip(input_filepaths,
+                                                         results):
             if analysis_files:
-                assert analysis.date, 'The results are requested to be saved to '
+                assert date, 'The results are requested to be saved to '
                 'an analysis file which is sorted by date, but could not find '
                 'a date in the input filename: %s' % input_filepath
 
             for analysis_file_class, analysis_file in analysis_files.items():
-                analysis_file.add_analysis(analysis.date, analysis.analysis_dict)
-                # Save
-                analysis_file.save()
+                analysis_file.add_analysis(date, analysis_dict)
+        # Save
+        for analysis_file in analysis_files.values():
+            analysis_file.save()
         log.info('Finished')
 
 def command():
@@ -0,0 +1,69 @@
+'''Times Formats.normalise on a large number of messy resource format strings,
+comparing it with the previous way of cleaning them (a resource_formats
+lookup and regex for every call).
+'''
+import random
+import re
+import time
+from optparse import OptionParser
+
+import common
+
+# The sort of thing publishers type into the format box
+MESSY_FORMATS = [
+    'csv', 'CSV', '.csv', ' .Csv', 'csv ', 'CSV file', 'csvfile', 'xls', 'XLSX',
+    '.xlsx', 'Excel', 'excel 2010', 'pdf', 'PDF ', '.PDF', 'html', 'HTML',
+    'web page', 'website', 'asp', 'php', 'zip', 'ZIP', '.zip', 'Zip (CSV)',
+    'rdf/xml', 'RDF', 'html+rdfa', 'json', 'JSON ', 'api', 'API', 'wms', 'WMS',
+    'shapefile', 'ESRI Shapefile', 'shp', 'kml', 'netcdf', 'ods', 'doc', 'docx',
+    'Word', 'txt', 'TXT ', 'sql', 'database', 'xml', 'XML ', 'ical', 'iCal',
+    '', 'unknown', 'other', 'XLS/CSV', 'CSV / Zip', 'Fixed width', 'N/A',
+    ]
+
+
+def previous_clean_format(format_string, disallowed=re.compile(r'[^a-zA-Z /+]')):
+    from ckan.lib import helpers
+    if isinstance(format_string, basestring):
+        matched_format = helpers.resource_formats().get(
+            format_string.lower().strip(' .'))
+        if matched_format:
+            return matched_format[1]
+        return re.sub(disallowed, '', format_string).strip()
+    return format_string
+
+
+def time_calls(func, format_strings):
+    start = time.time()
+    for format_string in format_strings:
+        func(format_string)
+    return time.time() - start
+
+
+def run(options):
+    from ckanext.dgu.lib.formats import Formats
+
+    random.seed(0)
+    format_strings = [random.choice(MESSY_FORMATS)
+                      for i in xrange(options.count)]
+    print 'Normalising %i format strings' % options.count
+    for name, func in (('previous', previous_clean_format),
+                       ('Formats.normalise', Formats.normalise)):
+        duration = time_calls(func, format_strings)
+        print '%-20s %6.2fs  %5.2f microseconds/call' % (
+            name, duration, duration * 1000000 / options.count)
+
+
+usage = __doc__ + '''
+Usage:
+    python format_normalise_benchmark.py <CKAN config.ini> [-n 1000000]'''
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=usage)
+    parser.add_option('-n', '--count', dest='count', type='int',
+                      default=1000000,
+                      help='Number of format strings to normalise')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Wrong number of arguments')
+    common.load_config(args[0])
+    run(options)
@@ -44,16 +44,20 @@ def command(config_file):
         default_analysis_dir = '/var/lib/ckan/%s/static/dump_analysis' % ckan_instance_name
         default_backup_dir = '/var/backups/ckan/%s' % ckan_instance_name
         default_openspending_reports_dir = '/var/lib/ckan/%s/openspending_reports' % ckan_instance_name
+        default_incremental_dump_dir = '/var/lib/ckan/%s/incremental_dump' % ckan_instance_name
     else:
         # test purposes
         default_dump_dir = '~/dump'
         default_analysis_dir = '~/dump_analysis'
         default_backup_dir = '~/backups'
         default_openspending_reports_dir = '~/openspending_reports'
+        default_incremental_dump_dir = '~/incremental_dump'
     dump_dir = os.path.expanduser(config.get('ckan.dump_dir',
                                              default_dump_dir))
     private_dump_dir = os.path.expanduser(config.get('ckan.private_dump_dir',
                                                      ''))
+    incremental_dump_dir = os.path.expanduser(
+        config.get('dgu.incremental_dump_dir', default_incremental_dump_dir))
     analysis_dir = os.path.expanduser(config.get('ckan.dump_analysis_dir',
                                              default_analysis_dir))
     backup_dir = os.path.expanduser(config.get('ckan.backup_dir',
@@ -197,25 +201,31 @@ def command(config_file):
 
         logging.getLogger("MARKDOWN").setLevel(logging.WARN)
 
-        # Explicitly dump the packages and resources to their respective CSV
-        # files before zipping them up and moving them into position.
+        # The packages and resources are streamed straight into their
+        # respective CSV files in the zip.
         dump_filepath = os.path.join(dump_dir, dump_file_base + '.csv.zip')
 
+        # Parquet versions of the CSV files are dumped too, if pyarrow is
+        # installed
+        parquet_filepaths = {}
+        parquet_writer = None
+        if dgu_dumper.ParquetDumpWriter.available():
+            for table in ('datasets', 'resources'):
+                parquet_filepaths[table] = os.path.join(
+                    dump_dir, '%s.%s.parquet' % (dump_file_base, table))
+            parquet_writer = dgu_dumper.ParquetDumpWriter(
+                parquet_filepaths['datasets'], parquet_filepaths['resources'])
+        else:
+            log.info('pyarrow is not installed, so not dumping Parquet')
+
         log.info('Creating CSV files: %s' % dump_filepath)
-        dumpobj = dgu_dumper.CSVDumper()
+        dumpobj = dgu_dumper.BulkCSVDumper(dump_filepath, stable_columns=True,
+                                           parquet_writer=parquet_writer)
         dumpobj.dump()
+        dumpobj.close()
 
-        dataset_file, resource_file = dumpobj.close()
-
-        log.info('Dumped datasets file is %dMb in size' % (
-            os.path.getsize(dataset_file) / (1024 * 1024)))
-        log.info('Dumped resources file is %dMb in size' % (
-            os.path.getsize(resource_file) / (1024 * 1024)))
-
-        dump_file = zipfile.ZipFile(dump_filepath, 'w', zipfile.ZIP_DEFLATED)
-        dump_file.write(dataset_file, "datasets.csv")
-        dump_file.write(resource_file, "resources.csv")
-        dump_file.close()
+        log.info('Dumped CSV zip file is %dMb in size' % (
+            os.path.getsize(dump_filepath) / (1024 * 1024)))
 
         link_filepath = os.path.join(
             dump_dir, 'data.gov.uk-ckan-meta-data-latest.csv.zip')
@@ -223,63 +233,97 @@ def command(config_file):
         if os.path.exists(link_filepath):
             os.unlink(link_filepath)
         os.symlink(dump_filepath, link_filepath)
-        os.remove(dataset_file)
-        os.remove(resource_file)
+
+        for table, parquet_filepath in parquet_filepaths.items():
+            link_filepath = os.path.join(
+                dump_dir,
+                'data.gov.uk-ckan-meta-data-latest.%s.parquet' % table)
+            if os.path.lexists(link_filepath):
+                os.unlink(link_filepath)
+            os.symlink(parquet_filepath, link_filepath)
 
     def dump_datasets(file_type, dumper_func, dumper_type, dump_dir,
                       *dumper_args, **dumper_kwargs):
         '''
-        Runs the dump, outputing to a tempfile, zips it in correct place,
-        adds 'current' symlink.
+        Runs the dump, writing zip and gz versions of it concurrently in the
+        correct place and, if that all succeeds, points the 'latest'
+        symlinks at them.
 
         dumper_func params depend on dumper_type:
          1: (file object, Package query)
          2: ckanapi.cli.dump.dump_things
         '''
-        import gzip
         import shutil
+        import time
         dump_file_base = start_time.strftime(dump_filebase)
         dump_filename = '%s.%s' % (dump_file_base, file_type)
-        zip_filepath = os.path.join(dump_dir, dump_filename + '.zip')
-        gz_filepath = os.path.join(dump_dir, dump_filename + '.gz')
-        log.info('Creating %s dump: %s', file_type, tmp_filepath)
-        # Dump the data to a temporary file
-        if dumper_type == 1:
-            tmp_file = open(tmp_filepath, 'w+b')
-            query = model.Session.query(model.Package) \
-                .filter(model.Package.state == 'active')
-            dumper_func(tmp_file, query)
-            tmp_file.close()
-        elif dumper_type == 2:
-            dumper_args[2]['--output'] = tmp_filepath
-            dumper_func(*dumper_args, **dumper_kwargs)
+        dump_filepaths = {
+            'zip': os.path.join(dump_dir, dump_filename + '.zip'),
+            'gz': os.path.join(dump_dir, dump_filename + '.gz'),
+            }
+        # Write to temporary paths, so that a failed dump never replaces a
+        # good one
+        partial_filepaths = dict((extension, filepath + '.partial')
+                                 for extension, filepath
+                                 in dump_filepaths.items())
+        log.info('Creating %s dump: %s & %s', file_type,
+                 dump_filepaths['zip'], dump_filepaths['gz'])
+        start = time.time()
+        tee = dgu_dumper.ThreadedTeeWriter([
+            ('zip', dgu_dumper.ZipFileWriter(partial_filepaths['zip'],
+                                             dump_filename)),
+            ('gz', dgu_dumper.GzipFileWriter(partial_filepaths['gz'],
+                                             dump_filename)),
+            ])
         try:
-            log.info('Dumped data file is %dMB in size' %
-                     (os.path.getsize(tmp_filepath) / (1024 * 1024)))
-            # Create zip and gz versions
-            log.info('Zipping dump to: %s & %s' % (zip_filepath, gz_filepath))
-            zip_file = zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_DEFLATED)
-            zip_file.write(tmp_filepath, dump_filename)
-            zip_file.close()
-            with open(tmp_filepath, 'rb') as f_in, \
-                    gzip.open(gz_filepath, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
-
-            # Setup a symbolic link to dumps from
-            # data.gov.uk-ckan-meta-data-latest.{0}.zip so that it is up-to-date
-            # with the latest version for both JSON and CSV.
-            for dump_filepath, extension in ((zip_filepath, 'zip'),
-                                             (gz_filepath, 'gz')):
-                link_filepath = os.path.join(
-                    dump_dir,
-                    'data.gov.uk-ckan-meta-data-latest.{0}.{1}'.format(
-                        file_type, extension))
-
-                if os.path.lexists(link_filepath):
-                    os.unlink(link_filepath)
-                os.symlink(dump_filepath, link_filepath)
+            try:
+                if dumper_type == 1:
+                    query = model.Session.query(model.Package) \
+                        .filter(model.Package.state == 'active')
+                    dumper_func(tee, query)
+                elif dumper_type == 2:
+                    # ckanapi writes to a file path, so read that once
+                    dumper_args[2]['--output'] = tmp_filepath
+                    dumper_func(*dumper_args, **dumper_kwargs)
+                    with open(tmp_filepath, 'rb') as f_in:
+                        shutil.copyfileobj(f_in, tee, tee.chunk_size)
+            finally:
+                tee.close()
+        except:
+            for filepath in partial_filepaths.values():
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+            raise
         finally:
-            os.remove(tmp_filepath)
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+        log.info('Dumped data is %dMB in size, took %.0fs (%s)',
+                 tee.size / (1024 * 1024), time.time() - start,
+                 ', '.join('%s compression %.0fs' % item
+                           for item in sorted(tee.timings.items())))
+
+        for extension, dump_filepath in dump_filepaths.items():
+            os.rename(partial_filepaths[extension], dump_filepath)
+
+        for extension, dump_filepath in dump_filepaths.items():
+            update_latest_link(dump_filepath, file_type, extension)
+
+    def update_latest_link(dump_filepath, file_type, extension):
+        '''
+        Setup a symbolic link to dumps from
+        data.gov.uk-ckan-meta-data-latest.{0}.zip so that it is up-to-date
+        with the latest version for both JSON and CSV. The new link is
+        renamed over the old one, so there is always a link.
+        '''
+        link_filepath = os.path.join(
+            dump_dir,
+            'data.gov.uk-ckan-meta-data-latest.{0}.{1}'.format(
+                file_type, extension))
+        new_link_filepath = link_filepath + '.new'
+        if os.path.lexists(new_link_filepath):
+            os.unlink(new_link_filepath)
+        os.symlink(dump_filepath, new_link_filepath)
+        os.rename(new_link_filepath, link_filepath)
 
     if run_task('dump-csv-unpublished'):
         log.info('Creating database dumps - CSV unpublished')
@@ -295,6 +339,47 @@ def command(config_file):
         dump_datasets('json', dumper.SimpleDumper().dump_json, 1, dump_dir)
         report_time_taken(log)
 
+    if run_task('dump-jsonl-incremental'):
+        # Patches the base dump kept in incremental_dump_dir with the
+        # datasets that have changed since the last run, and publishes it
+        # along with a delta of the changes
+        from ckanext.dgu.lib.incremental_dump import IncrementalDumper
+        log.info('Creating database dumps - incremental JSON lines')
+        create_dump_dir_if_necessary(dump_dir)
+        create_dump_dir_if_necessary(incremental_dump_dir)
+        dump_file_base = start_time.strftime(dump_filebase)
+        dump_filepaths = {}
+        writers = {}
+        for file_type in ('jsonl', 'delta.jsonl'):
+            dump_filename = '%s.%s' % (dump_file_base, file_type)
+            dump_filepaths[file_type] = \
+                os.path.join(dump_dir, dump_filename + '.gz')
+            writers[file_type] = dgu_dumper.GzipFileWriter(
+                dump_filepaths[file_type] + '.partial', dump_filename)
+        incremental_dumper = IncrementalDumper(
+            os.path.join(incremental_dump_dir, 'datasets.jsonl'))
+        try:
+            try:
+                incremental_dumper.dump(writers['jsonl'],
+                                        writers['delta.jsonl'])
+            finally:
+                for writer in writers.values():
+                    writer.close()
+            for dump_filepath in dump_filepaths.values():
+                os.rename(dump_filepath + '.partial', dump_filepath)
+        except:
+            incremental_dumper.abort()
+            for dump_filepath in dump_filepaths.values():
+                if os.path.exists(dump_filepath + '.partial'):
+                    os.remove(dump_filepath + '.partial')
+            raise
+        # Only now that the snapshot and delta are published does the base
+        # move on, so the next delta follows on from this one
+        incremental_dumper.commit()
+        for file_type, dump_filepath in dump_filepaths.items():
+            update_latest_link(dump_filepath, file_type, 'gz')
+        report_time_taken(log)
+
     if run_task('dump-json2'):
         # since gov_daily.py is run with sudo, and a path to python in the venv
         # rather than in an activated environment, and ckanapi creates
@@ -377,6 +462,31 @@ def command(config_file):
             worker_pool=None, stdout=devnull, stderr=devnull)
         report_time_taken(log)
 
+    if run_task('publisher-resource-counts'):
+        log.info('Refreshing the publisher resource counts view')
+        from ckanext.dgu.lib.publisher import refresh_resource_count_view
+        refresh_resource_count_view()
+        report_time_taken(log)
+
+    if run_task('publisher-performance'):
+        # Run this after the archiver and QA, so the traffic lights on the
+        # publisher pages reflect their latest results
+        log.info('Refreshing publisher performance data')
+        from ckanext.dgu.lib.publisher import refresh_performance_data
+        publishers = model.Session.query(model.Group) \
+                          .filter_by(is_organization=True) \
+                          .filter_by(state='active') \
+                          .all()
+        for publisher in publishers:
+            try:
+                refresh_performance_data(publisher)
+            except Exception, e:
+                log.exception(e)
+                log.error('Failed to refresh performance data for %s',
+                          publisher.name)
+                model.Session.rollback()
+        report_time_taken(log)
+
     # Dump analysis
     if run_task('dump_analysis'):
         log.info('Doing dump analysis')
@@ -476,9 +586,11 @@ class ConfigObject(dict):
 
 
 TASKS_TO_RUN = ['analytics', 'openspending',
-                'dump-csv', 'dump-csv-unpublished', 'dump-json', 'dump-json2',
+                'dump-csv', 'dump-csv-unpublished', 'dump-json',
+                'dump-jsonl-incremental', 'dump-json2',
                 'dump-orgs', 'dump-orgs-private',
-                'dump_analysis', 'backup']
+                'dump_analysis', 'publisher-resource-counts',
+                'publisher-performance', 'backup']
 
 if __name__ == '__main__':
     USAGE = '''Daily script for government
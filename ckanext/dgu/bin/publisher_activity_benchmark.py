@@ -0,0 +1,186 @@
+'''Times the generation of the publisher-activity report data
+(reports._get_activity), comparing it with the previous way of gathering it
+(several revision queries for every dataset, for every period), and checks
+that they give the same results.
+'''
+import datetime
+import time
+from optparse import OptionParser
+
+import common
+
+
+# The previous version of reports._get_activity
+def previous_get_activity(organization_name, include_sub_organizations, periods):
+    import ckan.model as model
+    import ckan.plugins as p
+    from paste.deploy.converters import asbool
+    from ckanext.report import lib
+
+    created = dict((period_name, []) for period_name in periods)
+    modified = dict((period_name, []) for period_name in periods)
+
+    # These are the authors whose revisions we ignore, as they are trivial
+    # changes. NB we do want to know about revisions by:
+    # * harvest (harvested metadata)
+    # * dgu (NS Stat Hub imports)
+    # * Fix national indicators
+    system_authors = ('autotheme', 'co-prod3.dh.bytemark.co.uk',
+                      'Date format tidier', 'current_revision_fixer',
+                      'current_revision_fixer2', 'fix_contact_details.py',
+                      'Repoint 410 Gone to webarchive url',
+                      'Fix duplicate resources',
+                      'fix_secondary_theme.py',
+                      )
+    system_author_template = 'script%'  # "%" is a wildcard
+
+    if organization_name:
+        organization = model.Group.by_name(organization_name)
+        if not organization:
+            raise p.toolkit.ObjectNotFound()
+
+    if not organization_name:
+        pkgs = model.Session.query(model.Package)\
+                    .all()
+    else:
+        pkgs = model.Session.query(model.Package)
+        pkgs = lib.filter_by_organizations(pkgs, organization,
+                                           include_sub_organizations).all()
+
+    for pkg in pkgs:
+        created_ = model.Session.query(model.PackageRevision)\
+            .filter(model.PackageRevision.id == pkg.id) \
+            .order_by("revision_timestamp asc").first()
+
+        pr_q = model.Session.query(model.PackageRevision, model.Revision)\
+            .filter(model.PackageRevision.id == pkg.id)\
+            .filter_by(state='active')\
+            .join(model.Revision)\
+            .filter(~model.Revision.author.in_(system_authors)) \
+            .filter(~model.Revision.author.like(system_author_template))
+        rr_q = model.Session.query(model.Package, model.ResourceRevision, model.Revision)\
+            .filter(model.Package.id == pkg.id)\
+            .filter_by(state='active')\
+            .join(model.ResourceGroup)\
+            .join(model.ResourceRevision,
+                  model.ResourceGroup.id == model.ResourceRevision.resource_group_id)\
+            .join(model.Revision)\
+            .filter(~model.Revision.author.in_(system_authors))\
+            .filter(~model.Revision.author.like(system_author_template))
+        pe_q = model.Session.query(model.Package, model.PackageExtraRevision, model.Revision)\
+            .filter(model.Package.id == pkg.id)\
+            .filter_by(state='active')\
+            .join(model.PackageExtraRevision,
+                  model.Package.id == model.PackageExtraRevision.package_id)\
+            .join(model.Revision)\
+            .filter(~model.Revision.author.in_(system_authors))\
+            .filter(~model.Revision.author.like(system_author_template))
+
+        for period_name in periods:
+            period = periods[period_name]
+            # created
+            if period[0] < created_.revision_timestamp < period[1]:
+                published = not asbool(pkg.extras.get('unpublished'))
+                created[period_name].append(
+                    (created_.name, created_.title, lib.dataset_notes(pkg),
+                     'created', period_name,
+                     created_.revision_timestamp.isoformat(),
+                     created_.revision.author, published))
+
+            # modified
+            # exclude the creation revision
+            period_start = max(period[0], created_.revision_timestamp)
+            prs = pr_q.filter(model.PackageRevision.revision_timestamp > period_start)\
+                        .filter(model.PackageRevision.revision_timestamp < period[1])
+            rrs = rr_q.filter(model.ResourceRevision.revision_timestamp > period_start)\
+                        .filter(model.ResourceRevision.revision_timestamp < period[1])
+            pes = pe_q.filter(model.PackageExtraRevision.revision_timestamp > period_start)\
+                        .filter(model.PackageExtraRevision.revision_timestamp < period[1])
+            authors = ' '.join(set([r[1].author for r in prs] +
+                                   [r[2].author for r in rrs] +
+                                   [r[2].author for r in pes]))
+            dates = set([r[1].timestamp.date() for r in prs] +
+                        [r[2].timestamp.date() for r in rrs] +
+                        [r[2].timestamp.date() for r in pes])
+            dates_formatted = ' '.join([date.isoformat()
+                                        for date in sorted(dates)])
+            if authors:
+                published = not asbool(pkg.extras.get('unpublished'))
+                modified[period_name].append(
+                    (pkg.name, pkg.title, lib.dataset_notes(pkg),
+                        'modified', period_name,
+                        dates_formatted, authors, published))
+    return created, modified
+
+
+def normalise_activity(activity):
+    '''Returns the created or modified dict in a form that can be compared
+    - the order of the datasets, and of the authors of each, is arbitrary.'''
+    def normalise_row(row):
+        row = list(row)
+        row[6] = ' '.join(sorted((row[6] or '').split(' ')))
+        return tuple(row)
+    return dict((period_name, sorted(normalise_row(row) for row in rows))
+                for period_name, rows in activity.items())
+
+
+class QueryCounter(object):
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self.on_execute)
+
+    def on_execute(self, *args):
+        self.count += 1
+
+
+def run(options):
+    from ckan import model
+    from ckanext.dgu.lib import reports
+
+    periods = reports.get_quarter_dates(datetime.datetime.now())
+    query_counter = QueryCounter(model.meta.engine)
+    print 'Activity of %s%s' % (
+        options.organization or 'all organizations',
+        ' and sub-organizations' if options.include_sub_organizations else '')
+    results = []
+    funcs = [('_get_activity', reports._get_activity)]
+    if not options.skip_previous:
+        funcs.insert(0, ('previous', previous_get_activity))
+    for name, func in funcs:
+        model.Session.remove()
+        query_counter.count = 0
+        start = time.time()
+        created, modified = func(options.organization,
+                                 options.include_sub_organizations, periods)
+        duration = time.time() - start
+        print '%-15s %8.2fs %8i queries  %i created %i modified' % (
+            name, duration, query_counter.count,
+            sum(len(rows) for rows in created.values()),
+            sum(len(rows) for rows in modified.values()))
+        results.append((normalise_activity(created),
+                        normalise_activity(modified)))
+    if len(results) == 2:
+        print 'Results are the same' if results[0] == results[1] \
+            else 'RESULTS DIFFER'
+
+
+usage = __doc__ + '''
+Usage:
+    python publisher_activity_benchmark.py <CKAN config.ini> [-o ORGANIZATION] [--include-sub-organizations] [--skip-previous]'''
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=usage)
+    parser.add_option('-o', '--organization', dest='organization',
+                      help='Name of the organization (default: all of them)')
+    parser.add_option('--include-sub-organizations', action='store_true',
+                      dest='include_sub_organizations', default=False)
+    parser.add_option('--skip-previous', action='store_true',
+                      dest='skip_previous', default=False,
+                      help='Don\'t time the previous way, which takes hours '
+                           'for all organizations')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Wrong number of arguments')
+    common.load_config(args[0])
+    run(options)
@@ -0,0 +1,30 @@
+import logging
+
+from ckan.lib.cli import CkanCommand
+# No other CKAN imports allowed until _load_config is run,
+# or logging is disabled
+
+class InitDB(CkanCommand):
+    """
+    Creates the table of search index fingerprints (dgu_index_fingerprint)
+    """
+    summary = __doc__.strip().split('\n')[0]
+    usage = __doc__
+    max_args = 0
+    min_args = 0
+
+    def __init__(self, name):
+        super(InitDB, self).__init__(name)
+
+    def command(self):
+        self._load_config()
+        log = logging.getLogger(__name__)
+
+        import ckan.model as model
+        model.Session.remove()
+        model.Session.configure(bind=model.meta.engine)
+        log.info("Database access initialised")
+
+        import ckanext.dgu.model.index_fingerprint as fp_model
+        fp_model.init_tables(model.meta.engine)
+        log.debug("Index fingerprint table is setup")
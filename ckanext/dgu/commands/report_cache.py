@@ -0,0 +1,282 @@
+import collections
+import datetime
+import time
+import logging
+import traceback
+from multiprocessing import Pool
+
+from ckan.lib.cli import CkanCommand
+
+log = logging.getLogger('ckanext')
+
+
+class ParallelReportCache(CkanCommand):
+    """
+    Regenerates the cached reports, running the option combinations in parallel
+
+    Each report's option combinations (e.g. every organization, with and
+    without sub-organizations) are shared out between a pool of worker
+    processes, each with its own DB session. The publisher tree is loaded
+    once, before the workers start, and the workers use it to find the
+    sub-organizations, rather than querying the hierarchy for every
+    combination. The reports are run one after another, each with its
+    combinations with the most datasets started first, so a worker only
+    keeps the organization parts (see report_rollup) of one report at a time.
+
+    The results are written to the report cache (DataCache) by this process,
+    committing a batch at a time.
+
+    With --only-stale, only the combinations that are not cached, or were
+    cached more than --max-age hours ago, are regenerated.
+
+    Usage:
+        paster parallel_report_cache [REPORT_NAME ...] [-w 4] [-b 50] [--only-stale] [--max-age 24]
+    """
+    summary = __doc__.strip().split('\n')[0]
+    usage = '\n' + __doc__
+    max_args = None
+    min_args = 0
+
+    def __init__(self, name):
+        super(ParallelReportCache, self).__init__(name)
+        self.parser.add_option("-w", "--workers",
+                  type="int", dest="workers",
+                  default=4,
+                  help="Number of worker processes")
+        self.parser.add_option("-b", "--batch-size",
+                  type="int", dest="batch_size",
+                  default=50,
+                  help="Number of reports written to the cache per commit")
+        self.parser.add_option("--only-stale",
+                  action="store_true", dest="only_stale",
+                  default=False,
+                  help="Only regenerate reports that are not cached or are "
+                       "older than --max-age")
+        self.parser.add_option("--max-age",
+                  type="float", dest="max_age",
+                  default=24,
+                  help="Age (hours) of a cached report before it is stale")
+
+    def command(self):
+        self._load_config()
+
+        import ckan.model as model
+        from ckanext.report.report_registry import ReportRegistry
+        from ckanext.dgu.lib.publisher import get_publisher_ancestry
+
+        registry = ReportRegistry.instance()
+        if self.args:
+            reports = [registry.get_report(name) for name in self.args]
+        else:
+            reports = registry.get_reports()
+
+        tasks = []
+        report_order = {}
+        for report in reports:
+            report_order[report.name] = len(report_order)
+            option_dicts = list(report.option_combinations()) \
+                if report.option_combinations else [{}]
+            if self.options.only_stale:
+                option_dicts = stale_option_dicts(
+                    report, option_dicts,
+                    datetime.timedelta(hours=self.options.max_age))
+            tasks.extend((report.name, option_dict)
+                         for option_dict in option_dicts)
+        log.info('Reports to generate: %i', len(tasks))
+        if not tasks:
+            return
+
+        # Loaded before the workers are forked, so they all share it
+        global _sub_organization_ids
+        _sub_organization_ids = load_sub_organization_ids(
+            get_publisher_ancestry())
+        tasks.sort(key=lambda task: (report_order[task[0]],
+                                     -estimate_task_size(task)))
+
+        # The workers must not share the parent's DB connections
+        model.Session.remove()
+        model.meta.engine.dispose()
+
+        start = time.time()
+        timings = collections.defaultdict(list)
+        errors = collections.defaultdict(int)
+        pool = Pool(self.options.workers, initializer=init_worker)
+        try:
+            batch = []
+            for result in pool.imap_unordered(generate_report, tasks):
+                report_name, option_dict, data, duration, error = result
+                timings[report_name].append(duration)
+                if error:
+                    errors[report_name] += 1
+                    log.error('Report %s %r failed: %s',
+                              report_name, option_dict, error)
+                    continue
+                batch.append((report_name, option_dict, data))
+                if len(batch) >= self.options.batch_size:
+                    save_reports(registry, batch)
+                    batch = []
+            save_reports(registry, batch)
+        finally:
+            pool.close()
+            pool.join()
+
+        log.info('Generated %i reports in %.0fs', len(tasks),
+                 time.time() - start)
+        log.info('%-25s %6s %6s %8s %8s %8s', 'Report', 'Count', 'Errors',
+                 'Total s', 'Mean s', 'Max s')
+        for report_name, durations in sorted(timings.items()):
+            log.info('%-25s %6i %6i %8.1f %8.2f %8.2f', report_name,
+                     len(durations), errors[report_name], sum(durations),
+                     sum(durations) / len(durations), max(durations))
+
+
+# Organization (name and id): its id and the ids of it and all the
+# organizations below it in the hierarchy. Loaded by the parent process and
+# inherited by the workers.
+_sub_organization_ids = None
+
+# Organization id: number of active datasets (for scheduling)
+_dataset_counts = None
+
+
+def load_sub_organization_ids(ancestry):
+    '''Given the publisher ancestry table (see get_publisher_ancestry),
+    returns a dict of each organization's id and name to a tuple of its id
+    and a list of the ids of it and its sub-organizations.'''
+    tree_ids = collections.defaultdict(list)
+    for key, publisher in ancestry.items():
+        if key != publisher['id']:
+            # each publisher appears under its id and name - do it once
+            continue
+        for ancestor_name in publisher['ancestors']:
+            tree_ids[ancestor_name].append(publisher['id'])
+    sub_organization_ids = {}
+    for name, ids in tree_ids.items():
+        publisher = ancestry[name]
+        sub_organization_ids[name] = sub_organization_ids[publisher['id']] = \
+            (publisher['id'], ids)
+    return sub_organization_ids
+
+
+def estimate_task_size(task):
+    '''The number of datasets a report option combination covers. Reports of
+    all organizations count as the biggest.'''
+    import ckan.model as model
+    from sqlalchemy import func
+    global _dataset_counts
+    if _dataset_counts is None:
+        _dataset_counts = dict(
+            model.Session.query(model.Package.owner_org,
+                                func.count(model.Package.id))
+            .filter(model.Package.state == 'active')
+            .group_by(model.Package.owner_org))
+    report_name, option_dict = task
+    organization = option_dict.get('organization') or option_dict.get('org')
+    if not organization:
+        return sum(_dataset_counts.values())
+    if organization not in _sub_organization_ids:
+        return 0
+    org_id, tree_ids = _sub_organization_ids[organization]
+    org_ids = tree_ids if option_dict.get('include_sub_organizations') \
+        else [org_id]
+    return sum(_dataset_counts.get(id_, 0) for id_ in org_ids)
+
+
+def stale_option_dicts(report, option_dicts, max_age):
+    '''Returns the option_dicts that have no cached report, or one older than
+    max_age (timedelta). The cache dates are got in one query.'''
+    import ckan.model as model
+    from ckanext.report.model import DataCache
+
+    cached_dates = dict(
+        model.Session.query(DataCache.key, DataCache.created)
+        .filter(DataCache.object_id == report.name))
+    stale_before = datetime.datetime.now() - max_age
+    stale = []
+    for option_dict in option_dicts:
+        key = report.generate_key(report.add_defaults_to_options(option_dict))
+        created = cached_dates.get(key)
+        if created is None or created < stale_before:
+            stale.append(option_dict)
+    log.info('Report %s: %i of %i option combinations are stale',
+             report.name, len(stale), len(option_dicts))
+    return stale
+
+
+def save_reports(registry, batch):
+    '''Writes the generated reports to the cache and commits. This is the same
+    as Report.refresh_cache does, but with one commit for the batch.'''
+    import ckan.model as model
+    from ckanext.report.model import DataCache
+
+    if not batch:
+        return
+    for report_name, option_dict, data in batch:
+        report = registry.get_report(report_name)
+        key = report.generate_key(option_dict)
+        DataCache.set(report.name, key, data, convert_json=False)
+    model.Session.commit()
+    log.info('Saved %i reports', len(batch))
+
+
+def filter_by_organizations(query, organization, include_sub_organizations):
+    '''Version of ckanext.report.lib.filter_by_organizations that gets the
+    sub-organizations from the pre-loaded publisher tree.'''
+    import ckan.model as model
+    if not organization:
+        return query
+    if not isinstance(organization, basestring):
+        organization = organization.name
+    if organization not in _sub_organization_ids:
+        return _original_filter_by_organizations(
+            query, organization, include_sub_organizations)
+    org_id, tree_ids = _sub_organization_ids[organization]
+    if not include_sub_organizations:
+        return query.filter(model.Package.owner_org == org_id)
+    return query.filter(model.Package.owner_org.in_(tree_ids))
+
+_original_filter_by_organizations = None
+
+
+def init_worker():
+    import ckan.model as model
+    from ckanext.report import lib
+
+    model.Session.remove()
+    model.Session.configure(bind=model.meta.engine)
+
+    # [Monkey patch] Reports call lib.filter_by_organizations for each
+    # option combination, which queries the hierarchy each time.
+    global _original_filter_by_organizations
+    if lib.filter_by_organizations is not filter_by_organizations:
+        _original_filter_by_organizations = lib.filter_by_organizations
+        lib.filter_by_organizations = filter_by_organizations
+
+
+def generate_report(task):
+    '''Runs in a worker. Returns the report data as JSON, so that it is the
+    same as Report.refresh_cache would store.'''
+    import json
+    import ckan.model as model
+    from ckan.lib.json import DateTimeJsonEncoder
+    from ckanext.report.report_registry import ReportRegistry
+    from ckanext.dgu.lib.report_rollup import cache_parts_in_scope
+
+    report_name, option_dict = task
+    # Each organization's part of the rolled-up reports is generated once by
+    # each worker, and reused for the organizations above it, until the
+    # worker moves on to the next report
+    cache_parts_in_scope(report_name)
+    start = time.time()
+    data = error = None
+    try:
+        report = ReportRegistry.instance().get_report(report_name)
+        option_dict = report.add_defaults_to_options(option_dict)
+        data = json.dumps(report.generate(**option_dict),
+                          cls=DateTimeJsonEncoder)
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        # Don't let the session grow, or hold a transaction open
+        model.Session.remove()
+    return report_name, option_dict, data, time.time() - start, error
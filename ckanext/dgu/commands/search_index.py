@@ -0,0 +1,247 @@
+import os
+import time
+import logging
+from multiprocessing import Process
+
+from ckan.lib.cli import CkanCommand
+
+log = logging.getLogger('ckanext')
+
+
+class ParallelSearchIndex(CkanCommand):
+    """
+    Rebuilds the Solr index of all active datasets, using several processes
+
+    The active dataset ids are sharded across the worker processes. Each
+    worker has its own DB session and Solr connection, runs the usual
+    before_index steps (SearchPlugin) and posts the documents to Solr in
+    batches without committing. Solr is committed once at the end.
+
+    Each worker records the ids it has posted in a checkpoint file, so if the
+    run crashes it can be restarted and will skip those datasets. Delete the
+    checkpoint files (or use --restart) to do a complete reindex.
+
+    A dataset that fails to index is logged and skipped. The failed ids are
+    listed at the end, and the checkpoint files are kept so that running
+    again retries just those.
+
+    Usage:
+        paster parallel_search_index [-w 4] [-b 500] [-c CHECKPOINT] [--restart]
+    """
+    summary = __doc__.strip().split('\n')[0]
+    usage = '\n' + __doc__
+    max_args = 0
+    min_args = 0
+
+    def __init__(self, name):
+        super(ParallelSearchIndex, self).__init__(name)
+        self.parser.add_option("-w", "--workers",
+                  type="int", dest="workers",
+                  default=4,
+                  help="Number of worker processes")
+        self.parser.add_option("-b", "--batch-size",
+                  type="int", dest="batch_size",
+                  default=500,
+                  help="Number of documents posted to Solr at a time")
+        self.parser.add_option("-c", "--checkpoint",
+                  type="string", dest="checkpoint",
+                  default="search_index.checkpoint",
+                  help="Path prefix for the checkpoint files")
+        self.parser.add_option("--restart",
+                  action="store_true", dest="restart",
+                  default=False,
+                  help="Ignore any existing checkpoint and reindex everything")
+
+    def command(self):
+        self._load_config()
+
+        import ckan.model as model
+        from ckan.lib.search import make_connection
+        from pylons import config
+        from paste.deploy.converters import asbool
+
+        checkpoint_files = [checkpoint_filepath(self.options.checkpoint, i)
+                            for i in range(self.options.workers)]
+        failed_files = [failed_filepath(self.options.checkpoint, i)
+                        for i in range(self.options.workers)]
+        for filepath in failed_files + \
+                (checkpoint_files if self.options.restart else []):
+            if os.path.exists(filepath):
+                os.remove(filepath)
+        done_ids = read_checkpoints(self.options.checkpoint)
+        if done_ids:
+            log.info('Resuming - %i datasets already indexed according to '
+                     'the checkpoint files', len(done_ids))
+
+        package_ids = [id_ for id_, in model.Session.query(model.Package.id)
+                       .filter(model.Package.state == 'active')
+                       .order_by(model.Package.id)
+                       if id_ not in done_ids]
+        log.info('Datasets to index: %i', len(package_ids))
+
+        # The workers write to Solr directly, so stored index fingerprints
+        # would no longer reflect what is in Solr
+        if asbool(config.get('dgu.search.skip_unchanged', False)):
+            from ckanext.dgu.lib import search_fingerprint
+            search_fingerprint.clear_fingerprints(package_ids)
+
+        # The workers must not share the parent's DB connections
+        model.Session.remove()
+        model.meta.engine.dispose()
+
+        start = time.time()
+        procs = []
+        for i in range(self.options.workers):
+            shard = package_ids[i::self.options.workers]
+            p = Process(target=index_worker,
+                        args=(i, shard, self.options.batch_size,
+                              checkpoint_files[i], failed_files[i]))
+            procs.append(p)
+            p.start()
+        for p in procs:
+            p.join()
+
+        failed = [i for i, p in enumerate(procs) if p.exitcode != 0]
+        if failed:
+            log.error('Workers %r failed - Solr not committed. Run again to '
+                      'resume from the checkpoint.', failed)
+            return
+
+        conn = make_connection()
+        try:
+            conn.commit()
+        finally:
+            conn.close()
+        duration = time.time() - start
+        log.info('Indexed %i datasets in %.0fs (%.1f docs/sec) and committed',
+                 len(package_ids), duration,
+                 len(package_ids) / duration if duration else 0)
+        failed_ids = read_failed(self.options.checkpoint,
+                                 self.options.workers)
+        if failed_ids:
+            log.error('%i datasets failed to index (see the errors above). '
+                      'Run again to retry them: %s',
+                      len(failed_ids), ' '.join(sorted(failed_ids)))
+            return
+        for filepath in checkpoint_files:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+
+
+def checkpoint_filepath(prefix, worker_num):
+    return '%s.%i' % (prefix, worker_num)
+
+
+def failed_filepath(prefix, worker_num):
+    # not matched by read_checkpoints' glob
+    return '%s-failed.%i' % (prefix, worker_num)
+
+
+def read_failed(prefix, num_workers):
+    '''Returns the set of package ids that the workers failed to index.'''
+    failed_ids = set()
+    for i in range(num_workers):
+        filepath = failed_filepath(prefix, i)
+        if os.path.exists(filepath):
+            with open(filepath) as f:
+                failed_ids.update(line.strip() for line in f if line.strip())
+    return failed_ids
+
+
+def read_checkpoints(prefix):
+    '''Returns the set of package ids recorded in all the checkpoint files
+    with the given path prefix.'''
+    import glob
+    done_ids = set()
+    for filepath in glob.glob(prefix + '.*'):
+        with open(filepath) as f:
+            done_ids.update(line.strip() for line in f if line.strip())
+    return done_ids
+
+
+class BatchingConnection(object):
+    '''Stands in for the Solr connection used by PackageSearchIndex, holding
+    on to the documents it is given and posting them to Solr in batches,
+    without committing.'''
+    def __init__(self, batch_size, on_flush):
+        self.batch_size = batch_size
+        self.on_flush = on_flush
+        self.docs = []
+
+    def add_many(self, docs, _commit=False):
+        self.docs.extend(docs)
+        if len(self.docs) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        from ckan.lib.search import make_connection
+        if not self.docs:
+            return
+        conn = make_connection()
+        try:
+            conn.add_many(self.docs, _commit=False)
+        finally:
+            conn.close()
+        self.on_flush([doc['id'] for doc in self.docs])
+        self.docs = []
+
+    def close(self):
+        # the real connection is only opened for each flush
+        pass
+
+
+def index_worker(worker_num, package_ids, batch_size, checkpoint_file,
+                 failed_file):
+    import ckan.model as model
+    from ckan.lib.search import index as search_index
+    from ckan.logic import get_action
+
+    model.Session.remove()
+    model.Session.configure(bind=model.meta.engine)
+
+    start = time.time()
+    stats = {'indexed': 0, 'failed': 0}
+    checkpoint = open(checkpoint_file, 'a')
+    failed = open(failed_file, 'a')
+
+    def on_flush(ids):
+        checkpoint.write(''.join(id_ + '\n' for id_ in ids))
+        checkpoint.flush()
+        stats['indexed'] += len(ids)
+        duration = time.time() - start
+        log.info('Worker %i: %i/%i datasets indexed (%.1f docs/sec)',
+                 worker_num, stats['indexed'], len(package_ids),
+                 stats['indexed'] / duration if duration else 0)
+
+    # [Monkey patch] PackageSearchIndex opens a connection and posts each
+    # document as it is indexed. Give it the batching connection instead.
+    batching_conn = BatchingConnection(batch_size, on_flush)
+    search_index.make_connection = lambda: batching_conn
+
+    package_index = search_index.PackageSearchIndex()
+    context = {'model': model, 'ignore_auth': True, 'validate': False,
+               'use_cache': False}
+    try:
+        for package_id in package_ids:
+            try:
+                pkg_dict = get_action('package_show')(context.copy(),
+                                                      {'id': package_id})
+                package_index.update_dict(pkg_dict, defer_commit=True)
+            except Exception:
+                log.exception('Worker %i: error indexing dataset %s',
+                              worker_num, package_id)
+                failed.write(package_id + '\n')
+                failed.flush()
+                stats['failed'] += 1
+            finally:
+                # Don't let the session grow throughout the run
+                model.Session.remove()
+        batching_conn.flush()
+    finally:
+        checkpoint.close()
+        failed.close()
+    duration = time.time() - start
+    log.info('Worker %i finished: %i datasets in %.0fs (%.1f docs/sec), '
+             '%i failed',
+             worker_num, stats['indexed'], duration,
+             stats['indexed'] / duration if duration else 0, stats['failed'])
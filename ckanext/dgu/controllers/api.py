@@ -1,10 +1,17 @@
+import base64
 import datetime
+import email.utils
+import hashlib
 import logging
 import csv
 import StringIO
+import time
 
+from sqlalchemy import or_, and_
 from webhelpers.text import truncate
 
+from pylons import config
+
 from ckan.lib.base import model, abort, response, h, BaseController, request
 from ckan.controllers.api import ApiController
 from ckan.lib.helpers import OrderedDict, date_str_to_datetime, markdown_extract, json
@@ -12,11 +19,18 @@ from ckanext.dgu.plugins_toolkit import get_action
 import ckan.plugins.toolkit as t
 from ckanext.dgu.lib.helpers import is_sysadmin
 from ckanext.dgu.lib import reports
+from ckanext.dgu.lib import incremental_dump
+from ckanext.dgu.lib.dataset_counts import get_dataset_counts
 
 log = logging.getLogger(__name__)
 
 default_limit = 10
 
+# (limit, published_only): (time cached, datasets, etag, last modified)
+_latest_datasets_cache = {}
+
+REVISION_CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
 
 class DguApiController(ApiController):
 
@@ -32,6 +46,10 @@ class DguApiController(ApiController):
         '''Designed for the dgu home page, shows lists the latest datasets
         that got changed (exluding extra, group and tag changes) with lots
         of details about each dataset.
+
+        The response is built just from the search index and is cached for
+        dgu.latest_datasets.ttl seconds (default 60). ETag and Last-Modified
+        headers are given, so clients can revalidate with a conditional GET.
         '''
         try:
             limit = int(request.params.get('limit', default_limit))
@@ -40,65 +58,121 @@ class DguApiController(ApiController):
 
         limit = min(100, limit) # max value
 
-        from ckan.lib.search import SearchError
+        cache_key = (limit, bool(published_only))
+        cached = _latest_datasets_cache.get(cache_key)
+        ttl = int(config.get('dgu.latest_datasets.ttl', 60))
+        if not cached or cached[0] + ttl < time.time():
+            pkg_dicts = self._latest_datasets_from_index(limit, published_only)
+            if pkg_dicts is None:
+                # search error
+                return self._finish_ok([])
+            etag = hashlib.md5(json.dumps(pkg_dicts)).hexdigest()
+            if cached and cached[2] == etag:
+                # unchanged, so keep the same Last-Modified
+                cached = (time.time(), cached[1], etag, cached[3])
+            else:
+                cached = (time.time(), pkg_dicts, etag, int(time.time()))
+            _latest_datasets_cache[cache_key] = cached
+        created, pkg_dicts, etag, last_modified = cached
+
+        response.headers['ETag'] = '"%s"' % etag
+        response.headers['Last-Modified'] = \
+            email.utils.formatdate(last_modified, usegmt=True)
+        if self._not_modified(etag, last_modified):
+            response.status_int = 304
+            return ''
+        return self._finish_ok(pkg_dicts)
+
+    def _latest_datasets_from_index(self, limit, published_only):
+        '''Returns the latest datasets, using only the fields stored in the
+        search index, or None if there is a search error.'''
+        from ckan.lib.search import SearchError, query_for
+        from ckanext.dgu.lib.publisher import get_publisher_ancestry
+
         fq = 'capacity:"public"'
         if published_only:
              fq = fq + ' unpublished:false'
 
         try:
-            # package search
-            context = {'model': model, 'session': model.Session,
-                       'user': 'visitor'}
-            data_dict = {
-                'q':'',
+            query = query_for(model.Package)
+            query.run({
+                'q': '',
                 'fq': fq,
-                'facet':'false',
-                'start':0,
+                'fl': 'name title notes organization metadata_modified',
+                'facet': 'false',
+                'start': 0,
                 'rows': limit,
                 'sort': 'metadata_modified desc'
-            }
-            query = get_action('package_search')(context,data_dict)
+            })
         except SearchError, se:
             log.error('Search error: %s', se)
+            return None
 
+        publishers = get_publisher_ancestry()
         pkg_dicts = []
-        for pkg_dict in query['results']:
-            pkg = model.Package.get(pkg_dict['id'])
-            publisher = pkg.get_organization()
+        for result in query.results:
+            publisher = publishers.get(result.get('organization'))
             if publisher:
-                pub_title = publisher.title
-                pub_link = '/publisher/%s' % publisher.name
+                pub_title = publisher['title']
+                pub_link = '/publisher/%s' % publisher['name']
             else:
                 pub_title = pub_link = None
-            last_modified = pkg.metadata_modified
             pkg_dict = OrderedDict((
-                ('name', pkg.name),
-                ('title', pkg.title),
-                ('notes', pkg.notes),
-                ('dataset_link', '/dataset/%s' % pkg.name),
+                ('name', result['name']),
+                ('title', result['title']),
+                ('notes', result.get('notes')),
+                ('dataset_link', '/dataset/%s' % result['name']),
                 ('publisher_title', pub_title),
                 ('publisher_link', pub_link),
-                ('metadata_modified', last_modified.isoformat()),
+                # Solr dates are UTC, with a Z
+                ('metadata_modified', result['metadata_modified'].rstrip('Z')),
                 ))
             pkg_dicts.append(pkg_dict)
-        return self._finish_ok(pkg_dicts)
+        return pkg_dicts
+
+    def _not_modified(self, etag, last_modified):
+        '''Returns whether the request is a conditional GET that matches the
+        given ETag or Last-Modified (seconds since epoch)'''
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match:
+            return if_none_match == '*' or '"%s"' % etag in \
+                [tag.strip() for tag in if_none_match.split(',')]
+        if_modified_since = request.headers.get('If-Modified-Since')
+        if if_modified_since:
+            since = email.utils.parsedate_tz(if_modified_since)
+            if since:
+                return email.utils.mktime_tz(since) >= last_modified
+        return False
 
     def revisions(self):
         '''
         Similar to the revision search API, lists all revisions for which
         a dataset or group changed in some way.
 
-        URL Params:
+        URL Params (one of):
           since-revision-id
           since-timestamp (utc)
           in-the-last-x-minutes
+          cursor - the 'next' value from a previous call
+
+        The revisions are returned a page at a time (up to 50, or 1000 for a
+        sysadmin), with results_limited set if there are more. The 'next'
+        value in the result gives the cursor for the following page, or for
+        polling for later revisions.
         '''
         # parse options
         rev_id = request.params.get('since-revision-id')
         since_timestamp = request.params.get('since-timestamp')
         in_the_last_x_minutes = request.params.get('in-the-last-x-minutes')
+        cursor = request.params.get('cursor')
         now = datetime.datetime.utcnow()
-        if rev_id is not None:
+        after_rev_id = None
+        if cursor is not None:
+            try:
+                since_timestamp, after_rev_id = self._parse_revision_cursor(cursor)
+            except ValueError:
+                abort(400, 'Could not parse cursor "%s"' % cursor)
+        elif rev_id is not None:
             rev = model.Session.query(model.Revision).get(rev_id)
             if not rev:
                 abort(400, 'Revision ID "%s" does not exist' % rev_id)
@@ -117,7 +191,7 @@ class DguApiController(ApiController):
             since_timestamp = now - \
                          datetime.timedelta(minutes=in_the_last_x_minutes)
         else:
-            abort(400, 'Must specify revisions parameter. It must be one from: since-revision-id since-timestamp in-the-last-x-minutes')
+            abort(400, 'Must specify revisions parameter. It must be one from: since-revision-id since-timestamp in-the-last-x-minutes cursor')
 
         # limit is higher if sysadmin
         if is_sysadmin():
@@ -125,111 +199,106 @@ class DguApiController(ApiController):
         else:
             max_limit = 50
 
-        # Get the revisions in the requested time frame
-        revs = model.Session.query(model.Revision) \
-               .filter(model.Revision.timestamp >= since_timestamp) \
-               .order_by(model.Revision.timestamp.asc()) \
-               .limit(max_limit) \
-               .all()
+        # Get the revisions in the requested time frame. A cursor points
+        # after a particular revision, so (timestamp, id) are compared.
+        revs = model.Session.query(model.Revision)
+        if after_rev_id is not None:
+            revs = revs.filter(or_(
+                model.Revision.timestamp > since_timestamp,
+                and_(model.Revision.timestamp == since_timestamp,
+                     model.Revision.id > after_rev_id)))
+        else:
+            revs = revs.filter(model.Revision.timestamp >= since_timestamp)
+        revs = revs.order_by(model.Revision.timestamp.asc(),
+                             model.Revision.id.asc()) \
+                   .limit(max_limit) \
+                   .all()
+        if revs:
+            next_cursor = self._revision_cursor(revs[-1])
+        else:
+            next_cursor = cursor or self._revision_cursor(None, since_timestamp)
         result = OrderedDict((
             ('number_of_revisions', len(revs)),
             ('since_timestamp', since_timestamp.strftime('%Y-%m-%d %H:%M')),
             ('current_timestamp', now.strftime('%Y-%m-%d %H:%M')),
             ('since_revision_id', revs[0].id if revs else None),
             ('newest_revision_id', revs[-1].id if revs else None),
-            ('results_limited', len(revs) == max_limit)))
-
-        # See which packages have changed in the time frame
-        changed_package_ids = set()
-        query = model.Session.query(model.PackageRevision) \
-                .join(model.Revision) \
-                .filter(model.Revision.timestamp >= since_timestamp) \
-                .limit(max_limit)
-        if query.count() == max_limit:
-            result['results_limited'] = True
-        changed_package_ids.update([pkg_rev.id for pkg_rev in query.all()])
-
-        if not result['results_limited']:
-            for related_type in (model.PackageTagRevision,
-                                 model.PackageExtraRevision):
-                query = model.Session.query(related_type) \
-                        .join(model.Revision) \
-                        .filter(model.Revision.timestamp >= since_timestamp) \
-                        .limit(max_limit)
-                res = query.all()
-                if len(res) == max_limit:
-                    result['results_limited'] = True
-                changed_package_ids.update([obj_rev.package_id \
-                                            for obj_rev in res])
-
-        if not result['results_limited']:
-            query = model.Session.query(model.ResourceRevision) \
-                    .join(model.Revision) \
-                    .filter(model.Revision.timestamp >= since_timestamp) \
-                    .join(model.ResourceGroup,
-                          model.ResourceRevision.resource_group_id == model.ResourceGroup.id) \
-                    .limit(max_limit)
-            res = query.all()
-            if len(res) == max_limit:
-                result['results_limited'] = True
-            changed_package_ids.update([obj_rev.resource_group.package_id \
-                                        for obj_rev in res])
-
-        if not result['results_limited']:
-            query = model.Session.query(model.MemberRevision) \
-                    .filter_by(table_name='package') \
-                    .join(model.Revision) \
-                    .filter(model.Revision.timestamp >= since_timestamp) \
-                    .limit(max_limit)
-            res = query.all()
-            if len(res) == max_limit:
-                result['results_limited'] = True
-            changed_package_ids.update([obj_rev.table_id for obj_rev in res])
-
-        # due to corrupt old obj revision tables, some package_ids may be blank
-        changed_package_ids.discard(None)
-
-        result['datasets'] = [self._mini_pkg_dict(pkg_id) for pkg_id in changed_package_ids]
+            ('results_limited', len(revs) == max_limit),
+            ('next', next_cursor)))
+
+        # See which packages changed in those revisions
+        if revs:
+            changed_package_ids = incremental_dump.changed_package_ids(
+                revision_ids=[rev.id for rev in revs])
+        else:
+            changed_package_ids = set()
+
+        result['datasets'] = self._mini_pkg_dicts(changed_package_ids)
         return self._finish_ok(result)
 
-    def _mini_pkg_dict(self, pkg_id):
-        '''For a package id, return the basic details for the package in a
-        dictionary.
-        Quite expensive - does two database lookups - so be careful with running it
-        lots of times.
-        '''
-        pkg = model.Session.query(model.Package).get(pkg_id)
-        pub = pkg.get_organization()
-        return OrderedDict((('id', pkg_id),
-                            ('name', pkg.name),
-                            ('title', pkg.title),
-                            ('notes', markdown_extract(pkg.notes)),
-                            ('dataset_link', '/dataset/%s' % pkg.name),
-                            ('publisher_title', pub.title if pub else None),
-                            ('publisher_link', '/publisher/%s' % pub.name if pub else None),
-                            # Metadata modified is a big query, so leave out unless required
-                            # ('metadata_modified', pkg.metadata_modified.isoformat()),
-                            ))
+    @staticmethod
+    def _revision_cursor(rev, timestamp=None):
+        '''Returns the cursor for the revisions after the given one (or from
+        the timestamp, if no revision).'''
+        if rev:
+            value = '%s|%s' % (rev.timestamp.strftime(REVISION_CURSOR_FORMAT),
+                               rev.id)
+        else:
+            value = timestamp.strftime(REVISION_CURSOR_FORMAT)
+        return base64.urlsafe_b64encode(value)
 
-    def dataset_count(self):
-        from ckan.lib.search import SearchError
+    @staticmethod
+    def _parse_revision_cursor(cursor):
+        '''Returns (timestamp, revision id) of a cursor. Raises ValueError
+        if it is invalid.'''
         try:
-            # package search
-            context = {'model': model, 'session': model.Session,
-                       'user': 'visitor'}
-            fq = 'capacity:"public" unpublished:false'
-            data_dict = {
-                'q':'',
-                'fq':fq,
-                'facet':'false',
-                'rows':0,
-                'start':0,
-            }
-            query = get_action('package_search')(context,data_dict)
-            count = query['count']
-        except SearchError, se:
-            log.error('Search error: %s', se)
-            count = 0
+            value = base64.urlsafe_b64decode(str(cursor))
+            timestamp, _, rev_id = value.partition('|')
+            timestamp = datetime.datetime.strptime(timestamp,
+                                                   REVISION_CURSOR_FORMAT)
+        except (TypeError, UnicodeEncodeError):
+            # bad base64 or null bytes
+            raise ValueError('Bad cursor')
+        return timestamp, rev_id or None
+
+    def _mini_pkg_dicts(self, pkg_ids):
+        '''For some package ids, return the basic details for the packages
+        in dictionaries, sorted by name. Uses a single query.'''
+        if not pkg_ids:
+            return []
+        rows = model.Session.execute(
+            '''SELECT P.id, P.name, P.title, P.notes,
+                      G.name as pub_name, G.title as pub_title
+               FROM package as P
+               LEFT OUTER JOIN "group" as G ON G.id = P.owner_org
+               WHERE P.id = ANY(:ids)
+               ORDER BY P.name''',
+            {'ids': list(pkg_ids)})
+        return [OrderedDict((('id', row.id),
+                             ('name', row.name),
+                             ('title', row.title),
+                             ('notes', markdown_extract(row.notes)),
+                             ('dataset_link', '/dataset/%s' % row.name),
+                             ('publisher_title', row.pub_title),
+                             ('publisher_link', '/publisher/%s' % row.pub_name if row.pub_name else None),
+                             # Metadata modified is a big query, so leave out unless required
+                             # ('metadata_modified', pkg.metadata_modified.isoformat()),
+                             ))
+                for row in rows]
+
+    def dataset_count(self):
+        '''The number of published datasets (cached)'''
+        return self._finish_counter(get_dataset_counts()['published'])
+
+    def dataset_counts(self):
+        '''The total, published and unpublished numbers of datasets, and the
+        number in each collection (cached)'''
+        return self._finish_counter(get_dataset_counts())
 
-        return self._finish_ok(count)
+    def _finish_counter(self, value):
+        # The cached counts are refreshed when the index changes, so clients
+        # can cache them for a short while too
+        response.headers['Cache-Control'] = 'public, max-age=%i' % \
+            int(config.get('dgu.dataset_counts.max_age', 60))
+        return self._finish_ok(value)
 
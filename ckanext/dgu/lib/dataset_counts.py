@@ -0,0 +1,101 @@
+'''Counts of datasets, for the counters shown on every Drupal page.
+
+The counts all come from a single search query, and are cached in the beaker
+'short_term' cache region, which is shared between processes (when it is
+file or memcached based). Rather than recounting for every request, the
+cache is invalidated whenever the search index commits a change (see
+install), however the indexing was started - by an edit, a harvest or a
+paster command. A deferred-commit rebuild invalidates it once, at the end.
+'''
+import logging
+
+from beaker.cache import cache_region, region_invalidate
+
+from ckan import model
+from ckanext.dgu.plugins_toolkit import get_action
+
+log = logging.getLogger(__name__)
+
+
+def get_dataset_counts():
+    '''Returns the dataset counts (cached). e.g.
+    {'total': 20000, 'published': 19000, 'unpublished': 1000,
+     'collections': {'National Information Infrastructure': 300, ...}}
+    '''
+    from ckan.lib.search import SearchError
+    try:
+        return _cached_dataset_counts()
+    except SearchError, se:
+        # not cached, so that it is retried next time
+        log.error('Search error: %s', se)
+        return {'total': 0, 'published': 0, 'unpublished': 0,
+                'collections': {}}
+
+
+@cache_region('short_term', 'dataset_counts')
+def _cached_dataset_counts():
+    return count_datasets()
+
+
+def invalidate_dataset_counts():
+    region_invalidate(_cached_dataset_counts, 'short_term', 'dataset_counts')
+
+
+def install():
+    '''[Monkey patch] Wrap the PackageSearchIndex methods that commit
+    changes to Solr, so that the counts are invalidated after each commit.
+    Invalidating before then (e.g. in IPackageController.after_update,
+    which runs before the index is updated) would let a request in between
+    cache the old counts again.'''
+    from ckan.lib.search.index import PackageSearchIndex
+    if getattr(PackageSearchIndex.commit, 'invalidates_dataset_counts',
+               False):
+        return
+    index_package = PackageSearchIndex.index_package
+    delete_package = PackageSearchIndex.delete_package
+    commit = PackageSearchIndex.commit
+
+    def index_package_and_invalidate(self, pkg_dict, defer_commit=False):
+        result = index_package(self, pkg_dict, defer_commit=defer_commit)
+        if not defer_commit:
+            invalidate_dataset_counts()
+        return result
+
+    def delete_package_and_invalidate(self, pkg_dict):
+        result = delete_package(self, pkg_dict)
+        invalidate_dataset_counts()
+        return result
+
+    def commit_and_invalidate(self):
+        result = commit(self)
+        invalidate_dataset_counts()
+        return result
+    commit_and_invalidate.invalidates_dataset_counts = True
+
+    PackageSearchIndex.index_package = index_package_and_invalidate
+    PackageSearchIndex.delete_package = delete_package_and_invalidate
+    PackageSearchIndex.commit = commit_and_invalidate
+
+
+def count_datasets():
+    '''Counts the public datasets, with a single search query.'''
+    log.debug('Counting datasets')
+    context = {'model': model, 'session': model.Session,
+               'user': 'visitor'}
+    data_dict = {
+        'q': '',
+        'fq': 'capacity:"public"',
+        'facet': 'true',
+        'facet.field': ['unpublished', 'collection'],
+        'facet.limit': -1,
+        'rows': 0,
+        'start': 0,
+    }
+    query = get_action('package_search')(context, data_dict)
+    unpublished = query['facets'].get('unpublished', {})
+    return {
+        'total': query['count'],
+        'published': unpublished.get('false', 0),
+        'unpublished': unpublished.get('true', 0),
+        'collections': query['facets'].get('collection', {}),
+        }
@@ -6,14 +6,19 @@ them.
 """
 import unicodecsv as csv
 import json
+import logging
 import tempfile
 import urlparse
+import zipfile
 
 from paste.deploy.converters import asbool
 
 from pylons import config
 import ckan.logic as logic
 import ckan.model as model
+from ckanext.dgu.lib.formats import Formats
+
+log = logging.getLogger(__name__)
 
 IGNORE_KEYS = [
     u'ratings_count',
@@ -49,6 +54,32 @@ INTERESTING_EXTRAS = [
     u'odi-certificate',
 ]
 
+# The dataset columns that come from Package.as_dict() (after flattening and
+# the IGNORE_KEYS), as opposed to from extras
+PACKAGE_KEYS = [
+    u'author',
+    u'isopen',
+    u'license_id',
+    u'maintainer',
+    u'metadata_created',
+    u'metadata_modified',
+    u'notes',
+    u'tags',
+    u'version',
+]
+
+# An extra with the same key as one of these package fields is given a
+# column of its own, named with this prefix, rather than overwriting it
+PACKAGE_FIELDS = set(PACKAGE_KEYS) | set(IGNORE_KEYS) | set([u'license'])
+EXTRA_COLUMN_PREFIX = u'extras_'
+
+
+def extra_column_key(key):
+    '''Returns the dataset column key for an extra'''
+    if key in PACKAGE_FIELDS:
+        return EXTRA_COLUMN_PREFIX + key
+    return key
+
 def make_nice_name(name):
 
     # Special cases
@@ -59,10 +90,42 @@ def make_nice_name(name):
     return name.replace('_', ' ').replace('-', ' ').title()
 
 
-class CSVDumper(object):
+def make_unique_nice_names(names, taken_names=()):
+    '''Returns the make_nice_name of each name, made unique (ignoring case)
+    with a number where needed. Different keys can have the same nice name
+    (e.g. "update_frequency" and "update-frequency") and Parquet and most CSV
+    readers need unique column names. taken_names are ones already used by
+    other columns.'''
+    used = set(name.lower() for name in taken_names)
+    nice_names = []
+    for name in names:
+        nice_name = base_name = make_nice_name(name)
+        number = 2
+        while nice_name.lower() in used:
+            nice_name = '%s %i' % (base_name, number)
+            number += 1
+        used.add(nice_name.lower())
+        nice_names.append(nice_name)
+    return nice_names
 
 
-    def __init__(self, *args, **kwargs):
+class CSVDumper(object):
+    """
+    Dumps datasets and resources to CSV files.
+
+    By default the dataset columns are the keys of the first dataset dumped.
+    With stable_columns=True the dump is done in two phases - first the
+    columns are worked out for all the datasets, using a query of the extras
+    keys, and then the rows are written. So every extra that any dataset has
+    gets a column, and the columns only change when the metadata does. An
+    extra with the same key as a package field (e.g. "version") gets a column
+    with an "extras_" prefix, so that it doesn't overwrite the field.
+    """
+
+    def __init__(self, stable_columns=False, parquet_writer=None,
+                 *args, **kwargs):
+        self.stable_columns = stable_columns
+        self.parquet_writer = parquet_writer
         self.dataset_file = tempfile.NamedTemporaryFile(delete=False)
         self.resource_file = tempfile.NamedTemporaryFile(delete=False)
 
@@ -84,6 +147,10 @@ class CSVDumper(object):
         if limit:
             packages = packages.limit(limit)
 
+        if self.stable_columns:
+            self.dataset_keys = self.discover_dataset_keys()
+            self.write_header(self.dataset_keys)
+
         first = True
         for pkg in packages.yield_per(200):
             self.write_object(pkg, first)
@@ -108,15 +175,8 @@ class CSVDumper(object):
     def write_object(self, pkg, first=False):
         pkg_dict, resources = self._flatten(pkg)
 
-        if first:
-            # TODO Get a better list of fields to dump than just what we see in
-            # the first dataset...
-            self.dataset_keys = sorted(pkg_dict.keys())
-            self.dataset_keys.remove('license')  # duplicate
-            self.write_header(self.dataset_keys)
-
-        url = config.get('ckan.site_url')
-        full_url = urlparse.urljoin(url, '/dataset/%s' % pkg.name)
+        if first and not self.stable_columns:
+            self.set_dataset_keys(pkg_dict)
 
         if pkg.owner_org in self.organization_cache:
             organization, top_level_publisher = self.organization_cache.get(pkg.owner_org)
@@ -136,28 +196,64 @@ class CSVDumper(object):
         if license:
             license = pkg.license.title
 
-        # This really should have been published, rather than unpublished.
-        published = not asbool(pkg.extras.get('unpublished') or False)
-        nii = asbool(pkg.extras.get('core-dataset') or False)
-        location = asbool(pkg.extras.get('UKLP') or False)
-        import_source = pkg.extras.get('import_source') or \
-            'harvest' if pkg.extras.get('harvest_object_id') else ''
+        self.write_rows(pkg.name, pkg.title, organization, top_level_publisher,
+                        license, pkg.extras, pkg_dict, sum(resources, []))
+
+    def set_dataset_keys(self, pkg_dict):
+        '''Sets the dataset columns and writes the headers'''
+        # TODO Get a better list of fields to dump than just what we see in
+        # the first dataset...
+        self.dataset_keys = sorted(pkg_dict.keys())
+        self.dataset_keys.remove('license')  # duplicate
+        self.write_header(self.dataset_keys)
+
+    def discover_dataset_keys(self):
+        '''Returns the dataset columns for a stable_columns dump - the
+        package columns plus every extra key used by a public dataset.'''
+        extra_keys = [key for key, in model.Session.execute(
+            """SELECT DISTINCT PE.key FROM package_extra as PE
+               INNER JOIN package as P ON P.id = PE.package_id
+               WHERE PE.state = 'active' AND P.state = 'active'
+                 AND P.private = false""")]
+        keys = set(PACKAGE_KEYS) | set(INTERESTING_EXTRAS) | \
+            set(extra_column_key(key) for key in extra_keys)
+        # odi-certificate is dumped as its url
+        keys.discard(u'odi-certificate')
+        keys.add(u'odi-certificate-url')
+        keys -= set(IGNORE_KEYS)
+        log.info('Dataset columns: %i (%i extras keys)',
+                 len(keys), len(extra_keys))
+        return sorted(keys)
+
+    def write_rows(self, name, title, organization, top_level_publisher,
+                   license, extras, pkg_dict, resources):
+        '''Writes the row for a dataset and the rows for its resources'''
+        url = config.get('ckan.site_url')
+        full_url = urlparse.urljoin(url, '/dataset/%s' % name)
 
-        vals = [self._encode(val) for val in [pkg.name, pkg.title, full_url, organization, top_level_publisher, license, published, nii, location, import_source]]
-        vals += [self._encode(pkg_dict.get(k)) for k in self.dataset_keys]
+        # This really should have been published, rather than unpublished.
+        published = not asbool(extras.get('unpublished') or False)
+        nii = asbool(extras.get('core-dataset') or False)
+        location = asbool(extras.get('UKLP') or False)
+        import_source = extras.get('import_source') or \
+            'harvest' if extras.get('harvest_object_id') else ''
 
-        self.dataset_csv.writerow(vals)
+        vals = [name, title, full_url, organization, top_level_publisher, license, published, nii, location, import_source]
+        vals += [pkg_dict.get(k) for k in self.dataset_keys]
 
-        # Flatten the list
-        resources = sum(resources, [])
+        self.dataset_csv.writerow([self._encode(val) for val in vals])
+        if self.parquet_writer:
+            self.parquet_writer.write_dataset(vals)
 
         for resource in resources:
             # Important to include the date column for timeseries.
             date = resource.get('date', '')
 
-            row = [pkg.name, resource['url'], resource['format'], resource.get('description', ''),
+            row = [name, resource['url'], Formats.normalise(resource['format']), resource.get('description', ''),
                 resource['id'], resource['position'], date, organization, top_level_publisher]
             self.resource_csv.writerow(row)
+            if self.parquet_writer:
+                self.parquet_writer.write_resource(row)
 
     def write_header(self, dataset_keys):
         """
@@ -172,18 +268,30 @@ class CSVDumper(object):
             'Dataset Name', 'URL', 'Format', 'Description', 'Resource ID', 'Position', 'Date', 'Organization', 'Top level organization'
         ]
 
-        for k in dataset_keys:
-            dataset_header_row.append(self._encode(make_nice_name(k)))
+        for name in make_unique_nice_names(dataset_keys, dataset_header_row):
+            dataset_header_row.append(self._encode(name))
 
         self.dataset_csv.writerow(dataset_header_row)
         self.resource_csv.writerow(resource_header_row)
+        if self.parquet_writer:
+            self.parquet_writer.open(dataset_header_row, resource_header_row)
 
     def _flatten(self, pkg):
         """
         Pull and flatten the package dict, making sure to promote any interesting
         extras we find.
+
+        Returns the flattened dict and a list of lists of resource dicts.
+        """
+        return self._flatten_dict(pkg.as_dict())
+
+    def _flatten_dict(self, pkg_dict):
+        """
+        Flattens a package dict, of the form returned by Package.as_dict()
+
+        In a stable_columns dump all the extras are kept, otherwise only
+        the INTERESTING_EXTRAS.
         """
-        pkg_dict = pkg.as_dict()
         resources = []
 
         new_dict = {}
@@ -235,6 +343,8 @@ class CSVDumper(object):
                 del new_dict['odi-certificate']
             elif k in INTERESTING_EXTRAS:
                 new_dict[k] = v
+            elif self.stable_columns:
+                new_dict[extra_column_key(k)] = v
 
         return new_dict, resources
 
@@ -253,5 +363,454 @@ class CSVDumper(object):
     def close(self):
         self.dataset_file.close()
         self.resource_file.close()
+        if self.parquet_writer:
+            self.parquet_writer.close()
 
         return self.dataset_filename, self.resource_filename
+
+
+class ZipMemberWriter(object):
+    """
+    A file-like object that compresses what is written to it straight into a
+    new member of a ZipFile (opened for writing), so the data never needs to
+    be on disk uncompressed.
+
+    Only one member can be written directly at a time. Others can be written
+    at the same time with buffered=True - they are compressed into memory and
+    added to the zip when closed.
+    """
+    def __init__(self, zip_file, arcname, buffered=False):
+        import cStringIO
+        import zlib
+        import time
+        self.zip_file = zip_file
+        self.zinfo = zipfile.ZipInfo(arcname,
+                                     date_time=time.localtime(time.time())[:6])
+        self.zinfo.compress_type = zipfile.ZIP_DEFLATED
+        self.zinfo.external_attr = 0644 << 16L
+        self.zinfo.file_size = self.zinfo.compress_size = self.zinfo.CRC = 0
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                           zlib.DEFLATED, -15)
+        self.buffered = buffered
+        if buffered:
+            self.fp = cStringIO.StringIO()
+        else:
+            self._write_header()
+            self.fp = zip_file.fp
+
+    def _write_header(self):
+        # Like ZipFile.write, a header is written with blank sizes and CRC,
+        # and rewritten once they are known
+        self.zinfo.header_offset = self.zip_file.fp.tell()
+        self.zip_file._writecheck(self.zinfo)
+        self.zip_file._didModify = True
+        self.zip_file.fp.write(self.zinfo.FileHeader(False))
+
+    def write(self, data):
+        import zlib
+        self.zinfo.file_size += len(data)
+        self.zinfo.CRC = zlib.crc32(data, self.zinfo.CRC) & 0xffffffff
+        compressed = self.compressor.compress(data)
+        self.zinfo.compress_size += len(compressed)
+        self.fp.write(compressed)
+
+    def close(self):
+        compressed = self.compressor.flush()
+        self.zinfo.compress_size += len(compressed)
+        self.fp.write(compressed)
+        if max(self.zinfo.file_size,
+               self.zinfo.compress_size) > zipfile.ZIP64_LIMIT:
+            raise RuntimeError('Zip member is too large: %s' %
+                               self.zinfo.filename)
+        fp = self.zip_file.fp
+        if self.buffered:
+            self._write_header()
+            fp.write(self.fp.getvalue())
+            self.fp.close()
+        position = fp.tell()
+        fp.seek(self.zinfo.header_offset, 0)
+        fp.write(self.zinfo.FileHeader(False))
+        fp.seek(position, 0)
+        self.zip_file.filelist.append(self.zinfo)
+        self.zip_file.NameToInfo[self.zinfo.filename] = self.zinfo
+
+
+class BulkCSVDumper(CSVDumper):
+    """
+    Produces the same datasets.csv and resources.csv as CSVDumper, but much
+    faster, writing them straight into a zip file.
+
+    Rather than loading each Package and its extras, resources etc. lazily,
+    it reads pages of datasets (keyset-paginated by name) with a few large
+    queries, joined up in Python. Organizations come from the publisher
+    ancestry table (lib.publisher.get_publisher_ancestry).
+    """
+    page_size = 1000
+    log_every = 5000  # datasets
+
+    def __init__(self, zip_filepath, stable_columns=False,
+                 parquet_writer=None):
+        self.stable_columns = stable_columns
+        self.parquet_writer = parquet_writer
+        self.zip_file = zipfile.ZipFile(zip_filepath, 'w',
+                                        zipfile.ZIP_DEFLATED)
+        self.dataset_member = ZipMemberWriter(self.zip_file, 'datasets.csv')
+        # resources are written at the same time, so buffer them
+        self.resource_member = ZipMemberWriter(self.zip_file, 'resources.csv',
+                                               buffered=True)
+        self.dataset_csv = csv.writer(self.dataset_member)
+        self.resource_csv = csv.writer(self.resource_member)
+        self.keys = []
+
+    def dump(self, limit=None):
+        import time
+        from ckanext.dgu.lib.publisher import get_publisher_ancestry
+
+        self.publishers = get_publisher_ancestry()
+        self.licenses = model.Package.get_license_register()
+        if self.stable_columns:
+            self.dataset_keys = self.discover_dataset_keys()
+            self.write_header(self.dataset_keys)
+        start = time.time()
+        num_datasets = num_resources = 0
+        first = True
+        for page in self._pages(limit):
+            for pkg_dict in page:
+                self._write_dict(pkg_dict, first)
+                first = False
+                num_datasets += 1
+                num_resources += len(pkg_dict['resources'])
+                if num_datasets % self.log_every == 0:
+                    self._log_rate(num_datasets, num_resources, start)
+        self._log_rate(num_datasets, num_resources, start)
+
+    def _log_rate(self, num_datasets, num_resources, start):
+        import time
+        duration = time.time() - start
+        log.info('CSV dump: %i datasets & %i resources in %.0fs '
+                 '(%.0f rows/sec)', num_datasets, num_resources, duration,
+                 (num_datasets + num_resources) / duration if duration else 0)
+
+    def _pages(self, limit=None):
+        '''Yields lists of package dicts (of the form of Package.as_dict(),
+        as far as is needed for the dump), page by page.'''
+        last_name = ''
+        num_dumped = 0
+        while True:
+            page_size = self.page_size
+            if limit:
+                page_size = min(page_size, limit - num_dumped)
+                if page_size <= 0:
+                    return
+            packages = model.Session.execute(
+                """SELECT id, name, title, version, author, maintainer, notes,
+                          license_id, owner_org, metadata_created,
+                          metadata_modified
+                   FROM package
+                   WHERE state = 'active' AND private = false AND name > :last_name
+                   ORDER BY name LIMIT :page_size""",
+                {'last_name': last_name, 'page_size': page_size}).fetchall()
+            if not packages:
+                return
+            yield self._package_dicts(packages)
+            last_name = packages[-1]['name']
+            num_dumped += len(packages)
+
+    def _package_dicts(self, packages):
+        import collections
+        ids = [p['id'] for p in packages]
+        params = {'ids': ids}
+
+        extras = collections.defaultdict(dict)
+        for package_id, key, value in model.Session.execute(
+                """SELECT package_id, key, value FROM package_extra
+                   WHERE state = 'active' AND package_id = ANY(:ids)""",
+                params):
+            extras[package_id][key] = value
+
+        tags = collections.defaultdict(list)
+        for package_id, name in model.Session.execute(
+                """SELECT PT.package_id, T.name FROM package_tag as PT
+                   INNER JOIN tag as T ON T.id = PT.tag_id
+                   WHERE PT.state = 'active' AND PT.package_id = ANY(:ids)""",
+                params):
+            tags[package_id].append(name)
+
+        resources = collections.defaultdict(list)
+        for row in model.Session.execute(
+                """SELECT RG.package_id, R.id, R.url, R.format, R.description,
+                          R.position, R.extras
+                   FROM resource as R
+                   INNER JOIN resource_group as RG ON RG.id = R.resource_group_id
+                   WHERE R.state != 'deleted' AND RG.package_id = ANY(:ids)
+                   ORDER BY RG.package_id, R.position""",
+                params):
+            resource = json.loads(row['extras'] or '{}')
+            resource.update(id=row['id'], url=row['url'],
+                            format=row['format'],
+                            description=row['description'],
+                            position=row['position'])
+            resources[row['package_id']].append(resource)
+
+        pkg_dicts = []
+        for package in packages:
+            pkg_dict = dict(package.items())
+            license = self.licenses.get(package['license_id'])
+            pkg_dict['license'] = license.title if license \
+                else package['license_id'] or ''
+            pkg_dict['isopen'] = self._isopen(license, package['license_id'],
+                                              extras[package['id']])
+            pkg_dict['tags'] = sorted(tags[package['id']])
+            pkg_dict['extras'] = extras[package['id']]
+            pkg_dict['resources'] = resources[package['id']]
+            for key in ('metadata_created', 'metadata_modified'):
+                if pkg_dict[key]:
+                    pkg_dict[key] = pkg_dict[key].isoformat()
+            pkg_dicts.append(pkg_dict)
+        return pkg_dicts
+
+    def _isopen(self, license, license_id, extras):
+        '''Same as the (DGU monkey-patched) Package.isopen'''
+        from ckanext.dgu.lib.helpers import _is_licence_text_open
+        if license:
+            return license.isopen()
+        return _is_licence_text_open(license_id, extras.get('licence'))
+
+    def _write_dict(self, pkg_dict, first=False):
+        flat_dict, resources = self._flatten_dict(pkg_dict)
+
+        if first and not self.stable_columns:
+            self.set_dataset_keys(flat_dict)
+
+        publisher = self.publishers.get(pkg_dict['owner_org'])
+        if publisher:
+            organization = publisher['title']
+            top_level_publisher = \
+                self.publishers[publisher['ancestors'][-1]]['title']
+        else:
+            log.error('Dataset %s has no organization', pkg_dict['name'])
+            organization = top_level_publisher = ''
+
+        license = self.licenses.get(pkg_dict['license_id'])
+        self.write_rows(pkg_dict['name'], pkg_dict['title'], organization,
+                        top_level_publisher, license.title if license else '',
+                        pkg_dict['extras'], flat_dict, sum(resources, []))
+
+    def close(self):
+        self.dataset_member.close()
+        self.resource_member.close()
+        self.zip_file.close()
+        if self.parquet_writer:
+            self.parquet_writer.close()
+
+
+class ParquetDumpWriter(object):
+    """
+    Writes the rows of a CSV dump to Parquet files as well - a columnar
+    format that analysts can load (e.g. with pandas) much faster than
+    parsing the CSV. The columns are the same as the CSV ones.
+
+    Needs pyarrow, which is an optional dependency - check with
+    ParquetDumpWriter.available() first.
+    """
+    batch_size = 10000  # rows
+    bool_columns = ('Published', 'NII', 'Location', 'Isopen')
+    int_columns = ('Position',)
+
+    def __init__(self, dataset_filepath, resource_filepath):
+        self.filepaths = (dataset_filepath, resource_filepath)
+        self.tables = None
+
+    @staticmethod
+    def available():
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            return False
+        return True
+
+    def open(self, dataset_header, resource_header):
+        self.tables = [ParquetTableWriter(filepath, header, self)
+                       for filepath, header in zip(self.filepaths,
+                                                   (dataset_header,
+                                                    resource_header))]
+
+    def write_dataset(self, row):
+        self.tables[0].write(row)
+
+    def write_resource(self, row):
+        self.tables[1].write(row)
+
+    def close(self):
+        for table in self.tables or []:
+            table.close()
+
+
+class ParquetTableWriter(object):
+    '''Writes rows to one Parquet file, a batch at a time'''
+    def __init__(self, filepath, header, options):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.names = [name.decode('utf8') if isinstance(name, str) else name
+                      for name in header]
+        self.types = []
+        for name in self.names:
+            if name in options.bool_columns:
+                self.types.append(pa.bool_())
+            elif name in options.int_columns:
+                self.types.append(pa.int64())
+            else:
+                self.types.append(pa.string())
+        self.schema = pa.schema([pa.field(name, type_)
+                                 for name, type_ in zip(self.names,
+                                                        self.types)])
+        self.writer = pq.ParquetWriter(filepath, self.schema)
+        self.batch_size = options.batch_size
+        self.columns = [[] for name in self.names]
+
+    def write(self, row):
+        for column, type_, value in zip(self.columns, self.types, row):
+            column.append(self._convert(value, type_))
+        if len(self.columns[0]) >= self.batch_size:
+            self.flush()
+
+    def _convert(self, value, type_):
+        import pyarrow as pa
+        if value is None or value == '':
+            return None
+        if type_ == pa.bool_():
+            return asbool(value)
+        if type_ == pa.int64():
+            return int(value)
+        if isinstance(value, str):
+            return value.decode('utf8')
+        if not isinstance(value, unicode):
+            return unicode(value)
+        return value
+
+    def flush(self):
+        import pyarrow as pa
+        if not self.columns[0]:
+            return
+        arrays = [pa.array(column, type=type_)
+                  for column, type_ in zip(self.columns, self.types)]
+        self.writer.write_table(pa.Table.from_arrays(arrays,
+                                                     names=self.names))
+        self.columns = [[] for name in self.names]
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class ZipFileWriter(object):
+    '''A file-like object that writes a zip file containing a single file'''
+    def __init__(self, filepath, arcname):
+        self.zip_file = zipfile.ZipFile(filepath, 'w', zipfile.ZIP_DEFLATED)
+        self.member = ZipMemberWriter(self.zip_file, arcname)
+        self.write = self.member.write
+
+    def close(self):
+        self.member.close()
+        self.zip_file.close()
+
+
+class GzipFileWriter(object):
+    '''A file-like object that writes a gzip file. The arcname is the
+    filename recorded in the gzip header, which need not match the path.'''
+    def __init__(self, filepath, arcname):
+        import gzip
+        self.fileobj = open(filepath, 'wb')
+        self.gzip_file = gzip.GzipFile(arcname, 'wb', fileobj=self.fileobj)
+        self.write = self.gzip_file.write
+
+    def close(self):
+        self.gzip_file.close()
+        self.fileobj.close()
+
+
+class ThreadedTeeWriter(object):
+    """
+    A file-like object that passes what is written to it on to several
+    other writers (e.g. ZipFileWriter and GzipFileWriter), each in its own
+    thread. zlib releases the GIL, so the compression for each output happens
+    concurrently.
+
+    The data is passed on in chunks of chunk_size, and the time each output
+    spends writing is recorded in timings (seconds, by output name).
+    """
+    chunk_size = 1024 * 1024
+    queue_size = 16  # chunks
+
+    def __init__(self, outputs):
+        '''outputs is a list of (name, writer) pairs'''
+        import Queue
+        import threading
+        self.buffer = []
+        self.buffered_size = 0
+        self.size = 0
+        self.timings = {}
+        self.errors = {}
+        self.threads = []
+        self.queues = []
+        for name, writer in outputs:
+            queue = Queue.Queue(self.queue_size)
+            thread = threading.Thread(target=self._output_worker,
+                                      args=(name, writer, queue),
+                                      name='tee-%s' % name)
+            thread.daemon = True
+            thread.start()
+            self.queues.append(queue)
+            self.threads.append(thread)
+
+    def _output_worker(self, name, writer, queue):
+        import time
+        duration = 0
+        while True:
+            chunk = queue.get()
+            start = time.time()
+            try:
+                if chunk is None:
+                    # even after an error, so the file handle is released
+                    writer.close()
+                elif name in self.errors:
+                    # keep consuming, so that the writing isn't blocked
+                    pass
+                else:
+                    writer.write(chunk)
+            except Exception, e:
+                log.exception('Error writing %s output', name)
+                self.errors.setdefault(name, e)
+            duration += time.time() - start
+            if chunk is None:
+                break
+        self.timings[name] = duration
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.buffer.append(data)
+        self.buffered_size += len(data)
+        self.size += len(data)
+        if self.buffered_size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        chunk = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered_size = 0
+        for queue in self.queues:
+            queue.put(chunk)
+
+    def close(self):
+        '''Finishes writing all the outputs. Raises an exception if any of
+        them failed.'''
+        self.flush()
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise Exception('Error writing output(s): %r' % self.errors)
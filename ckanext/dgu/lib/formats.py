@@ -119,6 +119,50 @@ class Formats(object):
         if reduced_raw in cls.by_reduced_name():
             return cls.by_reduced_name()[reduced_raw]
 
+    # Bounded cache of normalise() results {raw_format: canonical_format}.
+    # There are few distinct raw formats in practice, so this rarely fills,
+    # and when it does it is simply emptied. It is a plain dict, whose single
+    # reads and writes are safe from the request threads without a lock.
+    _normalised = {}
+    normalised_cache_size = 10000
+
+    _disallowed_characters = re.compile(r'[^a-zA-Z /+]')
+
+    @classmethod
+    def normalise(cls, raw_resource_format):
+        '''Given a resource format as entered by a user (e.g. " .Csv"),
+        returns the canonical name for it (e.g. "CSV"). This is what is indexed
+        and used in dumps and reports.
+
+        The canonical names are those of CKAN\'s resource_formats, or failing
+        that, of the formats listed here. If neither recognises it, the raw
+        format is returned without odd characters. Non-strings (e.g. None) are
+        returned as they are.
+        '''
+        if not isinstance(raw_resource_format, basestring):
+            return raw_resource_format
+        cache = cls._normalised
+        canonical = cache.get(raw_resource_format)
+        if canonical is None:
+            canonical = cls._normalise(raw_resource_format)
+            if len(cache) >= cls.normalised_cache_size:
+                cache.clear()
+            cache[raw_resource_format] = canonical
+        return canonical
+
+    @classmethod
+    def _normalise(cls, raw_resource_format):
+        from ckan.lib import helpers
+        matched_format = helpers.resource_formats().get(
+            raw_resource_format.lower().strip(' .'))
+        if matched_format:
+            return matched_format[1]
+        format_dict = cls.match(raw_resource_format)
+        if format_dict:
+            return format_dict['display_name']
+        return re.sub(cls._disallowed_characters, '',
+                      raw_resource_format).strip()
+
     @classmethod
     def get_data(cls):
         '''Returns the list of data formats, each one as a dict
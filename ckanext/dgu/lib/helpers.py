@@ -1069,12 +1069,18 @@ def isopen(pkg):
         # _isopen is the original one (before this method was monkey-patched in
         # its place)
         return pkg._isopen()
-    elif pkg.license_id:
+    return _is_licence_text_open(pkg.license_id, pkg.extras.get('licence'))
+
+
+def _is_licence_text_open(license_id, licence_extra):
+    '''The part of isopen for datasets whose license_id is not one of the
+    CKAN licenses.'''
+    if license_id:
         # However if the user selects 'free text' in the form, that is stored
         # in the same pkg.license field.
-        license_text = pkg.license_id
+        license_text = license_id
     else:
-        license_text = pkg.extras.get('licence') or ''
+        license_text = licence_extra or ''
     open_licenses = [
         'Open Government Licen',
         'http://www.nationalarchives.gov.uk/doc/open-government-licence/',
@@ -1622,81 +1628,36 @@ def publisher_performance_data(publisher, include_sub_publishers):
 
         broken_links - green = 0%, amber <= 60% broken links, red > 60% broken
         openness - green if all > 4 *, amber for 50%> 3*, red otherwise
+
+        The data is slow to calculate, so it is only ever read from the cache,
+        which is filled by a background task (see
+        lib.publisher.refresh_performance_data). If the cached data is older
+        than dgu.publisher_performance.ttl seconds (default 6 hours), or
+        missing, a refresh is requested and the stale data (or None) is
+        returned meanwhile. A refresh is requested at most once every
+        dgu.publisher_performance.refresh_interval seconds (default 30
+        minutes) for each publisher.
     """
     try:
         import ckanext.qa
     except ImportError:
         return None
-    import time
-    from ckanext.qa.reports import broken_resource_links_for_organisation
     from ckanext.dgu.lib import publisher as publib
 
-    start_time = time.time()
-
-    rcount = publib.resource_count(publisher, include_sub_publishers)
-    log.debug("{p} has {r} resources".format(p=publisher.name, r=rcount))
-
-    # Issues data
-    issues = "green"
-
-    if 'issues' in config['ckan.plugins']:
-        # If issues are installed then we can use the info to determine
-        # whether the issues are older than a month, between a fortnight
-        # and a month, or less than a fortnight.
-        from ckanext.issues.lib import util
-
-        more_than_month = util.old_unresolved(publisher, days=30)
-        more_than_fortnight = util.old_unresolved(publisher, days=14)
-
-        if more_than_month:
-            issues = 'red'
-        elif more_than_fortnight:
-            issues = 'amber'
-        else:
-            issues = 'green'
-
-    spending = 'green'
-    if publisher_has_spend_data(publisher):
-        spending = 'red'
-
-    # TODO: Add a count to result of broken_resource_links_for_organisation or write a version
-    # that returns count().
-    data = broken_resource_links_for_organisation(publisher.name, include_sub_publishers, use_cache=True)
-    broken_count = len(data['data'])
-
-    if broken_count == 0 or rcount == 0:
-        pct = 0
-    else:
-        pct = int(100 * float(broken_count)/float(rcount))
-    log.debug("{d}% of resources in {p} are broken".format(d=pct, p=publisher.name))
-
-    broken_links = 'green'
-    if 1 < pct <= 60:
-        broken_links = 'amber'
-    elif pct > 60:
-        broken_links = 'red'
-
-    openness = ''
-    total, counters = publib.openness_scores(publisher, include_sub_publishers)
-    number_x_or_above = lambda x: sum(counters.get(str(c),0) for c in xrange(x, 6))
-
-    above_3 = number_x_or_above(3)
-    pct_above_3 = int(100 * float(total)/float(above_3)) if above_3 else 0
-
-    if number_x_or_above(4) == total:
-        openness = 'green'
-    elif pct_above_3 >= 50:
-        openness = 'amber'
-    else:
-        openness = 'red'
-
-    log.debug("publisher performance data took {d} seconds".format(d=time.time()-start_time))
-    return {
-        'broken_links': broken_links,
-        'openness': openness,
-        'issues': issues,
-        'spending': spending
-    }
+    data, created = publib.cached_performance_data(publisher,
+                                                   include_sub_publishers)
+    ttl = datetime.timedelta(
+        seconds=int(config.get('dgu.publisher_performance.ttl', 6 * 60 * 60)))
+    if data is None or datetime.datetime.now() - created > ttl:
+        refresh_interval = datetime.timedelta(seconds=int(config.get(
+            'dgu.publisher_performance.refresh_interval', 30 * 60)))
+        try:
+            publib.request_performance_refresh(publisher, refresh_interval)
+        except Exception, e:
+            # e.g. celery's broker is down - don't stop the page rendering
+            log.error('Could not request refresh of performance data for '
+                      '%s: %r', publisher.name, e)
+    return data
 
 def publisher_has_spend_data(publisher):
     return publisher.extras.get('category','') == 'ministerial-department'
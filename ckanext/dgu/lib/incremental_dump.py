@@ -0,0 +1,194 @@
+'''Incremental JSON Lines dumps of the datasets.
+
+Rather than dumping every dataset each night, a base file (one
+Package.as_dict() per line) is kept between runs. Each run finds the datasets
+that have changed since the last one, from the revision tables (like
+DguApiController.revisions), and patches the base file with them. So the
+database work is proportional to the number of datasets changed.
+
+Each run writes:
+  * a full snapshot - the same as the new base file
+  * a delta - a line for each dataset changed or deleted since the last run:
+        {"id": ..., "action": "changed", "dataset": {...}}
+        {"id": ..., "action": "deleted"}
+'''
+import datetime
+import json
+import logging
+import os
+
+from ckan import model
+
+log = logging.getLogger(__name__)
+
+# Ids of the datasets with a revision of themselves, their tags, extras,
+# resources or group memberships in the revisions matching the condition
+# (on revision R).
+CHANGED_PACKAGE_IDS_SQL = '''
+SELECT PR.id FROM package_revision as PR
+  INNER JOIN revision as R ON R.id = PR.revision_id
+  WHERE %(condition)s
+UNION
+SELECT PTR.package_id FROM package_tag_revision as PTR
+  INNER JOIN revision as R ON R.id = PTR.revision_id
+  WHERE %(condition)s
+UNION
+SELECT PER.package_id FROM package_extra_revision as PER
+  INNER JOIN revision as R ON R.id = PER.revision_id
+  WHERE %(condition)s
+UNION
+SELECT RG.package_id FROM resource_revision as RR
+  INNER JOIN resource_group as RG ON RG.id = RR.resource_group_id
+  INNER JOIN revision as R ON R.id = RR.revision_id
+  WHERE %(condition)s
+UNION
+SELECT MR.table_id FROM member_revision as MR
+  INNER JOIN revision as R ON R.id = MR.revision_id
+  WHERE MR.table_name = 'package' AND %(condition)s
+'''
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def changed_package_ids(since=None, revision_ids=None):
+    '''Returns the set of ids of datasets changed since the given datetime
+    (UTC), or in the given revisions.'''
+    if revision_ids is not None:
+        condition = 'R.id = ANY(:revision_ids)'
+    else:
+        condition = 'R.timestamp >= :since'
+    ids = set(id_ for id_, in model.Session.execute(
+        CHANGED_PACKAGE_IDS_SQL % {'condition': condition},
+        {'since': since, 'revision_ids': revision_ids}))
+    # due to corrupt old obj revision tables, some package_ids may be blank
+    ids.discard(None)
+    return ids
+
+
+def datasets_query():
+    '''The datasets that are dumped'''
+    return model.Session.query(model.Package) \
+        .filter(model.Package.state == 'active') \
+        .filter(model.Package.private == False)
+
+
+class IncrementalDumper(object):
+    '''
+    Keeps the base file up to date and writes the snapshot and delta.
+
+    The base file is at base_filepath and the time of the run that wrote it
+    is stored next to it, in base_filepath + '.state'. If there is no base
+    file yet, all the datasets are dumped (and all appear in the delta).
+
+    dump() leaves the new base pending, so that it only replaces the old one
+    when commit() is called, once the snapshot and delta have been
+    published. Otherwise call abort(), and the next run will produce a delta
+    from the same base.
+    '''
+    def __init__(self, base_filepath):
+        self.base_filepath = base_filepath
+        self.state_filepath = base_filepath + '.state'
+        self.new_base_filepath = base_filepath + '.partial'
+        self._pending_timestamp = None
+
+    def last_dump_time(self):
+        if not (os.path.exists(self.base_filepath) and
+                os.path.exists(self.state_filepath)):
+            return None
+        with open(self.state_filepath) as f:
+            state = json.load(f)
+        return datetime.datetime.strptime(state['timestamp'],
+                                          TIMESTAMP_FORMAT)
+
+    def dump(self, snapshot_file, delta_file):
+        '''Patches the base file with the datasets changed since the last
+        run, writing it to snapshot_file too, and writes the changes to
+        delta_file. These are file-like objects and are not closed.
+
+        Returns a dict of counts of datasets: unchanged, changed and
+        deleted.'''
+        # Take the time before querying, so that changes made during the
+        # dump are picked up (again) next time
+        now = datetime.datetime.utcnow()
+        since = self.last_dump_time()
+        stats = {'unchanged': 0, 'changed': 0, 'deleted': 0}
+        new_base_filepath = self.new_base_filepath
+        new_base = open(new_base_filepath, 'wb')
+        try:
+            if since is None:
+                log.info('No base dump - dumping all datasets')
+                fresh_datasets = datasets_query().yield_per(200)
+                changed_ids = None
+            else:
+                changed_ids = changed_package_ids(since)
+                log.info('Datasets changed since %s: %i',
+                         since, len(changed_ids))
+                fresh_datasets = self._fresh_datasets(changed_ids)
+
+            # Copy over the unchanged datasets from the base
+            base_ids = set()
+            if changed_ids is not None:
+                with open(self.base_filepath, 'rb') as base:
+                    for line in base:
+                        id_ = json.loads(line)['id']
+                        if id_ in changed_ids:
+                            base_ids.add(id_)
+                            continue
+                        new_base.write(line)
+                        snapshot_file.write(line)
+                        stats['unchanged'] += 1
+
+            # Add the changed ones
+            fresh_ids = set()
+            for pkg in fresh_datasets:
+                pkg_dict = pkg.as_dict()
+                fresh_ids.add(pkg.id)
+                line = json.dumps(pkg_dict) + '\n'
+                new_base.write(line)
+                snapshot_file.write(line)
+                delta_file.write(json.dumps(
+                    {'id': pkg.id, 'action': 'changed',
+                     'dataset': pkg_dict}) + '\n')
+                stats['changed'] += 1
+
+            # Datasets in the base that are now deleted (or private)
+            for id_ in sorted(base_ids - fresh_ids):
+                delta_file.write(json.dumps(
+                    {'id': id_, 'action': 'deleted'}) + '\n')
+                stats['deleted'] += 1
+        except:
+            new_base.close()
+            os.remove(new_base_filepath)
+            raise
+        new_base.close()
+        self._pending_timestamp = now
+
+        log.info('Incremental dump: %(unchanged)i datasets unchanged, '
+                 '%(changed)i changed, %(deleted)i deleted', stats)
+        return stats
+
+    def commit(self):
+        '''Replaces the base file with the one written by dump(), and
+        records the time of that run.'''
+        assert self._pending_timestamp, 'dump() has not been run'
+        os.rename(self.new_base_filepath, self.base_filepath)
+        new_state_filepath = self.state_filepath + '.partial'
+        with open(new_state_filepath, 'wb') as f:
+            json.dump({'timestamp':
+                       self._pending_timestamp.strftime(TIMESTAMP_FORMAT)}, f)
+        os.rename(new_state_filepath, self.state_filepath)
+        self._pending_timestamp = None
+
+    def abort(self):
+        '''Discards the base file written by dump(), leaving the old one.'''
+        if os.path.exists(self.new_base_filepath):
+            os.remove(self.new_base_filepath)
+        self._pending_timestamp = None
+
+    def _fresh_datasets(self, ids):
+        ids = list(ids)
+        # in chunks, to keep the IN clause a sensible size
+        for i in xrange(0, len(ids), 500):
+            for pkg in datasets_query() \
+                    .filter(model.Package.id.in_(ids[i:i + 500])):
+                yield pkg
@@ -28,6 +28,105 @@ def go_down_tree(publisher):
         for grandchild in go_down_tree(child):
             yield grandchild
 
+# Process-wide table of publisher details needed when indexing datasets, so
+# that before_index does not need to walk the hierarchy with a query per
+# ancestor. It is loaded on first use and cleared (by PublisherPlugin) when
+# publishers or their memberships change in this process. Changes made by
+# other processes are picked up by checking the latest revision of the
+# publishers and their memberships (see get_publisher_ancestry).
+#   {id_or_name: {'id':, 'name':, 'title':, 'abbreviation':, 'ancestors': []}}
+_publisher_ancestry = None
+_publisher_ancestry_version = None
+_publisher_ancestry_checked = 0
+
+# Changes to publishers, their extras or their place in the hierarchy all
+# make a new revision of one of these
+PUBLISHER_ANCESTRY_VERSION_SQL = '''
+SELECT (SELECT max(revision_timestamp) FROM group_revision),
+       (SELECT max(revision_timestamp) FROM group_extra_revision),
+       (SELECT max(revision_timestamp) FROM member_revision
+          WHERE table_name = 'group')
+'''
+
+def get_publisher_ancestry():
+    '''Returns a dict of all active publishers, keyed by both id and name.
+    Each value is a dict with the name, title, abbreviation and 'ancestors' -
+    the list of publisher names from this one up to the top of the tree.
+
+    The table is built with three queries and then held by the process,
+    until invalidate_publisher_ancestry() is called, or a check (at most
+    every dgu.publisher_ancestry.check_interval seconds, default 60) finds
+    that the publishers have been changed by another process.
+    '''
+    import time
+    from pylons import config
+    global _publisher_ancestry, _publisher_ancestry_version, \
+        _publisher_ancestry_checked
+    check_interval = int(config.get('dgu.publisher_ancestry.check_interval',
+                                    60))
+    now = time.time()
+    if _publisher_ancestry is not None and \
+            now - _publisher_ancestry_checked < check_interval:
+        return _publisher_ancestry
+    version = tuple(model.Session.execute(
+        PUBLISHER_ANCESTRY_VERSION_SQL).fetchone())
+    if _publisher_ancestry is None or version != _publisher_ancestry_version:
+        _publisher_ancestry = _load_publisher_ancestry()
+        _publisher_ancestry_version = version
+    _publisher_ancestry_checked = now
+    return _publisher_ancestry
+
+def invalidate_publisher_ancestry():
+    global _publisher_ancestry
+    _publisher_ancestry = None
+
+def _load_publisher_ancestry():
+    publishers = model.Session.query(model.Group.id, model.Group.name,
+                                     model.Group.title) \
+                      .filter(model.Group.type == 'organization') \
+                      .filter(model.Group.state == 'active') \
+                      .all()
+    abbreviations = dict(
+        model.Session.query(model.GroupExtra.group_id, model.GroupExtra.value)
+             .filter(model.GroupExtra.key == 'abbreviation')
+             .filter(model.GroupExtra.state == 'active')
+             .all())
+    # Member rows of a group in a group: group_id is the parent, table_id
+    # the child. Only organizations count as parents (as with
+    # get_parent_groups(type='organization')).
+    parents = {}
+    parent_members = model.Session.query(model.Member.table_id,
+                                         model.Member.group_id) \
+                          .join(model.Group,
+                                model.Group.id == model.Member.group_id) \
+                          .filter(model.Member.table_name == 'group') \
+                          .filter(model.Member.state == 'active') \
+                          .filter(model.Group.type == 'organization') \
+                          .filter(model.Group.state == 'active') \
+                          .order_by(model.Member.id)
+    for child_id, parent_id in parent_members:
+        if child_id in parents:
+            log.warning('Publisher %s has more than one parent publisher. '
+                        'Ignoring all but the first.', child_id)
+            continue
+        parents[child_id] = parent_id
+
+    by_id = dict((id_, {'id': id_, 'name': name, 'title': title,
+                        'abbreviation': abbreviations.get(id_)})
+                 for id_, name, title in publishers)
+    ancestry = {}
+    for publisher in by_id.values():
+        ancestors = []
+        id_ = publisher['id']
+        while id_ in by_id and by_id[id_]['name'] not in ancestors:
+            ancestors.append(by_id[id_]['name'])
+            id_ = parents.get(id_)
+        publisher['ancestors'] = ancestors
+        ancestry[publisher['id']] = publisher
+        ancestry[publisher['name']] = publisher
+    log.info('Loaded publisher ancestry for %i publishers', len(by_id))
+    return ancestry
+
 def find_group_admins(group):
     '''Look for publisher admins up the tree'''
     recipients = []
@@ -62,21 +161,152 @@ def cached_openness_scores(reports_to_run=None):
         filter(model.Group.state=='active')
 
     log.info("Generating openness-scores report")
-    log.info("Fetching %d publishers" % publishers.count())
+    publishers = publishers.all()
+    log.info("Fetching %d publishers" % len(publishers))
+
+    scores = all_openness_scores([publisher.id for publisher in publishers])
 
-    for publisher in publishers.all():
+    for publisher in publishers:
         # Run the openness report with and without include_sub_organisations set
         if 'openness-scores' in local_reports:
           log.info("Generating openness scores for %s" % publisher.name)
-          val = openness_scores(publisher, use_cache=False)
+          val = scores[publisher.id]['openness-scores']
           model.DataCache.set(publisher.name, "openness-scores", json.dumps(val,cls=DateTimeJsonEncoder))
 
         if 'openness-scores-withsub' in local_reports:
-          val = openness_scores(publisher, include_sub_publishers=True, use_cache=False)
+          val = scores[publisher.id]['openness-scores-withsub']
           model.DataCache.set(publisher.name, "openness-scores-withsub", json.dumps(val,cls=DateTimeJsonEncoder))
 
     model.Session.commit()
 
+def all_openness_scores(publisher_ids=None):
+    """
+    Returns the openness scores of the given publishers (default: all of
+    them), each both on its own and including its sub-publishers, in the same
+    form as openness_scores():
+
+        {publisher_id: {'openness-scores': (total, {score: count}),
+                        'openness-scores-withsub': (total, {score: count})}}
+
+    The scores of each dataset, the datasets of each publisher and the
+    publisher hierarchy are fetched with one query each, and the sub-publisher
+    variants are rolled up the tree in memory.
+    """
+    from collections import defaultdict
+
+    q = """SELECT RG.package_id, TS.value::INT, count(*) from task_status as TS
+           INNER JOIN resource as R ON R.id = TS.entity_id
+           INNER JOIN resource_group as RG ON RG.id = R.resource_group_id
+           INNER JOIN package as P ON P.id = RG.package_id
+           WHERE TS.task_type='qa' AND
+                 TS.entity_type ='resource' AND
+                 TS.key = 'openness_score' AND
+                 P.state = 'active' AND R.state='active'
+           GROUP BY RG.package_id, TS.value::INT;"""
+    package_scores = defaultdict(dict)  # {package_id: {score: count}}
+    for package_id, score, count in model.Session.execute(q):
+        package_scores[package_id][str(score)] = count
+
+    # Only datasets with scores matter
+    publisher_packages = defaultdict(set)  # {publisher_id: set(package_ids)}
+    for publisher_id, package_id in model.Session.query(
+            model.Member.group_id, model.Member.table_id) \
+            .filter(model.Member.table_name == 'package') \
+            .filter(model.Member.state == 'active'):
+        if package_id in package_scores:
+            publisher_packages[publisher_id].add(package_id)
+
+    # Only active organizations are followed, as go_down_tree does
+    children = defaultdict(list)  # {parent_id: [child_id, ...]}
+    for parent_id, child_id in model.Session.query(
+            model.Member.group_id, model.Member.table_id) \
+            .join(model.Group, model.Group.id == model.Member.table_id) \
+            .filter(model.Member.table_name == 'group') \
+            .filter(model.Member.state == 'active') \
+            .filter(model.Group.type == 'organization') \
+            .filter(model.Group.state == 'active'):
+        children[parent_id].append(child_id)
+
+    def histogram(package_ids):
+        d = defaultdict(int)
+        for package_id in package_ids:
+            for score, count in package_scores[package_id].iteritems():
+                d[score] += count
+        return sum(d.values()), d
+
+    # Sets (not counts) are rolled up, so a dataset in two publishers of the
+    # same tree is counted once, as it is by openness_scores()
+    tree_packages = {}  # {publisher_id: set(package_ids)}, memoized
+    def packages_in_tree(publisher_id, ancestors=()):
+        '''Returns the package ids of the tree, and whether a loop cut it
+        short - in which case it depends on the ancestors, so is not
+        memoized.'''
+        if publisher_id in tree_packages:
+            return tree_packages[publisher_id], False
+        package_ids = set(publisher_packages.get(publisher_id, ()))
+        looped = False
+        for child_id in children.get(publisher_id, ()):
+            if child_id in ancestors + (publisher_id,):
+                log.error('Publisher hierarchy has a loop: %s', child_id)
+                looped = True
+                continue
+            child_package_ids, child_looped = packages_in_tree(
+                child_id, ancestors + (publisher_id,))
+            package_ids |= child_package_ids
+            looped = looped or child_looped
+        if not looped:
+            tree_packages[publisher_id] = package_ids
+        return package_ids, looped
+
+    if publisher_ids is None:
+        publisher_ids = [id_ for id_, in model.Session.query(model.Group.id)
+                         .filter(model.Group.state == 'active')
+                         .filter(model.Group.is_organization == True)]
+    scores = {}
+    for publisher_id in publisher_ids:
+        scores[publisher_id] = {
+            'openness-scores':
+                histogram(publisher_packages.get(publisher_id, ())),
+            'openness-scores-withsub':
+                histogram(packages_in_tree(publisher_id)[0]),
+            }
+    return scores
+
+# Reusable SQL for counting things belonging to a publisher (or a publisher
+# tree). The publisher ids are bound as an array parameter
+# ("group_id = ANY(:publisher_ids)") rather than formatted into the SQL, so
+# that Postgres can reuse the plans.
+
+PUBLISHER_TREE_IDS_SQL = """
+    WITH RECURSIVE tree(id) AS (
+        SELECT CAST(:publisher_id AS text)
+        UNION
+        SELECT M.table_id FROM member as M
+        INNER JOIN tree ON M.group_id = tree.id
+        INNER JOIN "group" as G ON G.id = M.table_id
+        WHERE M.table_name = 'group' AND M.state = 'active' AND
+              G.type = 'organization' AND G.state = 'active'
+    )
+    SELECT id FROM tree;"""
+
+def publisher_ids(publisher, include_sub_publishers=False):
+    '''Returns the ids of the publisher, and optionally of all the
+    publishers below it in the hierarchy (in one query, unlike
+    go_down_tree).'''
+    if not include_sub_publishers:
+        return [publisher.id]
+    return [row[0] for row in model.Session.execute(
+        PUBLISHER_TREE_IDS_SQL, {'publisher_id': publisher.id})]
+
+ACTIVE_PUBLISHER_RESOURCES_SQL = """
+    FROM resource as R
+    INNER JOIN resource_group as RG ON RG.id = R.resource_group_id
+    INNER JOIN package as P ON P.id = RG.package_id
+    INNER JOIN member as M ON M.table_id = P.id
+    WHERE P.state = 'active' AND R.state = 'active' AND
+          M.table_name = 'package' AND M.state = 'active' AND
+          M.group_id = ANY(:publisher_ids)"""
+
 def openness_scores(publisher, include_sub_publishers=False, use_cache=True):
     """
         For the provided publisher, this grabs the resource ids
@@ -96,30 +326,19 @@ def openness_scores(publisher, include_sub_publishers=False, use_cache=True):
             log.info("Found openness score in cache: %s" % cache)
             return cache
 
-
-    q = """SELECT TS.value::INT from task_status  as TS
+    # DISTINCT, since a dataset may be in more than one of the publishers
+    q = """SELECT TS.value::INT, count(DISTINCT TS.id) from task_status as TS
+           INNER JOIN (SELECT R.id %s) as PR ON PR.id = TS.entity_id
            WHERE TS.task_type='qa' AND
                  TS.entity_type ='resource' AND
-                 TS.key = 'openness_score' AND
-                 TS.entity_id in (
-                   SELECT R.id from resource  as R
-                   INNER JOIN resource_group as RG ON RG.id = R.resource_group_id
-                   INNER JOIN package as P ON P.id = RG.package_id
-                   WHERE P.state = 'active' AND R.state='active' AND
-                         P.id in (SELECT table_id FROM member
-                                  WHERE group_id in ({pub_id})
-                                  AND table_name='package' AND state='active')
-                                 );"""
+                 TS.key = 'openness_score'
+           GROUP BY TS.value::INT;""" % ACTIVE_PUBLISHER_RESOURCES_SQL
 
     d = defaultdict(int)
 
-    if include_sub_publishers:
-        pubids = ["'%s'" % p.id for p in go_down_tree(publisher)]
-    else:
-        pubids = ["'%s'" % publisher.id]
-
-    for m in model.Session.execute(q.format(pub_id=','.join(pubids))):
-        d[str(m[0])] += 1
+    pubids = publisher_ids(publisher, include_sub_publishers)
+    for score, count in model.Session.execute(q, {'publisher_ids': pubids}):
+        d[str(score)] += count
     total = sum(d.values())
 
     return total, d
@@ -128,19 +347,230 @@ def resource_count(publisher, include_sub_publishers=False):
     """
         Counts the number of active resources within active datasets and
         returns the scalar.
+
+        If dgu.publisher.resource_count_view is set, the counts come from
+        the materialized view (see create_resource_count_view).
     """
-    q = """SELECT count(R.id) from resource  as R
-           INNER JOIN resource_group as RG ON RG.id = R.resource_group_id
-           INNER JOIN package as P ON P.id = RG.package_id
-           WHERE P.state = 'active' AND R.state='active' AND
-                 P.id in (SELECT table_id FROM member
-                          WHERE group_id IN ({pub_id})
-                          AND table_name='package' AND state='active');"""
+    from pylons import config
+    from paste.deploy.converters import asbool
+
+    pubids = publisher_ids(publisher, include_sub_publishers)
+    if asbool(config.get('dgu.publisher.resource_count_view', False)):
+        q = """SELECT coalesce(sum(resource_count), 0) FROM
+                 (SELECT DISTINCT package_id, resource_count
+                  FROM dgu_publisher_resource_count
+                  WHERE group_id = ANY(:publisher_ids)) as PRC;"""
+    else:
+        q = "SELECT count(DISTINCT R.id) %s;" % ACTIVE_PUBLISHER_RESOURCES_SQL
+
+    return model.Session.scalar(q, {'publisher_ids': pubids})
+
+# The counts of active resources of each dataset, for each publisher it is in.
+# Needs Postgres 9.3 or later.
+RESOURCE_COUNT_VIEW_SQL = """
+    CREATE MATERIALIZED VIEW dgu_publisher_resource_count AS
+    SELECT M.group_id, P.id as package_id, count(R.id) as resource_count
+    FROM resource as R
+    INNER JOIN resource_group as RG ON RG.id = R.resource_group_id
+    INNER JOIN package as P ON P.id = RG.package_id
+    INNER JOIN member as M ON M.table_id = P.id
+    WHERE P.state = 'active' AND R.state = 'active' AND
+          M.table_name = 'package' AND M.state = 'active'
+    GROUP BY M.group_id, P.id;
+    CREATE INDEX idx_dgu_publisher_resource_count_group_id
+        ON dgu_publisher_resource_count (group_id);"""
+
+def create_resource_count_view():
+    '''Creates the materialized view of resource counts used by
+    resource_count(), if it does not exist already.'''
+    exists = model.Session.execute(
+        "SELECT count(*) FROM pg_class WHERE relname = 'dgu_publisher_resource_count'"
+        ).scalar()
+    if not exists:
+        log.info('Creating materialized view dgu_publisher_resource_count')
+        model.Session.execute(RESOURCE_COUNT_VIEW_SQL)
+        model.Session.commit()
+
+def refresh_resource_count_view():
+    '''Brings the resource counts view up to date. Run it regularly (e.g.
+    gov_daily.py publisher-resource-counts).'''
+    create_resource_count_view()
+    model.Session.execute('REFRESH MATERIALIZED VIEW dgu_publisher_resource_count')
+    model.Session.commit()
+
+def calculate_performance_data(publisher, include_sub_publishers):
+    """
+        Calculates the traffic lights shown on the publisher read page - see
+        helpers.publisher_performance_data.
+
+        The time taken by each component is logged and returned in 'timings'.
+    """
+    import time
+    from pylons import config
+    from ckanext.qa.reports import broken_resource_links_for_organisation
+    from ckanext.dgu.lib.helpers import publisher_has_spend_data
+
+    timings = {}
+    start_time = time.time()
+    def time_component(name):
+        now = time.time()
+        timings[name] = now - time_component.last
+        time_component.last = now
+    time_component.last = start_time
+
+    rcount = resource_count(publisher, include_sub_publishers)
+    log.debug("{p} has {r} resources".format(p=publisher.name, r=rcount))
+    time_component('resource_count')
+
+    # Issues data
+    issues = "green"
+
+    if 'issues' in config['ckan.plugins']:
+        # If issues are installed then we can use the info to determine
+        # whether the issues are older than a month, between a fortnight
+        # and a month, or less than a fortnight.
+        from ckanext.issues.lib import util
+
+        more_than_month = util.old_unresolved(publisher, days=30)
+        more_than_fortnight = util.old_unresolved(publisher, days=14)
+
+        if more_than_month:
+            issues = 'red'
+        elif more_than_fortnight:
+            issues = 'amber'
+        else:
+            issues = 'green'
+    time_component('issues')
 
-    if include_sub_publishers:
-        pubids = ["'%s'" % p.id for p in go_down_tree(publisher)]
+    spending = 'green'
+    if publisher_has_spend_data(publisher):
+        spending = 'red'
+    time_component('spending')
+
+    data = broken_resource_links_for_organisation(publisher.name, include_sub_publishers, use_cache=True)
+    broken_count = len(data['data'])
+
+    if broken_count == 0 or rcount == 0:
+        pct = 0
     else:
-        pubids = ["'%s'" % publisher.id]
+        pct = int(100 * float(broken_count)/float(rcount))
+    log.debug("{d}% of resources in {p} are broken".format(d=pct, p=publisher.name))
+
+    broken_links = 'green'
+    if 1 < pct <= 60:
+        broken_links = 'amber'
+    elif pct > 60:
+        broken_links = 'red'
+    time_component('broken_links')
+
+    openness = ''
+    total, counters = openness_scores(publisher, include_sub_publishers)
+    number_x_or_above = lambda x: sum(counters.get(str(c),0) for c in xrange(x, 6))
+
+    above_3 = number_x_or_above(3)
+    pct_above_3 = int(100 * float(total)/float(above_3)) if above_3 else 0
+
+    if number_x_or_above(4) == total:
+        openness = 'green'
+    elif pct_above_3 >= 50:
+        openness = 'amber'
+    else:
+        openness = 'red'
+    time_component('openness')
+
+    log.info("publisher performance data for %s%s took %.2fs: %s",
+             publisher.name, ' (with sub-publishers)' if include_sub_publishers else '',
+             time.time() - start_time,
+             ' '.join('%s=%.2fs' % (k, v) for k, v in
+                      sorted(timings.items(), key=lambda x: -x[1])))
+    return {
+        'broken_links': broken_links,
+        'openness': openness,
+        'issues': issues,
+        'spending': spending,
+        'timings': timings,
+    }
+
+def _performance_data_key(include_sub_publishers):
+    return 'performance-data-withsub' if include_sub_publishers \
+        else 'performance-data'
 
-    return model.Session.scalar(q.format(pub_id=','.join(pubids)))
+def cached_performance_data(publisher, include_sub_publishers):
+    '''Returns the cached performance data and when it was calculated,
+    or (None, None) if there is none.'''
+    import json
+    from ckanext.report.model import DataCache
+
+    item = model.Session.query(DataCache.value, DataCache.created) \
+                .filter(DataCache.object_id == publisher.name) \
+                .filter(DataCache.key ==
+                        _performance_data_key(include_sub_publishers)) \
+                .first()
+    if not item:
+        return None, None
+    return json.loads(item[0]), item[1]
+
+PERFORMANCE_REFRESH_REQUESTED_KEY = 'performance-data-refresh-requested'
+
+def request_performance_refresh(publisher, min_interval):
+    '''Queues a task to refresh the performance data of a publisher, unless
+    one was queued less than min_interval (timedelta) ago. The time it was
+    queued is recorded in the DataCache, so that all the web processes see
+    it. Returns whether a task was queued.
+
+    This is called while rendering pages, so it uses its own connection and
+    transaction, rather than committing the request's Session. An advisory
+    lock makes the check-and-record atomic across processes, so only one of
+    them queues the task.'''
+    import datetime
+    from sqlalchemy import select, and_
+    from ckanext.report.model import DataCache
+    from ckanext.dgu import publisher_performance_tasks
 
+    table = DataCache.__table__
+    is_marker = and_(table.c.object_id == publisher.name,
+                     table.c.key == PERFORMANCE_REFRESH_REQUESTED_KEY)
+    now = datetime.datetime.now()
+    conn = model.meta.engine.connect()
+    trans = conn.begin()
+    try:
+        # held until the transaction ends. If another process has it, it is
+        # requesting the refresh right now.
+        locked = conn.execute(
+            'SELECT pg_try_advisory_xact_lock(hashtext(%s))',
+            '%s/%s' % (PERFORMANCE_REFRESH_REQUESTED_KEY,
+                       publisher.name)).scalar()
+        requested = conn.execute(
+            select([table.c.created]).where(is_marker)).scalar() \
+            if locked else None
+        if not locked or (requested and now - requested < min_interval):
+            trans.rollback()
+            return False
+        if requested:
+            conn.execute(table.update().where(is_marker).values(created=now))
+        else:
+            conn.execute(table.insert().values(
+                object_id=publisher.name,
+                key=PERFORMANCE_REFRESH_REQUESTED_KEY,
+                value=u'', created=now))
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    finally:
+        conn.close()
+    publisher_performance_tasks.create_refresh_task(publisher)
+    return True
+
+def refresh_performance_data(publisher):
+    '''Calculates and caches the performance data of a publisher, with
+    and without its sub-publishers.'''
+    import json
+    from ckanext.report.model import DataCache
+
+    for include_sub_publishers in (False, True):
+        data = calculate_performance_data(publisher, include_sub_publishers)
+        DataCache.set(publisher.name,
+                      _performance_data_key(include_sub_publishers),
+                      json.dumps(data))
+    model.Session.commit()
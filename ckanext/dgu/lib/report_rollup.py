@@ -0,0 +1,148 @@
+'''Rolls up per-organization report results through the publisher hierarchy.
+
+Reports that can include sub-organizations used to work out the datasets of
+the organization and all its descendants, and generate the report from
+scratch. Generating a report for every organization, with and without
+sub-organizations, therefore did the same work many times over.
+
+With a TreeRollup, a report is split into a 'part' for a single organization
+(not including its sub-organizations) and a way of merging parts. The result
+with sub-organizations is the merge of the parts of the organization and its
+descendants. While caching is on (see cached_parts) each part is computed
+only once, so the with-sub-organizations variants are merges of parts that
+have already been computed. When it is off, a with-sub-organizations variant
+is computed in one go over the whole tree (compute_tree), rather than a part
+at a time.
+
+The cached parts are kept per thread, as web requests may use them.
+
+The hierarchy comes from the publisher ancestry table (see
+lib.publisher.get_publisher_ancestry) rather than walking it with
+go_down_tree, which needs a query per organization.
+'''
+import collections
+import contextlib
+import logging
+import threading
+
+from ckanext.dgu.lib.publisher import get_publisher_ancestry
+
+log = logging.getLogger(__name__)
+
+# Per thread:
+# parts - {(rollup name, organization name, args): part}, or None when
+#         caching is off
+# scope - what the parts are for, when kept by cache_parts_in_scope
+_local = threading.local()
+
+# (ancestry table, {organization name: [names of it and its descendants]})
+_tree_names = (None, None)
+
+
+@contextlib.contextmanager
+def cached_parts():
+    '''Within this context, each part is only computed once. Use it around
+    generating many reports, when the data is not expected to change.
+    Nested uses are fine - the parts are kept until the outermost exits.'''
+    if _get_parts() is not None:
+        yield
+        return
+    _local.parts = parts = {}
+    try:
+        yield
+    finally:
+        log.debug('Report parts cached: %i', len(parts))
+        _local.parts = None
+
+
+def cache_parts_in_scope(scope):
+    '''Keeps parts between calls with the same scope (e.g. a report name),
+    for processes that only generate reports, such as report cache workers.
+    When the scope changes the parts are dropped, so only the parts of one
+    scope are held at a time.'''
+    parts = _get_parts()
+    previous_scope = getattr(_local, 'scope', None)
+    if parts is not None and scope == previous_scope:
+        return
+    if parts is not None:
+        log.debug('Report parts cached for %s: %i', previous_scope, len(parts))
+    _local.parts = {}
+    _local.scope = scope
+
+
+def _get_parts():
+    return getattr(_local, 'parts', None)
+
+
+def organization_tree_names(organization_name):
+    '''Returns the names of the organization and all the organizations below
+    it in the hierarchy. An organization that is not in the ancestry table
+    (e.g. deleted) is returned on its own.'''
+    global _tree_names
+    ancestry = get_publisher_ancestry()
+    if _tree_names[0] is not ancestry:
+        tree_names = collections.defaultdict(list)
+        for key, publisher in ancestry.items():
+            if key != publisher['id']:
+                # each publisher appears under its id and name - do it once
+                continue
+            for ancestor_name in publisher['ancestors']:
+                tree_names[ancestor_name].append(publisher['name'])
+        _tree_names = (ancestry, dict(tree_names))
+    return _tree_names[1].get(organization_name, [organization_name])
+
+
+def organization_tree_ids(organization_name):
+    '''Returns the ids of the organization and all the organizations below
+    it in the hierarchy, or [] if it is not in the ancestry table (e.g.
+    deleted).'''
+    ancestry = get_publisher_ancestry()
+    return [ancestry[name]['id']
+            for name in organization_tree_names(organization_name)
+            if name in ancestry]
+
+
+class TreeRollup(object):
+    '''
+    A report that is computed for each organization and rolled up the
+    hierarchy.
+
+    compute_part(organization_name, *args) returns the part of the report for
+    just that organization's datasets. args must be hashable, as they are
+    part of the cache key.
+
+    merge_parts(parts) combines a list of parts into a new part (it must not
+    modify them, as they may be cached).
+
+    compute_tree(organization_name, *args) optionally returns the merged part
+    for the organization and its sub-organizations in one go (e.g. with one
+    query over organization_tree_ids). It is used when parts are not being
+    cached, so as not to compute each part separately.
+    '''
+    def __init__(self, name, compute_part, merge_parts, compute_tree=None):
+        self.name = name
+        self.compute_part = compute_part
+        self.merge_parts = merge_parts
+        self.compute_tree = compute_tree
+
+    def get(self, organization_name, include_sub_organizations, *args):
+        '''Returns the merged part for the organization, including its
+        sub-organizations if requested.'''
+        if include_sub_organizations and self.compute_tree and \
+                _get_parts() is None:
+            return self.compute_tree(organization_name, *args)
+        if include_sub_organizations:
+            names = organization_tree_names(organization_name)
+        else:
+            names = [organization_name]
+        return self.merge_parts([self.get_part(name, *args)
+                                 for name in names])
+
+    def get_part(self, organization_name, *args):
+        parts = _get_parts()
+        if parts is None:
+            return self.compute_part(organization_name, *args)
+        key = (self.name, organization_name, args)
+        if key not in parts:
+            parts[key] = self.compute_part(organization_name, *args)
+        return parts[key]
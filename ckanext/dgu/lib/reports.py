@@ -11,6 +11,9 @@ import ckan.plugins as p
 from ckanext.report import lib
 from ckanext.dgu.lib.publisher import go_up_tree
 from ckanext.dgu.lib import helpers as dgu_helpers
+from ckanext.dgu.lib.formats import Formats
+from ckanext.dgu.lib.report_rollup import TreeRollup, cached_parts, \
+    organization_tree_ids
 
 log = logging.getLogger(__name__)
 
@@ -21,29 +24,45 @@ log = logging.getLogger(__name__)
 def nii_report():
     '''A list of the NII datasets, grouped by publisher, with details of broken
     links and source.'''
-    nii_dataset_q = model.Session.query(model.Package)\
-        .join(model.PackageExtra, model.PackageExtra.package_id == model.Package.id)\
-        .join(model.Group, model.Package.owner_org == model.Group.id)\
+    from sqlalchemy import func, orm
+    from ckanext.archiver.model import Archival
+
+    nii_package_ids = model.Session.query(model.PackageExtra.package_id)\
         .filter(model.PackageExtra.key == 'core-dataset')\
         .filter(model.PackageExtra.value == 'true')\
-        .filter(model.Package.state == 'active')
-    nii_dataset_objects = nii_dataset_q\
-            .order_by(model.Group.title, model.Package.title).all()
-
-    def broken_resources_for_package(package_id):
-        from ckanext.archiver.model import Archival
-
-        results = model.Session.query(Archival, model.Resource)\
-                       .filter(Archival.package_id == package_id)\
-                       .filter(Archival.is_broken == True)\
-                       .join(model.Package, Archival.package_id == model.Package.id)\
-                       .filter(model.Package.state == 'active')\
-                       .join(model.Resource, Archival.resource_id == model.Resource.id)\
-                       .filter(model.Resource.state == 'active')
-
-        broken_resources = [(resource.description, resource.id)
-                            for archival, resource in results.all()]
-        return broken_resources
+        .subquery()
+    # The datasets, with their organizations and extras (for the notes), in
+    # one go
+    nii_datasets = model.Session.query(model.Package, model.Group)\
+        .join(model.Group, model.Package.owner_org == model.Group.id)\
+        .filter(model.Package.id.in_(nii_package_ids))\
+        .filter(model.Package.state == 'active')\
+        .options(orm.subqueryload('_extras'))\
+        .order_by(model.Group.title, model.Package.title).all()
+
+    broken_resources_by_package = collections.defaultdict(list)
+    for package_id, description, resource_id in \
+            model.Session.query(Archival.package_id, model.Resource.description,
+                                model.Resource.id)\
+            .filter(Archival.package_id.in_(nii_package_ids))\
+            .filter(Archival.is_broken == True)\
+            .join(model.Package, Archival.package_id == model.Package.id)\
+            .filter(model.Package.state == 'active')\
+            .join(model.Resource, Archival.resource_id == model.Resource.id)\
+            .filter(model.Resource.state == 'active')\
+            .order_by(model.Resource.position):
+        broken_resources_by_package[package_id].append(
+            (description, resource_id))
+
+    # Package.resources are those not deleted
+    num_resources_by_package = dict(
+        model.Session.query(model.ResourceGroup.package_id,
+                            func.count(model.Resource.id))
+        .join(model.Resource,
+              model.Resource.resource_group_id == model.ResourceGroup.id)
+        .filter(model.ResourceGroup.package_id.in_(nii_package_ids))
+        .filter(model.Resource.state != 'deleted')
+        .group_by(model.ResourceGroup.package_id))
 
     nii_dataset_details = []
     num_resources = 0
@@ -51,9 +70,9 @@ def nii_report():
     num_broken_datasets = 0
     broken_organization_names = set()
     nii_organizations = set()
-    for dataset_object in nii_dataset_objects:
-        broken_resources = broken_resources_for_package(dataset_object.id)
-        org = dataset_object.get_organization()
+    for dataset_object, org in nii_datasets:
+        broken_resources = broken_resources_by_package.get(dataset_object.id,
+                                                           [])
         dataset_details = {
                 'name': dataset_object.name,
                 'title': dataset_object.title,
@@ -69,7 +88,7 @@ def nii_report():
             num_broken_datasets += 1
             broken_organization_names.add(org.name)
         nii_organizations.add(org)
-        num_resources += len(dataset_object.resources)
+        num_resources += num_resources_by_package.get(dataset_object.id, 0)
 
     org_tuples = [(org.name, org.title) for org in
                   sorted(nii_organizations, key=lambda o: o.title)]
@@ -77,7 +96,7 @@ def nii_report():
     return {'table': nii_dataset_details,
             'organizations': org_tuples,
             'num_resources': num_resources,
-            'num_datasets': len(nii_dataset_objects),
+            'num_datasets': len(nii_datasets),
             'num_organizations': len(nii_organizations),
             'num_broken_resources': num_broken_resources,
             'num_broken_datasets': num_broken_datasets,
@@ -108,18 +127,48 @@ def publisher_resources(organization=None,
     if not org:
         raise p.toolkit.ObjectNotFound('Publisher not found')
 
+    resources = publisher_resources_rollup.get(organization,
+                                               include_sub_organizations)
+    return {'organization_name': org.name,
+            'organization_title': org.title,
+            'num_datasets': resources['num_datasets'],
+            'num_resources': resources['num_resources'],
+            'table': resources['table'],
+            }
+
+
+def _publisher_resources_part(organization_name):
+    '''The datasets and resources of just the one organization.'''
+    org = model.Group.by_name(organization_name)
+    return _publisher_resources([org.id] if org else [])
+
+
+def _publisher_resources_tree(organization_name):
+    '''The datasets and resources of the organization and its
+    sub-organizations.'''
+    org = model.Group.by_name(organization_name)
+    return _publisher_resources(organization_tree_ids(organization_name) or
+                                [org.id])
+
+
+def _publisher_resources(org_ids):
+    '''The datasets and resources of the organizations, with one query for
+    the datasets.'''
+    orgs = dict((org.id, org) for org in model.Session.query(model.Group)
+                .filter(model.Group.id.in_(org_ids))) if org_ids else {}
+
     # Get packages
     pkgs = model.Session.query(model.Package)\
-                .filter_by(state='active')
-    pkgs = lib.filter_by_organizations(pkgs, organization,
-                                       include_sub_organizations).all()
+                .filter_by(state='active')\
+                .filter(model.Package.owner_org.in_(org_ids)).all() \
+        if org_ids else []
 
     # Get their resources
     def create_row(pkg_, resource_dict):
-        org_ = pkg_.get_organization()
+        org = orgs[pkg_.owner_org]
         return OrderedDict((
-                ('publisher_title', org_.title),
-                ('publisher_name', org_.name),
+                ('publisher_title', org.title),
+                ('publisher_name', org.name),
                 ('package_title', pkg_.title),
                 ('package_name', pkg_.name),
                 ('package_notes', lib.dataset_notes(pkg_)),
@@ -147,13 +196,23 @@ def publisher_resources(organization=None,
             # packages with no resources are still listed
             rows.append(create_row(pkg, {}))
 
-    return {'organization_name': org.name,
-            'organization_title': org.title,
-            'num_datasets': len(pkgs),
+    return {'num_datasets': len(pkgs),
             'num_resources': num_resources,
             'table': rows,
             }
 
+
+def _merge_publisher_resources(parts):
+    return {'num_datasets': sum(part['num_datasets'] for part in parts),
+            'num_resources': sum(part['num_resources'] for part in parts),
+            'table': [row for part in parts for row in part['table']],
+            }
+
+publisher_resources_rollup = TreeRollup('publisher-resources',
+                                        _publisher_resources_part,
+                                        _merge_publisher_resources,
+                                        _publisher_resources_tree)
+
 def publisher_resources_combinations():
     for organization in lib.all_organizations():
         for include_sub_organizations in (False, True):
@@ -215,8 +274,9 @@ def publisher_activity(organization, include_sub_organizations=False):
     if organization:
         quarters = get_quarter_dates(now)
 
-        created, modified = _get_activity(
-            organization, include_sub_organizations, quarters)
+        created, modified = publisher_activity_rollup.get(
+            organization, include_sub_organizations,
+            tuple(sorted(quarters.items())))
 
         datasets = []
         for quarter_name in quarters:
@@ -241,25 +301,29 @@ def publisher_activity(organization, include_sub_organizations=False):
             filter(model.Group.type=='organization').\
             filter(model.Group.state=='active').order_by('name').\
             all()
-        for organization in add_progress_bar(all_orgs):
-            created, modified = _get_activity(
-                organization.name, include_sub_organizations, periods)
-            created_names = [dataset[0] for dataset in created.values()[0]]
-            modified_names = [dataset[0] for dataset in modified.values()[0]]
-            num_created = len(created_names)
-            num_modified = len(modified_names)
-            num_total = len(set(created_names) | set(modified_names))
-            stats_by_org.append(OrderedDict((
-                ('organization name', organization.name),
-                ('organization title', organization.title),
-                ('num created', num_created),
-                ('num modified', num_modified),
-                ('total', num_total),
-                )))
-            if not include_sub_organizations:
-                totals['num created'] += num_created
-                totals['num modified'] += num_modified
-                totals['total'] += num_total
+        # each organization's activity is got once, and reused for the
+        # organizations above it
+        with cached_parts():
+            for organization in add_progress_bar(all_orgs):
+                created, modified = publisher_activity_rollup.get(
+                    organization.name, include_sub_organizations,
+                    tuple(sorted(periods.items())))
+                created_names = [dataset[0] for dataset in created.values()[0]]
+                modified_names = [dataset[0] for dataset in modified.values()[0]]
+                num_created = len(created_names)
+                num_modified = len(modified_names)
+                num_total = len(set(created_names) | set(modified_names))
+                stats_by_org.append(OrderedDict((
+                    ('organization name', organization.name),
+                    ('organization title', organization.title),
+                    ('num created', num_created),
+                    ('num modified', num_modified),
+                    ('total', num_total),
+                    )))
+                if not include_sub_organizations:
+                    totals['num created'] += num_created
+                    totals['num modified'] += num_modified
+                    totals['total'] += num_total
 
         period_iso = [date_.isoformat()
                       for date_ in periods.values()[0]]
@@ -271,106 +335,183 @@ def publisher_activity(organization, include_sub_organizations=False):
                 'period': period_iso}
 
 
+# These are the authors whose revisions we ignore, as they are trivial
+# changes. NB we do want to know about revisions by:
+# * harvest (harvested metadata)
+# * dgu (NS Stat Hub imports)
+# * Fix national indicators
+ACTIVITY_SYSTEM_AUTHORS = ('autotheme', 'co-prod3.dh.bytemark.co.uk',
+                           'Date format tidier', 'current_revision_fixer',
+                           'current_revision_fixer2', 'fix_contact_details.py',
+                           'Repoint 410 Gone to webarchive url',
+                           'Fix duplicate resources',
+                           'fix_secondary_theme.py',
+                           )
+ACTIVITY_SYSTEM_AUTHOR_TEMPLATE = 'script%'  # "%" is a wildcard
+
+# The first revision of each dataset
+CREATED_REVISIONS_SQL = '''
+SELECT DISTINCT ON (PR.id) PR.id, PR.name, PR.title, PR.revision_timestamp,
+    R.author
+  FROM package_revision as PR
+  INNER JOIN revision as R ON R.id = PR.revision_id
+  WHERE PR.id = ANY(:package_ids)
+  ORDER BY PR.id, PR.revision_timestamp ASC
+'''
+
+# Revisions of the datasets, their resources and extras, excluding those by
+# the system authors. Columns: package_id, object revision_timestamp,
+# author, revision timestamp
+MODIFIED_REVISIONS_SQL = '''
+SELECT PR.id, PR.revision_timestamp, R.author, R.timestamp
+  FROM package_revision as PR
+  INNER JOIN revision as R ON R.id = PR.revision_id
+  WHERE PR.id = ANY(:package_ids) AND PR.state = 'active'
+    AND PR.revision_timestamp > :start AND PR.revision_timestamp < :end
+    AND %(author_condition)s
+UNION ALL
+SELECT P.id, RR.revision_timestamp, R.author, R.timestamp
+  FROM package as P
+  INNER JOIN resource_group as RG ON RG.package_id = P.id
+  INNER JOIN resource_revision as RR ON RR.resource_group_id = RG.id
+  INNER JOIN revision as R ON R.id = RR.revision_id
+  WHERE P.id = ANY(:package_ids) AND P.state = 'active'
+    AND RR.revision_timestamp > :start AND RR.revision_timestamp < :end
+    AND %(author_condition)s
+UNION ALL
+SELECT P.id, PER.revision_timestamp, R.author, R.timestamp
+  FROM package as P
+  INNER JOIN package_extra_revision as PER ON PER.package_id = P.id
+  INNER JOIN revision as R ON R.id = PER.revision_id
+  WHERE P.id = ANY(:package_ids) AND P.state = 'active'
+    AND PER.revision_timestamp > :start AND PER.revision_timestamp < :end
+    AND %(author_condition)s
+''' % {'author_condition':
+       'NOT (R.author = ANY(:system_authors)) '
+       'AND R.author NOT LIKE :system_author_template'}
+
+
 def _get_activity(organization_name, include_sub_organizations, periods):
+    '''Returns the datasets created and modified in each of the periods, as
+    two dicts keyed by period name.
+
+    All the revisions needed are fetched in a few bulk queries and grouped by
+    dataset in memory, rather than querying the revisions of each dataset in
+    turn.'''
     import ckan.model as model
-    from paste.deploy.converters import asbool
 
     created = dict((period_name, []) for period_name in periods)
     modified = dict((period_name, []) for period_name in periods)
 
-    # These are the authors whose revisions we ignore, as they are trivial
-    # changes. NB we do want to know about revisions by:
-    # * harvest (harvested metadata)
-    # * dgu (NS Stat Hub imports)
-    # * Fix national indicators
-    system_authors = ('autotheme', 'co-prod3.dh.bytemark.co.uk',
-                      'Date format tidier', 'current_revision_fixer',
-                      'current_revision_fixer2', 'fix_contact_details.py',
-                      'Repoint 410 Gone to webarchive url',
-                      'Fix duplicate resources',
-                      'fix_secondary_theme.py',
-                      )
-    system_author_template = 'script%'  # "%" is a wildcard
-
     if organization_name:
         organization = model.Group.by_name(organization_name)
         if not organization:
             raise p.toolkit.ObjectNotFound()
 
-    if not organization_name:
-        pkgs = model.Session.query(model.Package)\
-                    .all()
-    else:
-        pkgs = model.Session.query(model.Package)
-        pkgs = lib.filter_by_organizations(pkgs, organization,
-                                           include_sub_organizations).all()
-
-    for pkg in pkgs:
-        created_ = model.Session.query(model.PackageRevision)\
-            .filter(model.PackageRevision.id == pkg.id) \
-            .order_by("revision_timestamp asc").first()
-
-        pr_q = model.Session.query(model.PackageRevision, model.Revision)\
-            .filter(model.PackageRevision.id == pkg.id)\
-            .filter_by(state='active')\
-            .join(model.Revision)\
-            .filter(~model.Revision.author.in_(system_authors)) \
-            .filter(~model.Revision.author.like(system_author_template))
-        rr_q = model.Session.query(model.Package, model.ResourceRevision, model.Revision)\
-            .filter(model.Package.id == pkg.id)\
-            .filter_by(state='active')\
-            .join(model.ResourceGroup)\
-            .join(model.ResourceRevision,
-                  model.ResourceGroup.id == model.ResourceRevision.resource_group_id)\
-            .join(model.Revision)\
-            .filter(~model.Revision.author.in_(system_authors))\
-            .filter(~model.Revision.author.like(system_author_template))
-        pe_q = model.Session.query(model.Package, model.PackageExtraRevision, model.Revision)\
-            .filter(model.Package.id == pkg.id)\
-            .filter_by(state='active')\
-            .join(model.PackageExtraRevision,
-                  model.Package.id == model.PackageExtraRevision.package_id)\
-            .join(model.Revision)\
-            .filter(~model.Revision.author.in_(system_authors))\
-            .filter(~model.Revision.author.like(system_author_template))
-
+    pkg_ids = model.Session.query(model.Package.id)
+    if organization_name and include_sub_organizations:
+        pkg_ids = pkg_ids.filter(model.Package.owner_org.in_(
+            organization_tree_ids(organization_name) or [organization.id]))
+    elif organization_name:
+        pkg_ids = lib.filter_by_organizations(pkg_ids, organization, False)
+    pkg_ids = [id_ for id_, in pkg_ids]
+    if not pkg_ids or not periods:
+        return created, modified
+
+    created_revisions = dict(
+        (row[0], row) for row in model.Session.execute(
+            CREATED_REVISIONS_SQL, {'package_ids': pkg_ids}))
+
+    # package_id: [(revision_timestamp, author, timestamp), ...]
+    revisions_by_pkg = collections.defaultdict(list)
+    for pkg_id, revision_timestamp, author, timestamp in \
+            model.Session.execute(MODIFIED_REVISIONS_SQL, {
+                'package_ids': pkg_ids,
+                'start': min(period[0] for period in periods.values()),
+                'end': max(period[1] for period in periods.values()),
+                'system_authors': list(ACTIVITY_SYSTEM_AUTHORS),
+                'system_author_template': ACTIVITY_SYSTEM_AUTHOR_TEMPLATE}):
+        revisions_by_pkg[pkg_id].append((revision_timestamp, author,
+                                         timestamp))
+
+    # (pkg_id, period_name, created_row or None, authors, dates)
+    activity = []
+    for pkg_id in pkg_ids:
+        created_ = created_revisions.get(pkg_id)
+        if not created_:
+            # no revisions at all
+            continue
+        created_timestamp = created_[3]
+        revisions = revisions_by_pkg.get(pkg_id, [])
         for period_name in periods:
             period = periods[period_name]
             # created
-            if period[0] < created_.revision_timestamp < period[1]:
-                published = not asbool(pkg.extras.get('unpublished'))
-                created[period_name].append(
-                    (created_.name, created_.title, lib.dataset_notes(pkg),
-                     'created', period_name,
-                     created_.revision_timestamp.isoformat(),
-                     created_.revision.author, published))
-
+            if period[0] < created_timestamp < period[1]:
+                activity.append((pkg_id, period_name, created_, None, None))
             # modified
             # exclude the creation revision
-            period_start = max(period[0], created_.revision_timestamp)
-            prs = pr_q.filter(model.PackageRevision.revision_timestamp > period_start)\
-                        .filter(model.PackageRevision.revision_timestamp < period[1])
-            rrs = rr_q.filter(model.ResourceRevision.revision_timestamp > period_start)\
-                        .filter(model.ResourceRevision.revision_timestamp < period[1])
-            pes = pe_q.filter(model.PackageExtraRevision.revision_timestamp > period_start)\
-                        .filter(model.PackageExtraRevision.revision_timestamp < period[1])
-            authors = ' '.join(set([r[1].author for r in prs] +
-                                   [r[2].author for r in rrs] +
-                                   [r[2].author for r in pes]))
-            dates = set([r[1].timestamp.date() for r in prs] +
-                        [r[2].timestamp.date() for r in rrs] +
-                        [r[2].timestamp.date() for r in pes])
+            period_start = max(period[0], created_timestamp)
+            revisions_in_period = [
+                (author, timestamp)
+                for revision_timestamp, author, timestamp in revisions
+                if period_start < revision_timestamp < period[1]]
+            authors = ' '.join(set(author for author, timestamp
+                                   in revisions_in_period))
+            if authors:
+                dates = set(timestamp.date() for author, timestamp
+                            in revisions_in_period)
+                activity.append((pkg_id, period_name, None, authors, dates))
+
+    # Only the datasets with activity need their details
+    pkgs = {}
+    active_pkg_ids = list(set(item[0] for item in activity))
+    for i in xrange(0, len(active_pkg_ids), 500):
+        for pkg in model.Session.query(model.Package) \
+                .filter(model.Package.id.in_(active_pkg_ids[i:i + 500])):
+            pkgs[pkg.id] = pkg
+
+    for pkg_id, period_name, created_, authors, dates in activity:
+        pkg = pkgs[pkg_id]
+        published = not asbool(pkg.extras.get('unpublished'))
+        if created_:
+            created[period_name].append(
+                (created_[1], created_[2], lib.dataset_notes(pkg),
+                 'created', period_name,
+                 created_[3].isoformat(), created_[4], published))
+        else:
             dates_formatted = ' '.join([date.isoformat()
                                         for date in sorted(dates)])
-            if authors:
-                published = not asbool(pkg.extras.get('unpublished'))
-                modified[period_name].append(
-                    (pkg.name, pkg.title, lib.dataset_notes(pkg),
-                        'modified', period_name,
-                        dates_formatted, authors, published))
+            modified[period_name].append(
+                (pkg.name, pkg.title, lib.dataset_notes(pkg),
+                 'modified', period_name,
+                 dates_formatted, authors, published))
     return created, modified
 
 
+def _publisher_activity_part(organization_name, periods_items):
+    return _get_activity(organization_name, False, dict(periods_items))
+
+
+def _publisher_activity_tree(organization_name, periods_items):
+    return _get_activity(organization_name, True, dict(periods_items))
+
+
+def _merge_publisher_activity(parts):
+    created = collections.defaultdict(list)
+    modified = collections.defaultdict(list)
+    for part_created, part_modified in parts:
+        for period_name, datasets in part_created.items():
+            created[period_name].extend(datasets)
+        for period_name, datasets in part_modified.items():
+            modified[period_name].extend(datasets)
+    return dict(created), dict(modified)
+
+publisher_activity_rollup = TreeRollup('publisher-activity',
+                                       _publisher_activity_part,
+                                       _merge_publisher_activity,
+                                       _publisher_activity_tree)
+
+
 def publisher_activity_combinations():
     for org in lib.all_organizations(include_none=True):
         for include_sub_organizations in (False, True):
@@ -599,48 +740,70 @@ def get_user_realname(user):
     return name
 
 def admin_editor(org=None, include_sub_organizations=False):
-    from ckanext.dgu.lib.helpers import group_get_users
-
     table = []
 
     if org:
-        q = model.Group.all('organization')
         parent = model.Group.by_name(org)
         if not parent:
             raise p.toolkit.ObjectNotFound('Publisher not found')
 
-        if include_sub_organizations:
-            child_ids = [ch[0] for ch in parent.get_children_group_hierarchy(type='organization')]
-        else:
-            child_ids = []
+        table = admin_editor_rollup.get(org, include_sub_organizations)
+    else:
+        table.append({})
 
-        q = q.filter(model.Group.id.in_([parent.id] + child_ids))
+    return {'table': table}
 
-        for g in q.all():
-            record = {}
-            record['publisher_name'] = g.name
-            record['publisher_title'] = g.title
 
-            admin_users = group_get_users(g, capacity='admin')
-            admins = []
-            for u in admin_users:
-                name = get_user_realname(u)
-                admins.append('%s <%s>' % (name, u.email))
+def _admin_editor_part(organization_name):
+    g = model.Group.by_name(organization_name)
+    if not g or g.state != 'active':
+        return []
+    return [_admin_editor_record(g)]
 
-            record['admins'] = "\n".join(admins)
 
-            editor_users = group_get_users(g, capacity='editor')
-            editors = []
-            for u in editor_users:
-                name = get_user_realname(u)
-                editors.append('%s <%s>' % (name, u.email))
+def _admin_editor_tree(organization_name):
+    '''The records of the organization and its sub-organizations, with one
+    query for the organizations.'''
+    org_ids = organization_tree_ids(organization_name)
+    if not org_ids:
+        return _admin_editor_part(organization_name)
+    groups = model.Group.all('organization') \
+        .filter(model.Group.id.in_(org_ids))
+    return [_admin_editor_record(g) for g in groups]
 
-            record['editors'] = "\n".join(editors)
-            table.append(record)
-    else:
-        table.append({})
 
-    return {'table': table}
+def _admin_editor_record(g):
+    from ckanext.dgu.lib.helpers import group_get_users
+
+    record = {}
+    record['publisher_name'] = g.name
+    record['publisher_title'] = g.title
+
+    admin_users = group_get_users(g, capacity='admin')
+    admins = []
+    for u in admin_users:
+        name = get_user_realname(u)
+        admins.append('%s <%s>' % (name, u.email))
+
+    record['admins'] = "\n".join(admins)
+
+    editor_users = group_get_users(g, capacity='editor')
+    editors = []
+    for u in editor_users:
+        name = get_user_realname(u)
+        editors.append('%s <%s>' % (name, u.email))
+
+    record['editors'] = "\n".join(editors)
+    return record
+
+
+def _merge_admin_editor(parts):
+    # in title order, as Group.all gives them
+    return sorted((record for part in parts for record in part),
+                  key=lambda record: record['publisher_title'])
+
+admin_editor_rollup = TreeRollup('admin-editor', _admin_editor_part,
+                                 _merge_admin_editor, _admin_editor_tree)
 
 def admin_editor_combinations():
     from ckanext.dgu.lib.helpers import organization_list
@@ -748,62 +911,65 @@ la_schemas_info = {
 
 # Licence report
 
+# The published datasets grouped by licence. Columns: license_id, licence
+# extra, names, titles
+LICENCE_REPORT_SQL = '''
+SELECT COALESCE(P.license_id, ''), COALESCE(LE.value, ''),
+    array_agg(P.name), array_agg(P.title)
+  FROM package as P
+  LEFT OUTER JOIN package_extra as LE ON LE.package_id = P.id
+    AND LE.key = 'licence' AND LE.state = 'active'
+  LEFT OUTER JOIN package_extra as UE ON UE.package_id = P.id
+    AND UE.key = 'unpublished' AND UE.state = 'active'
+  WHERE P.state = 'active'
+    AND COALESCE(lower(trim(UE.value)), '') NOT IN %(true_values)s
+    %(organization_condition)s
+  GROUP BY 1, 2
+'''
+# as asbool() understands them
+SQL_TRUE_VALUES = "('true', 'yes', 'on', 'y', 't', '1')"
+
+
 def licence_report(organization=None, include_sub_organizations=False):
     '''
     Returns a dictionary detailing licences for datasets in the
     organisation specified, and optionally sub organizations.
     '''
-    # Get packages
+    params = {}
+    organization_condition = ''
     if organization:
         top_org = model.Group.by_name(organization)
         if not top_org:
             raise p.toolkit.ObjectNotFound('Publisher not found')
 
         if include_sub_organizations:
-            orgs = lib.go_down_tree(top_org)
+            params['org_ids'] = organization_tree_ids(organization) or \
+                [top_org.id]
         else:
-            orgs = [top_org]
-        pkgs = set()
-        for org in orgs:
-            org_pkgs = model.Session.query(model.Package)\
-                            .filter_by(state='active')
-            org_pkgs = lib.filter_by_organizations(
-                org_pkgs, organization,
-                include_sub_organizations=False)\
-                .all()
-            pkgs |= set(org_pkgs)
-    else:
-        pkgs = model.Session.query(model.Package)\
-                    .filter_by(state='active')\
-                    .all()
+            params['org_ids'] = [top_org.id]
+        organization_condition = 'AND P.owner_org = ANY(:org_ids)'
+
+    licence_rows = model.Session.execute(LICENCE_REPORT_SQL % {
+        'true_values': SQL_TRUE_VALUES,
+        'organization_condition': organization_condition}, params)
+    license_register = model.Package.get_license_register()
 
-    # Get their licences
-    packages_by_licence = collections.defaultdict(list)
     rows = []
     num_pkgs = 0
-    for pkg in pkgs:
-        if asbool(pkg.extras.get('unpublished')) is True:
-            # Ignore unpublished datasets
-            continue
-        licence_tuple = (pkg.license_id or '',
-                         pkg.license.title if pkg.license else '',
-                         pkg.extras.get('licence', ''))
-        packages_by_licence[licence_tuple].append((pkg.name, pkg.title))
-        num_pkgs += 1
-
-    for licence_tuple, dataset_tuples in sorted(packages_by_licence.items(),
-                                                key=lambda x: -len(x[1])):
-        license_id, license_title, licence = licence_tuple
-        dataset_tuples.sort(key=lambda x: x[0])
+    for license_id, licence, names, titles in sorted(
+            licence_rows, key=lambda x: -len(x[2])):
+        license_ = license_register.get(license_id) if license_id else None
+        dataset_tuples = sorted(zip(names, titles), key=lambda x: x[0])
         dataset_names, dataset_titles = zip(*dataset_tuples)
         licence_dict = OrderedDict((
             ('license_id', license_id),
-            ('license_title', license_title),
+            ('license_title', license_.title if license_ else ''),
             ('licence', licence),
             ('dataset_titles', '|'.join(t for t in dataset_titles)),
             ('dataset_names', ' '.join(dataset_names)),
             ))
         rows.append(licence_dict)
+        num_pkgs += len(dataset_tuples)
 
     return {
         'num_datasets': num_pkgs,
@@ -852,14 +1018,15 @@ def pdf_datasets_report():
             continue
         num_datasets_published += 1
 
-        formats = set([res.format.lower() for res in pkg.resources
+        formats = set([Formats.normalise(res.format)
+                       for res in pkg.resources
                        if res.resource_type != 'documentation'])
-        if 'pdf' not in formats:
+        if 'PDF' not in formats:
             continue
         org = pkg.get_organization().name
 
-        data_formats = formats - set(('html', '', None))
-        if data_formats == set(('pdf',)):
+        data_formats = formats - set(('HTML', '', None))
+        if data_formats == set(('PDF',)):
             num_datasets_only_pdf += 1
             datasets_by_publisher_only_pdf[org].append((pkg.name, pkg.title))
 
@@ -923,14 +1090,15 @@ def html_datasets_report():
             continue
         num_datasets_published += 1
 
-        formats = set([res.format.lower() for res in pkg.resources
+        formats = set([Formats.normalise(res.format)
+                       for res in pkg.resources
                        if res.resource_type != 'documentation'])
-        if 'html' not in formats:
+        if 'HTML' not in formats:
             continue
         org = pkg.get_organization().name
 
-        data_formats = formats - set(('asp', '', None))
-        if data_formats == set(('html',)):
+        data_formats = formats - set(('', None))
+        if data_formats == set(('HTML',)):
             num_datasets_only_html += 1
             datasets_by_publisher_only_html[org].append((pkg.name, pkg.title))
 
@@ -0,0 +1,239 @@
+'''Skips Solr writes for datasets whose index document has not changed.
+
+Package edits, archiver/QA updates and gemini post-processing all cause a
+dataset to be reindexed, even when none of the indexed fields change. With
+this installed, the connection that CKAN's PackageSearchIndex posts to is
+wrapped so that each document is hashed and only written if the hash differs
+from the one stored (in the dgu_index_fingerprint table) when it was last
+written.
+
+Enable it with this option in the CKAN config (after creating the table with
+"paster index_fingerprint_init"):
+
+    dgu.search.skip_unchanged = true
+
+A fingerprint is only stored once Solr has committed the document, so a
+write that is rolled back, or never committed, is made again next time.
+
+"paster search-index rebuild" (including a refresh with -r, used to repair
+the index) writes every document regardless, unless this is also set:
+
+    dgu.search.skip_unchanged_on_rebuild = true
+'''
+import contextlib
+import hashlib
+import json
+import logging
+import re
+import threading
+
+from sqlalchemy import select
+
+from ckan import model
+from ckanext.dgu.model.index_fingerprint import IndexFingerprint
+
+log = logging.getLogger(__name__)
+
+# Fields that differ every time a document is built, so are not hashed
+VOLATILE_FIELDS = set(('indexed_ts', '_version_'))
+
+# How often (in documents) to log the counters
+LOG_EVERY = 100
+
+stats = {'written': 0, 'skipped': 0}
+
+# Fingerprints of the documents written but not yet committed to Solr
+# {package_id: fingerprint}
+_pending_fingerprints = {}
+_pending_lock = threading.Lock()
+
+# While set, every document is written (its fingerprint is still stored)
+_skipping_disabled = threading.local()
+
+fingerprint_table = IndexFingerprint.__table__
+
+
+def fingerprint(doc):
+    '''Returns a stable hash of a Solr document (dict).'''
+    doc = dict((k, v) for k, v in doc.items() if k not in VOLATILE_FIELDS)
+    serialized = json.dumps(doc, sort_keys=True, default=unicode)
+    return unicode(hashlib.sha1(serialized).hexdigest())
+
+
+def get_stats():
+    '''Returns the numbers of documents written and skipped by this process.'''
+    return dict(stats)
+
+
+def _count(key):
+    stats[key] += 1
+    if sum(stats.values()) % LOG_EVERY == 0:
+        log.info('Index documents written: %(written)i skipped as unchanged: '
+                 '%(skipped)i', stats)
+
+
+# The fingerprints are read and written on their own connection, since the
+# indexing may happen while the main Session is part way through a commit.
+
+def get_fingerprints(package_ids):
+    '''Returns the stored fingerprints of the datasets, in one query.
+
+    :returns: {package_id: fingerprint}
+    '''
+    if not package_ids:
+        return {}
+    conn = model.meta.engine.connect()
+    try:
+        return dict(conn.execute(
+            select([fingerprint_table.c.package_id,
+                    fingerprint_table.c.fingerprint])
+            .where(fingerprint_table.c.package_id.in_(package_ids))))
+    finally:
+        conn.close()
+
+
+def set_fingerprints(fingerprints):
+    '''Stores fingerprints.
+
+    :param fingerprints: {package_id: fingerprint}
+    '''
+    if not fingerprints:
+        return
+    conn = model.meta.engine.connect()
+    trans = conn.begin()
+    try:
+        conn.execute(fingerprint_table.delete().where(
+            fingerprint_table.c.package_id.in_(fingerprints.keys())))
+        conn.execute(fingerprint_table.insert(),
+                     [{'package_id': id_, 'fingerprint': fp}
+                      for id_, fp in fingerprints.items()])
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _add_pending_fingerprints(fingerprints):
+    with _pending_lock:
+        _pending_fingerprints.update(fingerprints)
+
+
+def _pop_pending_fingerprints():
+    global _pending_fingerprints
+    with _pending_lock:
+        fingerprints = _pending_fingerprints
+        _pending_fingerprints = {}
+    return fingerprints
+
+
+@contextlib.contextmanager
+def skipping_disabled():
+    '''Within this context (in this thread) every document is written.'''
+    _skipping_disabled.value = True
+    try:
+        yield
+    finally:
+        _skipping_disabled.value = False
+
+
+def clear_fingerprints(package_ids=None):
+    '''Forgets the fingerprints of the given datasets, or of all datasets if
+    none are specified, so they will be written next time they are indexed.
+    '''
+    delete = fingerprint_table.delete()
+    if package_ids is not None:
+        if not package_ids:
+            return
+        delete = delete.where(fingerprint_table.c.package_id.in_(package_ids))
+    conn = model.meta.engine.connect()
+    try:
+        conn.execute(delete)
+    finally:
+        conn.close()
+
+
+class FingerprintingConnection(object):
+    '''Wraps a Solr connection, dropping documents from add_many that are
+    unchanged since they were last written. Deletes forget the fingerprints
+    of the datasets concerned.'''
+    _id_in_query = re.compile(r'\bid:"([^"]+)"')
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def add_many(self, docs, _commit=False):
+        from pylons import config
+        from paste.deploy.converters import asbool
+
+        to_write = []
+        fingerprints = {}
+        if getattr(_skipping_disabled, 'value', False):
+            stored_fingerprints = {}
+        else:
+            stored_fingerprints = get_fingerprints([doc['id'] for doc in docs])
+        for doc in docs:
+            fp = fingerprint(doc)
+            if stored_fingerprints.get(doc['id']) == fp:
+                log.debug('Index document unchanged - not written: %s',
+                          doc.get('name'))
+                _count('skipped')
+                continue
+            to_write.append(doc)
+            fingerprints[doc['id']] = fp
+        if not to_write:
+            return
+        self.conn.add_many(to_write, _commit=_commit)
+        if _commit or \
+                not asbool(config.get('ckan.search.solr_commit', 'true')):
+            # committed now, or by Solr's autoCommit
+            set_fingerprints(fingerprints)
+        else:
+            _add_pending_fingerprints(fingerprints)
+        for doc in to_write:
+            _count('written')
+
+    def commit(self, *args, **kwargs):
+        result = self.conn.commit(*args, **kwargs)
+        set_fingerprints(_pop_pending_fingerprints())
+        return result
+
+    def rollback(self, *args, **kwargs):
+        _pop_pending_fingerprints()
+        return self.conn.rollback(*args, **kwargs)
+
+    def delete_query(self, query, *args, **kwargs):
+        package_ids = self._id_in_query.findall(query)
+        # a query without a dataset id (e.g. clearing the index) could match
+        # any dataset
+        clear_fingerprints(package_ids or None)
+        return self.conn.delete_query(query, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+def install(skip_unchanged_on_rebuild=False):
+    '''[Monkey patch] Wrap the Solr connections that PackageSearchIndex
+    writes to. Unless skip_unchanged_on_rebuild, also wrap the search index
+    rebuild so that it writes every document.'''
+    import ckan.lib.search as search
+    from ckan.lib.search import index as search_index
+    if getattr(search_index.make_connection, 'fingerprinting', False):
+        return
+    make_connection = search_index.make_connection
+
+    def make_fingerprinting_connection():
+        return FingerprintingConnection(make_connection())
+    make_fingerprinting_connection.fingerprinting = True
+    search_index.make_connection = make_fingerprinting_connection
+
+    if not skip_unchanged_on_rebuild:
+        rebuild = search.rebuild
+
+        def rebuild_writing_all(*args, **kwargs):
+            with skipping_disabled():
+                return rebuild(*args, **kwargs)
+        search.rebuild = rebuild_writing_all
+    log.info('Unchanged index documents will not be written to Solr')
@@ -6,7 +6,7 @@ from ckan import plugins
 import ckan.lib.plugins as lib_plugins
 from ckan.lib.navl.dictization_functions import validate
 from ckan.logic.action.get import organization_show
-from ckanext.dgu.model.schema_codelist import Schema, Codelist
+from ckanext.dgu.model.schema_codelist import Schema, Codelist, cached_list
 
 #from ckan.plugins.toolkit as t
 
@@ -74,14 +74,10 @@ def suggest_themes(context, data_dict):
 def schema_list(context, data_dict):
     check_access('schema_list', context, data_dict)
 
-    model = context['model']
-    items = model.Session.query(Schema).order_by('title')
-    return [item.as_dict() for item in items.all()]
+    return cached_list(Schema)
 
 @side_effect_free
 def codelist_list(context, data_dict):
     check_access('codelist_list', context, data_dict)
 
-    model = context['model']
-    items = model.Session.query(Codelist).order_by('title')
-    return [item.as_dict() for item in items.all()]
+    return cached_list(Codelist)
@@ -0,0 +1,23 @@
+import datetime
+
+from sqlalchemy import Column, types
+from sqlalchemy.ext.declarative import declarative_base
+
+Base = declarative_base()
+
+
+class IndexFingerprint(Base):
+    """
+    A hash of the document last written to Solr for a dataset, so that the
+    write can be skipped when the document would be the same.
+    """
+    __tablename__ = 'dgu_index_fingerprint'
+
+    package_id = Column(types.UnicodeText, primary_key=True)
+    fingerprint = Column(types.UnicodeText, nullable=False)
+    updated = Column(types.DateTime, default=datetime.datetime.utcnow,
+                     nullable=False)
+
+
+def init_tables(e):
+    Base.metadata.create_all(e)
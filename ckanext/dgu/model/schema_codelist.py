@@ -1,3 +1,4 @@
+import time
 import uuid
 
 from sqlalchemy import Column
@@ -70,5 +71,39 @@ class Codelist(DeclarativeBase, model.DomainObject):
         return model.Session.query(cls).filter(cls.url==url).first()
 
 
+# Schemas and codelists are reference data that rarely changes, so they are
+# held in memory rather than queried for every form and dataset indexed.
+# SchemaPlugin clears this when edits to them are committed in this process,
+# and the TTL picks up edits made by other processes (e.g. paster commands).
+#   {cls: (time_loaded, [item_dict, ...], {id: title})}
+_cache = {}
+CACHE_TTL = 600  # seconds
+
+
+def _cached(cls):
+    loaded_at, items, titles = _cache.get(cls, (0, None, None))
+    if items is None or time.time() - loaded_at > CACHE_TTL:
+        items = [item.as_dict() for item in
+                 model.Session.query(cls).order_by(cls.title).all()]
+        titles = dict((item['id'], item['title']) for item in items)
+        _cache[cls] = (time.time(), items, titles)
+    return items, titles
+
+
+def cached_list(cls):
+    '''Returns all the Schemas (or Codelists) as dicts, ordered by title.'''
+    return [dict(item) for item in _cached(cls)[0]]
+
+
+def cached_titles(cls):
+    '''Returns a dict of the titles of all the Schemas (or Codelists),
+    keyed by id.'''
+    return _cached(cls)[1]
+
+
+def invalidate_cache():
+    _cache.clear()
+
+
 def init_tables(e):
     DeclarativeBase.metadata.create_all(e)
@@ -287,6 +287,9 @@ class PublisherPlugin(p.SingletonPlugin):
         """
         Before we commit a session we will check to see if any of the new
         items are users so we can notify them to apply for publisher access.
+
+        Also, if publishers or their place in the hierarchy have changed, the
+        publisher ancestry table used for search indexing is cleared.
         """
         from pylons.i18n import _
         from ckan.model import User
@@ -295,6 +298,8 @@ class PublisherPlugin(p.SingletonPlugin):
         if not hasattr(session, '_object_cache'):
             return
 
+        self._invalidate_publisher_ancestry_if_changed(session)
+
         pubctlr = 'ckanext.dgu.controllers.publisher:PublisherController'
         for obj in set(session._object_cache['new']):
             if isinstance(obj, (User)):
@@ -315,6 +320,19 @@ class PublisherPlugin(p.SingletonPlugin):
                     #log.debug('Did not add a flash message due to a missing session: %s' % msg)
                     pass
 
+    def _invalidate_publisher_ancestry_if_changed(self, session):
+        from ckan import model
+        from ckanext.dgu.lib.publisher import invalidate_publisher_ancestry
+
+        object_cache = session._object_cache
+        for key in ('new', 'changed', 'deleted'):
+            for obj in object_cache.get(key, ()):
+                if isinstance(obj, (model.Group, model.GroupExtra)) or \
+                        (isinstance(obj, model.Member) and
+                         obj.table_name == 'group'):
+                    invalidate_publisher_ancestry()
+                    return
+
     def before_map(self, map):
         map.redirect('/organization/{url:.*}', '/publisher/{url}')
         with SubMapper(map, controller='ckanext.dgu.controllers.publisher:PublisherController') as m:
@@ -434,11 +452,29 @@ class SearchPlugin(p.SingletonPlugin):
     Another thing that DGU does differently is that it cleans up the resource
     formats prior to indexing.
 
+    If dgu.search.skip_unchanged is set, a dataset is only written to Solr
+    when its index document has changed - see lib/search_fingerprint.py.
+
     A further thing that DGU does differently is to index the group title, as
     well as the group name.
     """
 
     p.implements(p.IPackageController, inherit=True)
+    p.implements(p.IConfigurable)
+
+    def configure(self, config):
+        # Evaluate this once, rather than for every dataset indexed
+        SearchIndexing.ga_report_enabled = is_plugin_enabled('ga-report')
+
+        # the dataset counts are refreshed after each index commit
+        from ckanext.dgu.lib import dataset_counts
+        dataset_counts.install()
+
+        if toolkit.asbool(config.get('dgu.search.skip_unchanged', False)):
+            from ckanext.dgu.lib import search_fingerprint
+            search_fingerprint.install(
+                skip_unchanged_on_rebuild=toolkit.asbool(config.get(
+                    'dgu.search.skip_unchanged_on_rebuild', False)))
 
     def read(self, entity):
         pass
@@ -539,6 +575,7 @@ class ApiPlugin(p.SingletonPlugin):
         api_controller = 'ckanext.dgu.controllers.api:DguApiController'
         map.connect('/api/util/latest-datasets', controller=api_controller, action='latest_datasets')
         map.connect('/api/util/dataset-count', controller=api_controller, action='dataset_count')
+        map.connect('/api/util/dataset-counts', controller=api_controller, action='dataset_counts')
         map.connect('/api/util/revisions', controller=api_controller, action='revisions')
         map.connect('/api/util/latest-unpublished', controller=api_controller, action='latest_unpublished')
         map.connect('/api/util/popular-unpublished', controller=api_controller, action='popular_unpublished')
@@ -566,6 +603,30 @@ class SchemaPlugin(p.SingletonPlugin):
     '''Schemas & Code lists'''
     p.implements(p.IActions)
     p.implements(p.IAuthFunctions)
+    p.implements(p.ISession, inherit=True)
+
+    # ISession
+
+    def before_commit(self, session):
+        from ckanext.dgu.model.schema_codelist import Schema, Codelist
+        if not hasattr(session, '_object_cache'):
+            return
+        for key in ('new', 'changed', 'deleted'):
+            for obj in session._object_cache.get(key, ()):
+                if isinstance(obj, (Schema, Codelist)):
+                    # the cache is cleared once committed - clearing it now
+                    # would let another thread reload the old rows
+                    session._dgu_schema_codelist_changed = True
+                    return
+
+    def after_commit(self, session):
+        from ckanext.dgu.model.schema_codelist import invalidate_cache
+        if getattr(session, '_dgu_schema_codelist_changed', False):
+            session._dgu_schema_codelist_changed = False
+            invalidate_cache()
+
+    def after_rollback(self, session):
+        session._dgu_schema_codelist_changed = False
 
     # IActions
 
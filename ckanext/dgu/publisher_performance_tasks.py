@@ -0,0 +1,48 @@
+import os
+
+from ckan.lib.celery_app import celery
+
+from ckanext.dgu.gemini_postprocess_tasks import load_config, \
+    register_translator
+
+
+def create_refresh_task(publisher, queue='bulk'):
+    from pylons import config
+    from ckan.model.types import make_uuid
+    log = __import__('logging').getLogger(__name__)
+    task_id = '%s/%s' % (publisher.name, make_uuid()[:4])
+    ckan_ini_filepath = os.path.abspath(config['__file__'])
+    celery.send_task('publisher_performance.refresh',
+                     args=[ckan_ini_filepath, publisher.name],
+                     task_id=task_id, queue=queue)
+    log.debug('Refresh of publisher performance data put into celery queue '
+              '%s: %s', queue, publisher.name)
+
+
+@celery.task(name="publisher_performance.refresh")
+def refresh(ckan_ini_filepath, publisher_name):
+    '''
+    Recalculate the performance data (traffic lights) of a publisher.
+    '''
+    load_config(ckan_ini_filepath)
+    register_translator()
+
+    log = refresh.get_logger()
+    log.info('Starting publisher performance refresh task: %s',
+             publisher_name)
+
+    from ckan import model
+    from ckanext.dgu.lib.publisher import refresh_performance_data
+    try:
+        publisher = model.Group.get(publisher_name)
+        if not publisher:
+            log.error('Publisher not found: %s', publisher_name)
+            return
+        refresh_performance_data(publisher)
+    except Exception, e:
+        if os.environ.get('DEBUG'):
+            raise
+        # Any problem at all is logged and reraised so that celery can log it too
+        log.error('Error occurred refreshing publisher performance data: '
+                  '%s\nPublisher: %s', e, publisher_name)
+        raise
@@ -2,6 +2,8 @@ from logging import getLogger
 import re
 import string
 import json
+import threading
+from collections import OrderedDict
 
 from paste.deploy.converters import asbool
 
@@ -17,20 +19,80 @@ class SearchIndexing(object):
     '''Functions that edit the package dictionary fields to affect the way it
     gets indexed in Solr.'''
 
+    # Whether the ga-report plugin is enabled. SearchPlugin sets this once when
+    # it is configured.
+    ga_report_enabled = None
+
+    # {dataset_name: popularity_score} for all datasets, loaded in one query
+    _popularity_scores = None
+    _popularity_scores_loaded_at = 0
+
     @classmethod
     def add_popularity(cls, pkg_dict):
         '''Adds the views field from the ga-report plugin, if it is installed'''
-        from pylons import config
+        if cls.ga_report_enabled is None:
+            cls.ga_report_enabled = dgu_helpers.is_plugin_enabled('ga-report')
 
         score = 0
 
-        if 'ga-report' in config.get('ckan.plugins'):
-            from ckanext.ga_report.ga_model import get_score_for_dataset
-            score += get_score_for_dataset(pkg_dict['name'])
+        if cls.ga_report_enabled:
+            score += cls.get_popularity_scores().get(pkg_dict['name'], 0)
 
         pkg_dict['popularity'] = score
         log.debug('Popularity: %s', pkg_dict['popularity'])
 
+    @classmethod
+    def get_popularity_scores(cls):
+        '''Returns the popularity scores of all datasets. They are reloaded
+        when older than dgu.popularity_cache_ttl seconds (default 1 hour), so
+        that incremental indexing in the web process picks up new GA data.'''
+        from pylons import config
+        import time
+
+        ttl = int(config.get('dgu.popularity_cache_ttl', 3600))
+        if cls._popularity_scores is None or \
+                time.time() - cls._popularity_scores_loaded_at > ttl:
+            cls._popularity_scores = cls.load_popularity_scores()
+            cls._popularity_scores_loaded_at = time.time()
+        return cls._popularity_scores
+
+    @classmethod
+    def load_popularity_scores(cls):
+        '''Calculates the popularity score of every dataset with GA data, in
+        a single query. The score is the same as ga_model.get_score_for_dataset
+        gives: views per day this month, plus half of last month's.'''
+        import datetime
+        from ckanext.ga_report.ga_model import GA_Url
+
+        now = datetime.datetime.now()
+        last_month = now - datetime.timedelta(days=30)
+        period_names = ['%s-%02d' % (last_month.year, last_month.month),
+                        '%s-%02d' % (now.year, now.month),
+                        ]
+        views_per_day = {}  # {(period_name, dataset_name): views_per_day}
+        entries = model.Session.query(GA_Url.period_name, GA_Url.package_id,
+                                      GA_Url.pageviews,
+                                      GA_Url.period_complete_day) \
+                       .filter(GA_Url.period_name.in_(period_names)) \
+                       .filter(GA_Url.package_id != None)
+        for period_name, dataset_name, pageviews, complete_day in entries:
+            key = (period_name, dataset_name)
+            if key in views_per_day:
+                # get_score_for_dataset only uses the first entry
+                continue
+            views = float(pageviews)
+            views_per_day[key] = views / (complete_day or 15)  # 15 is a guess
+
+        scores = {}
+        for dataset_name in set(name for _, name in views_per_day):
+            score = 0
+            for period_name in period_names:
+                score /= 2  # previous periods are discounted by 50%
+                score += views_per_day.get((period_name, dataset_name), 0)
+            scores[dataset_name] = int(score * 100)
+        log.info('Loaded popularity scores for %i datasets', len(scores))
+        return scores
+
     @classmethod
     def add_api_flag(cls, pkg_dict):
         pkg_dict['api'] = 'API' in [p.upper() for p in pkg_dict['res_format']]
@@ -116,45 +178,34 @@ class SearchIndexing(object):
         '''Standardises the res_format field.'''
         pkg_dict['res_format'] = [ cls._clean_format(f) for f in pkg_dict.get('res_format', []) ]
 
-    _disallowed_characters = re.compile(r'[^a-zA-Z /+]')
     @classmethod
     def _clean_format(cls, format_string):
-        if isinstance(format_string, basestring):
-            matched_format = helpers.resource_formats().get(format_string.lower().strip(' .'))
-            if matched_format:
-                return matched_format[1]
-            return re.sub(cls._disallowed_characters, '', format_string).strip()
-        else:
-            return format_string
+        from ckanext.dgu.lib.formats import Formats
+        return Formats.normalise(format_string)
 
     @classmethod
     def add_field__organization_title_and_abbreviation(cls, pkg_dict):
         '''Adds any group abbreviation '''
-        abbr = None
+        from ckanext.dgu.lib.publisher import get_publisher_ancestry
 
-        g = model.Group.get(pkg_dict['organization'])
-        if not g:
+        publisher = get_publisher_ancestry().get(pkg_dict['organization'])
+        if not publisher:
             log.error("Package %s does not belong to an organization" % pkg_dict['name'])
             return
 
-        pkg_dict['organization_titles'] = [g.title]
+        pkg_dict['organization_titles'] = [publisher['title']]
 
-        try:
-            abbr = g.extras.get('abbreviation')
-        except:
-            raise
-
-        if abbr:
-            pkg_dict['organization_titles'].append(abbr)
+        if publisher['abbreviation']:
+            pkg_dict['organization_titles'].append(publisher['abbreviation'])
 
         log.debug('Organization title: %r', pkg_dict['organization_titles'])
 
     @classmethod
     def add_field__publisher(cls, pkg_dict):
         '''Adds the 'publisher' based on group.'''
-        import ckan.model as model
+        from ckanext.dgu.lib.publisher import get_publisher_ancestry
 
-        publisher = model.Group.get(pkg_dict.get('organization'))
+        publisher = get_publisher_ancestry().get(pkg_dict.get('organization'))
         if not publisher:
             log.warning('Dataset %s doesn\'t seem to have a publisher!  '
                         'Unable to add publisher to index.',
@@ -163,29 +214,15 @@ class SearchIndexing(object):
 
         # Publisher names
         if not pkg_dict.has_key('publisher'):
-            pkg_dict['publisher'] = publisher.name
-            log.debug(u"Publisher: %s", publisher.name)
+            pkg_dict['publisher'] = publisher['name']
+            log.debug(u"Publisher: %s", publisher['name'])
         else:
             log.warning('Unable to add "publisher" to index, as the datadict '
                         'already contains a key of that name')
 
-        # Ancestry of publishers
-        ancestors = []
-        while(publisher is not None):
-            ancestors.append(publisher)
-            parent_publishers = publisher.get_parent_groups('organization')
-            if len(parent_publishers) == 0:
-                publisher = None
-            else:
-                if len(parent_publishers) > 1:
-                    log.warning('Publisher %s has more than one parent publisher. '
-                                'Ignoring all but the first. %s',
-                                publisher, repr(parent_publishers))
-                publisher = parent_publishers[0]
-
-
+        # Ancestry of publishers (precomputed, so no queries here)
         if not pkg_dict.has_key('parent_publishers'):
-            pkg_dict['parent_publishers'] = [ p.name for p in ancestors ]
+            pkg_dict['parent_publishers'] = list(publisher['ancestors'])
         else:
             log.warning('Unable to add "parent_publishers" to index, as the datadict '
                         'already contains a key of that name. '
@@ -195,8 +232,20 @@ class SearchIndexing(object):
     @classmethod
     def add_field__harvest_document(cls, pkg_dict):
         '''Index a harvested dataset\'s XML content
-           (Given a low priority when searching)'''
+           (Given a low priority when searching)
+
+        By default the whole GEMINI document is indexed. With config option
+        dgu.search.harvest_document_mode = text only the text of the abstract,
+        keywords and lineage is indexed, truncated to
+        dgu.search.harvest_document_max_size characters.
+        '''
+        from pylons import config
+
         if pkg_dict.get('UKLP', '') == 'True':
+            if config.get('dgu.search.harvest_document_mode') == 'text':
+                cls._add_harvest_document_text(pkg_dict)
+                return
+
             import ckan
             from ckanext.dgu.plugins_toolkit import get_action
 
@@ -214,6 +263,85 @@ class SearchIndexing(object):
                             'referenced by dataset "%s"',
                             data_dict['id'], pkg_dict['id'])
 
+    # Text extracted from harvest documents {harvest_object_id: text}, most
+    # recently used last. A harvest object's content doesn't change (a
+    # reharvest creates a new one) so entries never need invalidating.
+    # Indexing may run in several threads, so it is only used with the lock.
+    _harvest_document_text_cache = OrderedDict()
+    _harvest_document_text_lock = threading.Lock()
+    harvest_document_text_cache_size = 5000
+
+    @classmethod
+    def _add_harvest_document_text(cls, pkg_dict):
+        from pylons import config
+        from ckanext.harvest.model import HarvestObject
+
+        harvest_object_id = pkg_dict.get('harvest_object_id', '')
+        max_size = int(config.get('dgu.search.harvest_document_max_size',
+                                  20000))
+        cache = cls._harvest_document_text_cache
+        with cls._harvest_document_text_lock:
+            text = cache.pop(harvest_object_id, None)
+            if text is not None:
+                cache[harvest_object_id] = text  # most recently used
+        if text is None:
+            content = model.Session.query(HarvestObject.content) \
+                           .filter(HarvestObject.id == harvest_object_id) \
+                           .scalar()
+            if content is None:
+                log.warning('Unable to find harvest object "%s" '
+                            'referenced by dataset "%s"',
+                            harvest_object_id, pkg_dict['id'])
+                return
+            text = cls.harvest_document_text(content, max_size)
+            with cls._harvest_document_text_lock:
+                while len(cache) >= cls.harvest_document_text_cache_size:
+                    cache.popitem(last=False)
+                cache[harvest_object_id] = text
+        pkg_dict['extras_harvest_document_content'] = text
+
+    # GEMINI elements whose text is worth indexing
+    _harvest_document_text_elements = set(('abstract', 'keyword', 'statement'))
+
+    @classmethod
+    def harvest_document_text(cls, content, max_size):
+        '''Returns the text of the abstract, keywords and lineage in a GEMINI
+        document, without building the whole tree, stopping once max_size
+        characters have been collected.'''
+        from lxml import etree
+        from io import BytesIO
+
+        if isinstance(content, unicode):
+            content = content.encode('utf8')
+        texts = []
+        size = 0
+        depth_inside = 0  # number of open text elements we are inside
+        try:
+            for event, elem in etree.iterparse(BytesIO(content),
+                                               events=('start', 'end')):
+                if not isinstance(elem.tag, basestring):
+                    continue  # comments and processing instructions
+                local_name = etree.QName(elem).localname
+                is_text_element = \
+                    local_name in cls._harvest_document_text_elements
+                if event == 'start':
+                    if is_text_element:
+                        depth_inside += 1
+                    continue
+                if depth_inside and elem.text and elem.text.strip():
+                    texts.append(elem.text.strip())
+                    size += len(texts[-1]) + 1
+                if is_text_element:
+                    depth_inside -= 1
+                # free the memory of elements that have been dealt with
+                if depth_inside == 0:
+                    elem.clear()
+                if size >= max_size:
+                    break
+        except etree.XMLSyntaxError, e:
+            log.warning('Could not parse harvest document: %s', e)
+        return u' '.join(texts)[:max_size]
+
     @classmethod
     def add_field__openness(cls, pkg_dict):
         '''Add the openness score (stars) to the search index'''
@@ -256,18 +384,21 @@ class SearchIndexing(object):
 
     @classmethod
     def add_schema(cls, pkg_dict):
-        from ckanext.dgu.model.schema_codelist import Schema, Codelist
+        from ckanext.dgu.model.schema_codelist import Schema, Codelist, \
+            cached_titles
+        schema_titles = cached_titles(Schema)
+        codelist_titles = cached_titles(Codelist)
         try:
             schema_ids = json.loads(pkg_dict.get('schema') or '[]')
         except ValueError:
             log.error('Not valid JSON in schema field: %s %r',
                       pkg_dict['name'], pkg_dict.get('schema'))
-            schema_ids = None
+            schema_ids = []
         schemas = []
         for schema_id in schema_ids:
             try:
-                schemas.append(Schema.get(schema_id).title)
-            except AttributeError, e:
+                schemas.append(schema_titles[schema_id])
+            except (KeyError, TypeError), e:
                 log.error('Invalid schema_id: %r %s', schema_id, e)
         pkg_dict['schema_multi'] = schemas
         #log.debug('Schema: %s', ' '.join(schemas))
@@ -277,9 +408,12 @@ class SearchIndexing(object):
         except ValueError:
             log.error('Not valid JSON in codelists field: %s %r',
                       pkg_dict['name'], pkg_dict.get('codelist'))
-            codelists = None
+            codelist_ids = []
         codelists = []
         for codelist_id in codelist_ids:
-            codelists.append(Codelist.get(codelist_id).title)
+            try:
+                codelists.append(codelist_titles[codelist_id])
+            except (KeyError, TypeError), e:
+                log.error('Invalid codelist_id: %r %s', codelist_id, e)
         pkg_dict['codelist_multi'] = codelists
         #log.debug('Code lists: %s', ' '.join(codelists))
@@ -0,0 +1,25 @@
+import json
+import StringIO
+
+from nose.tools import assert_equal
+from ckanext.dgu.bin.dump_analysis import iter_json_packages
+
+PACKAGES = [{'name': 'pkg%s' % i, 'notes': u'Caf\xe9 ' * i, 'extras': {}}
+            for i in range(50)]
+
+
+class TestIterJsonPackages(object):
+    def _parse(self, json_str):
+        # small chunks, so that packages are split across them
+        return list(iter_json_packages(StringIO.StringIO(json_str),
+                                       chunk_size=100))
+
+    def test_array(self):
+        assert_equal(self._parse(json.dumps(PACKAGES, indent=4)), PACKAGES)
+
+    def test_json_lines(self):
+        json_str = ''.join(json.dumps(pkg) + '\n' for pkg in PACKAGES)
+        assert_equal(self._parse(json_str), PACKAGES)
+
+    def test_empty_array(self):
+        assert_equal(self._parse('[]'), [])
@@ -0,0 +1,157 @@
+import datetime
+
+import mock
+from nose.tools import assert_equal
+from nose.plugins.skip import SkipTest
+
+from ckan import model
+from ckanext.dgu.commands import report_cache
+from ckanext.dgu.commands.report_cache import (
+    estimate_task_size, filter_by_organizations, load_sub_organization_ids,
+    stale_option_dicts)
+
+
+def publisher(id_, name, ancestors):
+    return {'id': id_, 'name': name, 'title': name.title(),
+            'ancestors': [name] + ancestors}
+
+PUBLISHERS = [publisher('dept-id', 'dept', []),
+              publisher('agency-id', 'agency', ['dept']),
+              publisher('office-id', 'office', ['agency', 'dept']),
+              publisher('other-id', 'other', [])]
+# keyed by id and name, as get_publisher_ancestry is
+ANCESTRY = dict([(pub['id'], pub) for pub in PUBLISHERS] +
+                [(pub['name'], pub) for pub in PUBLISHERS])
+SUB_ORGANIZATION_IDS = load_sub_organization_ids(ANCESTRY)
+
+
+class TestLoadSubOrganizationIds(object):
+    def test_tree_ids(self):
+        org_id, tree_ids = SUB_ORGANIZATION_IDS['dept']
+        assert_equal(org_id, 'dept-id')
+        assert_equal(sorted(tree_ids), ['agency-id', 'dept-id', 'office-id'])
+        assert_equal(sorted(SUB_ORGANIZATION_IDS['agency'][1]),
+                     ['agency-id', 'office-id'])
+        assert_equal(SUB_ORGANIZATION_IDS['office'], ('office-id', ['office-id']))
+
+    def test_keyed_by_id_and_name(self):
+        for pub in PUBLISHERS:
+            assert SUB_ORGANIZATION_IDS[pub['id']] is \
+                SUB_ORGANIZATION_IDS[pub['name']]
+
+
+@mock.patch.object(report_cache, '_sub_organization_ids', SUB_ORGANIZATION_IDS)
+class TestFilterByOrganizations(object):
+    def _filter(self, organization, include_sub_organizations):
+        query = mock.Mock()
+        result = filter_by_organizations(query, organization,
+                                         include_sub_organizations)
+        assert result is query.filter.return_value
+        return query.filter.call_args[0][0]
+
+    def test_organization(self):
+        assert self._filter('agency', False).compare(
+            model.Package.owner_org == 'agency-id')
+
+    def test_sub_organizations(self):
+        tree_ids = SUB_ORGANIZATION_IDS['agency'][1]
+        assert_equal(sorted(tree_ids), ['agency-id', 'office-id'])
+        assert self._filter('agency', True).compare(
+            model.Package.owner_org.in_(tree_ids))
+
+    def test_no_organization(self):
+        query = model.Session.query(model.Package)
+        assert filter_by_organizations(query, None, True) is query
+
+    @mock.patch.object(report_cache, '_original_filter_by_organizations')
+    def test_unknown_organization_falls_back(self, original):
+        query = model.Session.query(model.Package)
+        result = filter_by_organizations(query, 'new-org', True)
+        original.assert_called_once_with(query, 'new-org', True)
+        assert result is original.return_value
+
+
+class TestInitWorker(object):
+    def test_patches_filter_by_organizations_once(self):
+        from ckanext.report import lib
+        original = lib.filter_by_organizations
+        with mock.patch.object(lib, 'filter_by_organizations', original), \
+                mock.patch.object(report_cache,
+                                  '_original_filter_by_organizations'), \
+                mock.patch.object(model, 'Session'):
+            report_cache.init_worker()
+            report_cache.init_worker()
+            assert lib.filter_by_organizations is filter_by_organizations
+            # the fallback is ckanext-report's, not the patch itself
+            assert report_cache._original_filter_by_organizations is original
+
+
+@mock.patch.object(report_cache, '_sub_organization_ids', SUB_ORGANIZATION_IDS)
+@mock.patch.object(report_cache, '_dataset_counts',
+                   {'dept-id': 1, 'agency-id': 10, 'office-id': 100})
+class TestEstimateTaskSize(object):
+    def test_organization(self):
+        assert_equal(estimate_task_size(('report', {'organization': 'agency'})),
+                     10)
+
+    def test_sub_organizations(self):
+        assert_equal(estimate_task_size(
+            ('report', {'org': 'agency', 'include_sub_organizations': True})),
+            110)
+
+    def test_all_organizations(self):
+        assert_equal(estimate_task_size(('report', {})), 111)
+
+    def test_unknown_organization(self):
+        assert_equal(estimate_task_size(('report', {'organization': 'new'})),
+                     0)
+
+
+class Report(object):
+    '''The parts of ckanext-report's Report that stale_option_dicts uses'''
+    name = 'test-report'
+
+    def add_defaults_to_options(self, option_dict):
+        options = {'include_sub_organizations': False}
+        options.update(option_dict)
+        return options
+
+    def generate_key(self, option_dict):
+        return '?' + '&'.join('%s=%s' % item
+                              for item in sorted(option_dict.items()))
+
+
+class TestStaleOptionDicts(object):
+    @classmethod
+    def setup_class(cls):
+        try:
+            from ckanext.report.model import DataCache
+        except ImportError:
+            raise SkipTest('Needs ckanext-report')
+        model.repo.rebuild_db()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def _cache(self, report, option_dict, age):
+        from ckanext.report.model import DataCache
+        key = report.generate_key(report.add_defaults_to_options(option_dict))
+        DataCache.set(report.name, key, '{}')
+        model.Session.query(DataCache) \
+            .filter_by(object_id=report.name, key=key) \
+            .update({'created': datetime.datetime.now() - age})
+        model.Session.commit()
+
+    def test_stale(self):
+        report = Report()
+        fresh = {'organization': 'fresh'}
+        old = {'organization': 'old'}
+        uncached = {'organization': 'uncached'}
+        # the defaults are added when matching the cache keys
+        self._cache(report, fresh, datetime.timedelta(hours=1))
+        self._cache(report, old, datetime.timedelta(hours=30))
+
+        assert_equal(stale_option_dicts(report, [fresh, old, uncached],
+                                        datetime.timedelta(hours=24)),
+                     [old, uncached])
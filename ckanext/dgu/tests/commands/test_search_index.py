@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+
+import mock
+from nose.tools import assert_equal
+
+from ckanext.dgu.commands.search_index import (
+    checkpoint_filepath, failed_filepath, index_worker, read_checkpoints,
+    read_failed)
+
+
+class TestCheckpoints(object):
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.dir, 'search_index.checkpoint')
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def _run_worker(self, package_ids, failing_ids=()):
+        def package_show(context, data_dict):
+            if data_dict['id'] in failing_ids:
+                raise Exception('Broken dataset')
+            return {'id': data_dict['id']}
+
+        def update_dict(pkg_dict, defer_commit=False):
+            # PackageSearchIndex posts the document to its connection
+            from ckan.lib.search import index as search_index
+            search_index.make_connection().add_many([pkg_dict])
+
+        with mock.patch('ckan.logic.get_action') as get_action, \
+                mock.patch('ckan.lib.search.index.make_connection'), \
+                mock.patch('ckan.lib.search.index.PackageSearchIndex') \
+                as package_search_index, \
+                mock.patch('ckan.lib.search.make_connection') as solr:
+            get_action.return_value = package_show
+            package_search_index.return_value.update_dict.side_effect = \
+                update_dict
+            index_worker(0, package_ids, 2, checkpoint_filepath(self.prefix, 0),
+                         failed_filepath(self.prefix, 0))
+        return solr
+
+    def test_failed_dataset_is_skipped(self):
+        solr = self._run_worker(['a', 'b', 'c'], failing_ids=('b',))
+        posted_ids = [doc['id'] for call in solr.return_value.add_many.call_args_list
+                      for doc in call[0][0]]
+        assert_equal(posted_ids, ['a', 'c'])
+        assert_equal(read_checkpoints(self.prefix), set(['a', 'c']))
+        assert_equal(read_failed(self.prefix, 1), set(['b']))
+
+    def test_resume(self):
+        self._run_worker(['a', 'b', 'c'], failing_ids=('b',))
+        done_ids = read_checkpoints(self.prefix)
+        # the failed dataset is retried on resume
+        remaining = [id_ for id_ in ['a', 'b', 'c'] if id_ not in done_ids]
+        assert_equal(remaining, ['b'])
+
+        os.remove(failed_filepath(self.prefix, 0))
+        self._run_worker(remaining)
+        assert_equal(read_checkpoints(self.prefix), set(['a', 'b', 'c']))
+        assert_equal(read_failed(self.prefix, 1), set())
+
+    def test_read_checkpoints_of_several_workers(self):
+        for worker_num, ids in enumerate((['a', 'b'], ['c'], [])):
+            with open(checkpoint_filepath(self.prefix, worker_num), 'w') as f:
+                f.write(''.join(id_ + '\n' for id_ in ids) + '\n')
+        assert_equal(read_checkpoints(self.prefix), set(['a', 'b', 'c']))
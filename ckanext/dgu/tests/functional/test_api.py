@@ -373,6 +373,16 @@ class TestDguApi(ControllerTestCase, TestSearchIndexer):
         assert isinstance(res, int), res
         assert 3 < res < 10, res
 
+    def test_dataset_counts(self):
+        offset = '/api/util/dataset-counts'
+        result = self.app.get(offset, status=[200])
+        assert 'max-age' in result.header_dict['Cache-Control']
+        res = json.loads(result.body)
+        assert set(res.keys()) == set(('total', 'published', 'unpublished',
+                                       'collections')), res.keys()
+        assert 3 < res['published'] < 10, res
+        assert res['total'] >= res['published'], res
+
     def test_latest_datasets(self):
         offset = '/api/util/latest-datasets'
         result = self.app.get(offset, status=[200])
@@ -395,6 +405,15 @@ class TestDguApi(ControllerTestCase, TestSearchIndexer):
         res = self.app.get(pkg['publisher_link'], status=[200])
         assert 'National Health Service' in res.body, res
 
+    def test_latest_datasets__not_modified(self):
+        offset = '/api/util/latest-datasets'
+        result = self.app.get(offset, status=[200])
+        etag = result.header_dict['ETag']
+        assert etag, result.header_dict
+        result = self.app.get(offset, headers={'If-None-Match': etag},
+                              status=[304])
+        assert_equal(result.body, '')
+
 def pkg_id(pkg_name):
     return model.Package.by_name(pkg_name).id
 
@@ -564,4 +583,22 @@ class TestDrupalApi(ControllerTestCase, TestSearchIndexer):
         assert_equal(res['since_revision_id'], revs[0].id)
         assert_equal(res['newest_revision_id'], revs[-1].id)
         assert res['number_of_revisions'] == len(revs), res['number_of_revisions']
-        assert res['results_limited'] == True, res['results_limited']
+        # results are limited only if there are more revisions than fit in
+        # a page, since every package in the revisions is returned
+        assert_equal(res['results_limited'], len(revs) >= 50)
+
+    def test_revisions__cursor(self):
+        last_rev, rev = self._get_last_and_penultimate_revisions()
+        offset = '/api/util/revisions?since-revision-id=%s' % rev.id
+        res = json.loads(self.app.get(offset, status=[200]).body)
+        assert_equal(res['newest_revision_id'], last_rev.id)
+
+        # the next page is empty, as there are no later revisions
+        offset = '/api/util/revisions?%s' % urlencode({'cursor': res['next']})
+        res = json.loads(self.app.get(offset, status=[200]).body)
+        assert_equal(res['number_of_revisions'], 0)
+        assert_equal(res['datasets'], [])
+        assert res['next'], res
+
+    def test_revisions__bad_cursor(self):
+        self.app.get('/api/util/revisions?cursor=rubbish', status=[400])
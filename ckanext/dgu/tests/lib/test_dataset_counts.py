@@ -0,0 +1,24 @@
+import mock
+from nose.tools import assert_equal
+
+from ckan.lib.search.index import PackageSearchIndex
+from ckanext.dgu.lib import dataset_counts
+
+
+@mock.patch('ckan.lib.search.index.make_connection')
+@mock.patch('ckanext.dgu.lib.dataset_counts.invalidate_dataset_counts')
+class TestInvalidatedByIndexCommits(object):
+    @classmethod
+    def setup_class(cls):
+        dataset_counts.install()
+        # installing again does not wrap the methods twice
+        dataset_counts.install()
+
+    def test_commit(self, invalidate, make_connection):
+        PackageSearchIndex().commit()
+        assert_equal(invalidate.call_count, 1)
+
+    def test_delete_package(self, invalidate, make_connection):
+        PackageSearchIndex().delete_package({'id': 'test-dataset'})
+        assert_equal(invalidate.call_count, 1)
+        assert make_connection.return_value.delete_query.called
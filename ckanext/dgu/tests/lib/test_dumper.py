@@ -0,0 +1,90 @@
+import os
+
+import mock
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.dgu.lib.dumper import CSVDumper, make_unique_nice_names, \
+    extra_column_key, ThreadedTeeWriter
+
+
+class TestMakeUniqueNiceNames(object):
+    def test_nice_names(self):
+        assert_equal(make_unique_nice_names(['theme-primary', 'update_frequency']),
+                     ['Primary Theme', 'Update Frequency'])
+
+    def test_clashing_keys(self):
+        assert_equal(make_unique_nice_names(['update-frequency',
+                                             'update_frequency',
+                                             'Update Frequency']),
+                     ['Update Frequency', 'Update Frequency 2',
+                      'Update Frequency 3'])
+
+    def test_clash_with_taken_names(self):
+        assert_equal(make_unique_nice_names(['license', 'url'],
+                                            ['Name', 'URL', 'License']),
+                     ['License 2', 'Url 2'])
+
+
+class TestCSVDumperClose(object):
+    def test_closes_parquet_writer(self):
+        parquet_writer = mock.Mock()
+        dumper = CSVDumper(parquet_writer=parquet_writer)
+        filenames = dumper.close()
+        for filename in filenames:
+            os.remove(filename)
+        assert_equal(parquet_writer.close.call_count, 1)
+
+    def test_without_parquet_writer(self):
+        dumper = CSVDumper()
+        for filename in dumper.close():
+            os.remove(filename)
+
+
+class TestExtrasColumns(object):
+    def test_extra_column_key(self):
+        assert_equal(extra_column_key(u'version'), u'extras_version')
+        assert_equal(extra_column_key(u'url'), u'extras_url')
+        assert_equal(extra_column_key(u'spatial'), u'spatial')
+
+    def test_extra_does_not_overwrite_package_field(self):
+        dumper = CSVDumper(stable_columns=True)
+        try:
+            flat_dict, resources = dumper._flatten_dict({
+                'version': u'1.0', 'url': u'http://example.com/',
+                'resources': [],
+                'extras': {u'version': u'extra version',
+                           u'url': u'http://extra.example.com/',
+                           u'spatial': u'UK'}})
+        finally:
+            for filename in dumper.close():
+                os.remove(filename)
+        assert_equal(flat_dict['version'], u'1.0')
+        assert_equal(flat_dict['extras_version'], u'extra version')
+        assert_equal(flat_dict['extras_url'], u'http://extra.example.com/')
+        assert_equal(flat_dict['spatial'], u'UK')
+        assert 'url' not in flat_dict
+
+
+class TestThreadedTeeWriter(object):
+    def test_writes_to_all_outputs(self):
+        outputs = [mock.Mock(), mock.Mock()]
+        tee = ThreadedTeeWriter([('a', outputs[0]), ('b', outputs[1])])
+        tee.write('data')
+        tee.close()
+        for output in outputs:
+            output.write.assert_called_once_with('data')
+            assert_equal(output.close.call_count, 1)
+
+    def test_failed_output_is_still_closed(self):
+        failing, ok = mock.Mock(), mock.Mock()
+        failing.write.side_effect = IOError('Disk full')
+        tee = ThreadedTeeWriter([('failing', failing), ('ok', ok)])
+        tee.chunk_size = 4
+        tee.write('data')
+        tee.write('more')
+        assert_raises(Exception, tee.close)
+        assert_equal(failing.write.call_count, 1)
+        assert_equal(failing.close.call_count, 1)
+        assert_equal(ok.write.call_count, 2)
+        assert_equal(ok.close.call_count, 1)
+        assert isinstance(tee.errors['failing'], IOError)
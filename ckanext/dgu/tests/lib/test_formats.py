@@ -0,0 +1,28 @@
+from nose.tools import assert_equal
+
+from ckanext.dgu.lib.formats import Formats
+
+
+class TestNormalise(object):
+    def test_messy_formats(self):
+        for raw, canonical in ((' .Csv', 'CSV'), ('csv ', 'CSV'),
+                               ('XLSX', 'XLSX'), ('.PDF', 'PDF'),
+                               ('Zip (CSV)', 'Zip CSV'), ('', '')):
+            assert_equal(Formats.normalise(raw), canonical)
+            # again, from the cache
+            assert_equal(Formats.normalise(raw), canonical)
+
+    def test_non_strings(self):
+        assert_equal(Formats.normalise(None), None)
+        assert_equal(Formats.normalise(5), 5)
+
+    def test_cache_is_bounded(self):
+        original_size = Formats.normalised_cache_size
+        Formats.normalised_cache_size = 3
+        try:
+            raws = ['csv', 'pdf', 'xls', 'html', 'json', 'csv']
+            results = [Formats.normalise(raw) for raw in raws]
+            assert len(Formats._normalised) <= 3
+            assert_equal(results, ['CSV', 'PDF', 'XLS', 'HTML', 'JSON', 'CSV'])
+        finally:
+            Formats.normalised_cache_size = original_size
@@ -1,6 +1,9 @@
+import datetime
 import json
 
+import mock
 from nose.tools import assert_equal
+from nose.plugins.skip import SkipTest
 
 from ckan.tests.pylons_controller import PylonsTestCase
 import ckan.new_tests.factories as factories
@@ -18,6 +21,7 @@ from ckanext.dgu.lib.helpers import (dgu_linked_user, user_properties,
                                      get_license_from_id,
                                      linkify,
                                      british_date_to_ga_date,
+                                     publisher_performance_data,
                                      )
 from ckanext.dgu.plugins_toolkit import c, get_action
 
@@ -510,3 +514,55 @@ class TestBritishDateToGaDate(object):
 
     def test_blank(self):
         assert_equal(british_date_to_ga_date(''), '')
+
+
+class TestPublisherPerformanceData(object):
+    @classmethod
+    def setup_class(cls):
+        try:
+            import ckanext.qa
+            from ckanext.report.model import DataCache
+        except ImportError:
+            raise SkipTest('Needs ckanext-qa and ckanext-report')
+        model.repo.rebuild_db()
+        cls.org = factories.Organization(name='perf-org',
+                                         category='ministerial-department')
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def setup(self):
+        from ckanext.report.model import DataCache
+        model.Session.query(DataCache).delete()
+        model.Session.commit()
+
+    @mock.patch('ckanext.dgu.publisher_performance_tasks.create_refresh_task')
+    def test_stale_data_queues_one_refresh(self, mock_create_refresh_task):
+        from ckanext.report.model import DataCache
+        publisher = model.Group.by_name('perf-org')
+        stale_data = {'broken_links': 'green', 'openness': 'amber',
+                      'issues': 'green', 'spending': 'red', 'timings': {}}
+        DataCache.set(publisher.name, 'performance-data',
+                      json.dumps(stale_data))
+        model.Session.query(DataCache) \
+            .filter_by(object_id=publisher.name, key='performance-data') \
+            .update({'created': datetime.datetime.now() -
+                     datetime.timedelta(days=2)})
+        model.Session.commit()
+
+        for i in range(3):
+            assert_equal(publisher_performance_data(publisher, False),
+                         stale_data)
+        assert_equal(mock_create_refresh_task.call_count, 1)
+
+    @mock.patch('ckanext.dgu.publisher_performance_tasks.create_refresh_task')
+    def test_does_not_commit_the_session(self, mock_create_refresh_task):
+        from ckanext.report.model import DataCache
+        publisher = model.Group.by_name('perf-org')
+        DataCache.set(publisher.name, 'uncommitted', 'x')
+        publisher_performance_data(publisher, True)
+        model.Session.rollback()
+        assert_equal(model.Session.query(DataCache)
+                     .filter_by(object_id=publisher.name, key='uncommitted')
+                     .count(), 0)
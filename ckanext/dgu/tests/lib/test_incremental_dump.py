@@ -0,0 +1,104 @@
+import json
+import os
+import shutil
+import StringIO
+import tempfile
+import uuid
+
+from nose.tools import assert_equal
+
+from ckan import model
+try:
+    from ckan.tests import factories
+except ImportError:
+    from ckan.new_tests import factories
+
+from ckanext.dgu.lib.incremental_dump import IncrementalDumper
+
+
+class TestIncrementalDumper(object):
+    @classmethod
+    def setup_class(cls):
+        model.repo.rebuild_db()
+        for name in ('unchanged', 'changed', 'deleted'):
+            factories.Dataset(name=name)
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.dumper = IncrementalDumper(os.path.join(self.dir,
+                                                     'datasets.jsonl'))
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def _dump(self):
+        snapshot, delta = StringIO.StringIO(), StringIO.StringIO()
+        stats = self.dumper.dump(snapshot, delta)
+        snapshot = [json.loads(line)['name']
+                    for line in snapshot.getvalue().splitlines()]
+        delta = [(json.loads(line)['id'], json.loads(line)['action'])
+                 for line in delta.getvalue().splitlines()]
+        return stats, sorted(snapshot), sorted(delta)
+
+    def _edit_datasets(self):
+        rev = model.repo.new_revision()
+        model.Package.by_name(u'changed').notes = unicode(uuid.uuid4())
+        model.Package.by_name(u'deleted').state = 'deleted'
+        model.repo.commit_and_remove()
+
+    def _ids(self, *names):
+        return [model.Package.by_name(unicode(name)).id for name in names]
+
+    def test_dumps(self):
+        stats, snapshot, delta = self._dump()
+        self.dumper.commit()
+        assert_equal(stats, {'unchanged': 0, 'changed': 3, 'deleted': 0})
+        assert_equal(snapshot, ['changed', 'deleted', 'unchanged'])
+
+        self._edit_datasets()
+        try:
+            stats, snapshot, delta = self._dump()
+            self.dumper.commit()
+            assert_equal(stats, {'unchanged': 1, 'changed': 1, 'deleted': 1})
+            assert_equal(snapshot, ['changed', 'unchanged'])
+            changed_id, deleted_id = self._ids('changed', 'deleted')
+            assert_equal(delta, sorted([(changed_id, 'changed'),
+                                        (deleted_id, 'deleted')]))
+
+            # nothing changed since
+            stats, snapshot, delta = self._dump()
+            self.dumper.commit()
+            assert_equal(stats, {'unchanged': 2, 'changed': 0, 'deleted': 0})
+            assert_equal(delta, [])
+        finally:
+            rev = model.repo.new_revision()
+            model.Package.by_name(u'deleted').state = 'active'
+            model.repo.commit_and_remove()
+
+    def test_failed_run_is_repeated(self):
+        self._dump()
+        self.dumper.commit()
+        base = open(self.dumper.base_filepath).read()
+        state = open(self.dumper.state_filepath).read()
+
+        self._edit_datasets()
+        try:
+            first_stats, first_snapshot, first_delta = self._dump()
+            # e.g. publishing the dump failed
+            self.dumper.abort()
+            assert_equal(open(self.dumper.base_filepath).read(), base)
+            assert_equal(open(self.dumper.state_filepath).read(), state)
+            assert not os.path.exists(self.dumper.new_base_filepath)
+
+            # the next run gives the same delta
+            stats, snapshot, delta = self._dump()
+            assert_equal(stats, first_stats)
+            assert_equal(delta, first_delta)
+        finally:
+            rev = model.repo.new_revision()
+            model.Package.by_name(u'deleted').state = 'active'
+            model.repo.commit_and_remove()
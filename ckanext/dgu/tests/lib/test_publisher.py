@@ -129,3 +129,159 @@ class TestGoDownTree:
     def test_barnsley(self):
         assert_equal(to_names(go_down_tree(model.Group.get(u'barnsley-primary-care-trust'))),
                      ['barnsley-primary-care-trust'])
+
+class TestPublisherAncestry:
+    @classmethod
+    def setup_class(cls):
+        DguCreateTestData.create_dgu_test_data()
+        invalidate_publisher_ancestry()
+
+    @classmethod
+    def teardown_class(cls):
+        invalidate_publisher_ancestry()
+        model.repo.rebuild_db()
+
+    def test_barnsley(self):
+        pub = get_publisher_ancestry()['barnsley-primary-care-trust']
+        assert_equal(pub['ancestors'],
+                     ['barnsley-primary-care-trust', 'national-health-service', 'dept-health'])
+
+    def test_matches_go_up_tree(self):
+        ancestry = get_publisher_ancestry()
+        for group in model.Session.query(model.Group) \
+                          .filter_by(type='organization', state='active'):
+            assert_equal(ancestry[group.id]['ancestors'],
+                         to_names(go_up_tree(group)))
+            assert_equal(ancestry[group.id]['title'], group.title)
+
+    def test_keyed_by_id_and_name(self):
+        group = model.Group.get(u'dept-health')
+        ancestry = get_publisher_ancestry()
+        assert ancestry[group.id] is ancestry[group.name]
+
+    def test_non_organization_parent_ignored(self):
+        rev = model.repo.new_revision()
+        theme_group = model.Group(name=u'theme-group', type='group')
+        model.Session.add(theme_group)
+        model.Session.flush()
+        model.Session.add(model.Member(
+            group=theme_group, table_name='group', capacity='parent',
+            table_id=model.Group.get(u'barnsley-primary-care-trust').id))
+        model.repo.commit_and_remove()
+        invalidate_publisher_ancestry()
+
+        pub = get_publisher_ancestry()['barnsley-primary-care-trust']
+        assert_equal(pub['ancestors'],
+                     ['barnsley-primary-care-trust', 'national-health-service', 'dept-health'])
+
+    def test_changes_by_other_processes_are_picked_up(self):
+        import ckanext.dgu.lib.publisher as publib
+        stale_ancestry = get_publisher_ancestry()
+        stale_version = publib._publisher_ancestry_version
+        rev = model.repo.new_revision()
+        model.Group.get(u'dept-health').title = u'Department of Health (new)'
+        model.repo.commit_and_remove()
+        # as if another process made the change
+        publib._publisher_ancestry = stale_ancestry
+        publib._publisher_ancestry_version = stale_version
+        publib._publisher_ancestry_checked = 0
+
+        assert_equal(get_publisher_ancestry()['dept-health']['title'],
+                     u'Department of Health (new)')
+
+class TestPublisherIds:
+    @classmethod
+    def setup_class(cls):
+        DguCreateTestData.create_dgu_test_data()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def test_matches_go_down_tree(self):
+        for group in model.Session.query(model.Group) \
+                          .filter_by(type='organization', state='active'):
+            assert_equal(set(publisher_ids(group, include_sub_publishers=True)),
+                         set(pub.id for pub in go_down_tree(group)))
+            assert_equal(publisher_ids(group), [group.id])
+
+    def test_non_organization_child_ignored(self):
+        rev = model.repo.new_revision()
+        theme_group = model.Group(name=u'theme-group-child', type='group')
+        model.Session.add(theme_group)
+        model.Session.flush()
+        model.Session.add(model.Member(
+            group=model.Group.get(u'national-health-service'),
+            table_name='group', capacity='parent', table_id=theme_group.id))
+        model.repo.commit_and_remove()
+
+        nhs = model.Group.get(u'national-health-service')
+        assert_equal(set(publisher_ids(nhs, include_sub_publishers=True)),
+                     set(pub.id for pub in go_down_tree(nhs)))
+
+class TestAllOpennessScores:
+    @classmethod
+    def setup_class(cls):
+        DguCreateTestData.create_dgu_test_data()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def test_same_as_openness_scores(self):
+        scores = all_openness_scores()
+        for name in ('dept-health', 'national-health-service',
+                     'barnsley-primary-care-trust'):
+            publisher = model.Group.get(name)
+            assert_equal(scores[publisher.id]['openness-scores'],
+                         openness_scores(publisher, use_cache=False))
+            assert_equal(scores[publisher.id]['openness-scores-withsub'],
+                         openness_scores(publisher, include_sub_publishers=True,
+                                         use_cache=False))
+
+    def test_non_organization_child_ignored(self):
+        nhs = model.Group.get(u'national-health-service')
+        expected = all_openness_scores()[nhs.id]['openness-scores-withsub']
+        rev = model.repo.new_revision()
+        theme_group = model.Group(name=u'theme-group-scores', type='group')
+        model.Session.add(theme_group)
+        model.Session.flush()
+        model.Session.add(model.Member(
+            group=nhs, table_name='group', capacity='parent',
+            table_id=theme_group.id))
+        model.Session.add(model.Member(
+            group=theme_group, table_name='package', capacity='public',
+            table_id=model.Package.by_name(u'nhs-spend-over-25k-barnsleypct').id))
+        model.repo.commit_and_remove()
+
+        nhs = model.Group.get(u'national-health-service')
+        assert_equal(all_openness_scores()[nhs.id]['openness-scores-withsub'],
+                     expected)
+        assert_equal(expected, openness_scores(nhs, include_sub_publishers=True,
+                                               use_cache=False))
+
+class TestAllOpennessScoresLoop:
+    @classmethod
+    def setup_class(cls):
+        DguCreateTestData.create_dgu_test_data()
+        # make barnsley the parent of dept-health, as well as its grandchild
+        rev = model.repo.new_revision()
+        model.Session.add(model.Member(
+            group=model.Group.get(u'barnsley-primary-care-trust'),
+            table_name='group', capacity='parent',
+            table_id=model.Group.get(u'dept-health').id))
+        model.repo.commit_and_remove()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def test_whole_loop_counted_for_each_publisher(self):
+        scores = all_openness_scores()
+        names = ('dept-health', 'national-health-service',
+                 'barnsley-primary-care-trust')
+        withsub = [scores[model.Group.get(name).id]['openness-scores-withsub']
+                   for name in names]
+        # they are all in the same loop, so each tree is the whole loop
+        assert_equal(withsub[1], withsub[0])
+        assert_equal(withsub[2], withsub[0])
@@ -1,7 +1,25 @@
-from datetime import datetime as dt
+from datetime import datetime as dt, timedelta
+import threading
+
+import mock
 from nose.tools import assert_equal
+from nose.plugins.skip import SkipTest
 
-from ckanext.dgu.lib.reports import get_quarter_dates
+from ckan import model
+try:
+    from ckan.tests import factories
+except ImportError:
+    from ckan.new_tests import factories
+from ckanext.dgu.lib.reports import get_quarter_dates, _get_activity, \
+    licence_report, publisher_resources, publisher_resources_rollup, \
+    nii_report
+from ckanext.dgu.lib.publisher import invalidate_publisher_ancestry
+from ckanext.dgu.lib import report_rollup
+from ckanext.dgu.lib.report_rollup import cached_parts, cache_parts_in_scope, \
+    TreeRollup
+from ckanext.dgu.testtools.create_test_data import DguCreateTestData
+from ckanext.dgu.bin.publisher_activity_benchmark import \
+    previous_get_activity, normalise_activity
 
 class TestQuarters(object):
     def test_may(self):
@@ -20,3 +38,202 @@ class TestQuarters(object):
         assert_equal(qs['last'], (dt(2014, 1, 1), dt(2014, 3, 31)))
 
 
+class TestGetActivity(object):
+    '''Checks _get_activity gives the same as the previous (per dataset)
+    implementation.'''
+    @classmethod
+    def setup_class(cls):
+        DguCreateTestData.create_dgu_test_data()
+        # edits by a publisher, and by system authors which are ignored
+        for author, edit in (
+                ('nhseditor', lambda pkg: setattr(pkg, 'notes', 'Edited')),
+                ('autotheme', lambda pkg: pkg.extras.__setitem__(
+                    'theme-primary', 'Health')),
+                ('script-fix', lambda pkg: setattr(pkg, 'version', '2')),
+                ('nhsadmin', lambda pkg: pkg.extras.__setitem__(
+                    'mandate', 'http://example.com/mandate')),
+                ('nhsadmin', lambda pkg: setattr(
+                    pkg.resources[0], 'format', 'XLS')),
+                ):
+            rev = model.repo.new_revision()
+            rev.author = author
+            edit(model.Package.by_name(u'directgov-cota'))
+            model.repo.commit_and_remove()
+        now = dt.now()
+        cls.periods = {'this': (now - timedelta(days=1),
+                                now + timedelta(days=1)),
+                       'last': (now - timedelta(days=100),
+                                now - timedelta(days=1))}
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def _assert_same_as_previous(self, organization_name,
+                                 include_sub_organizations):
+        args = (organization_name, include_sub_organizations, self.periods)
+        created, modified = _get_activity(*args)
+        previous_created, previous_modified = previous_get_activity(*args)
+        assert_equal(normalise_activity(created),
+                     normalise_activity(previous_created))
+        assert_equal(normalise_activity(modified),
+                     normalise_activity(previous_modified))
+        return created, modified
+
+    def test_all_organizations(self):
+        created, modified = self._assert_same_as_previous(None, False)
+        assert created['this']
+        authors = dict((row[0], sorted(row[6].split()))
+                       for row in modified['this'])
+        assert_equal(authors['directgov-cota'], ['nhsadmin', 'nhseditor'])
+        assert_equal(modified['last'], [])
+
+    def test_organization(self):
+        self._assert_same_as_previous('national-health-service', False)
+
+    def test_organization_and_sub_organizations(self):
+        self._assert_same_as_previous('dept-health', True)
+
+
+class TestNiiReport(object):
+    @classmethod
+    def setup_class(cls):
+        try:
+            from ckanext.archiver.model import Archival, init_tables
+        except ImportError:
+            raise SkipTest('Needs ckanext-archiver')
+        model.repo.rebuild_db()
+        init_tables(model.meta.engine)
+        factories.Organization(name='nii-org-a', title='A publisher')
+        factories.Organization(name='nii-org-b', title='B publisher')
+        nii = [{'key': 'core-dataset', 'value': 'true'}]
+        factories.Dataset(name='nii-1', owner_org='nii-org-a', extras=nii,
+                          resources=[{'url': 'http://a/1', 'description': 'Broken'},
+                                     {'url': 'http://a/2', 'description': 'OK'}])
+        factories.Dataset(name='nii-2', owner_org='nii-org-b', extras=nii,
+                          resources=[{'url': 'http://b/1', 'description': 'OK'}])
+        factories.Dataset(name='not-nii', owner_org='nii-org-a',
+                          resources=[{'url': 'http://a/3',
+                                      'description': 'Broken'}])
+        for resource in model.Session.query(model.Resource):
+            archival = Archival.create(resource.id)
+            archival.is_broken = resource.description == 'Broken'
+            model.Session.add(archival)
+        model.Session.commit()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def test_nii_report(self):
+        report = nii_report()
+        broken_resource = model.Session.query(model.Resource) \
+            .filter_by(url='http://a/1').one()
+        assert_equal([row['name'] for row in report['table']],
+                     ['nii-1', 'nii-2'])
+        assert_equal([row['broken_resources'] for row in report['table']],
+                     [[('Broken', broken_resource.id)], []])
+        assert_equal(report['organizations'],
+                     [('nii-org-a', 'A publisher'),
+                      ('nii-org-b', 'B publisher')])
+        assert_equal(report['num_datasets'], 2)
+        assert_equal(report['num_resources'], 3)
+        assert_equal(report['num_organizations'], 2)
+        assert_equal(report['num_broken_resources'], 1)
+        assert_equal(report['num_broken_datasets'], 1)
+        assert_equal(report['num_broken_organizations'], 1)
+
+
+class TestRollups(object):
+    @classmethod
+    def setup_class(cls):
+        model.repo.rebuild_db()
+        factories.Organization(name='parent-org', category='ministerial-department')
+        factories.Organization(name='child-org', category='ministerial-department',
+                               groups=[{'name': 'parent-org'}])
+        invalidate_publisher_ancestry()
+        for org_name, license_id in (('parent-org', 'uk-ogl'),
+                                     ('child-org', 'uk-ogl'),
+                                     ('child-org', 'cc-by')):
+            factories.Dataset(owner_org=org_name, license_id=license_id)
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+        invalidate_publisher_ancestry()
+
+    def test_licence_report(self):
+        report = licence_report('parent-org', include_sub_organizations=False)
+        assert_equal(report['num_datasets'], 1)
+
+        report = licence_report('parent-org', include_sub_organizations=True)
+        assert_equal(report['num_datasets'], 3)
+        assert_equal([(row['license_id'], len(row['dataset_names'].split()))
+                      for row in report['table']],
+                     [('uk-ogl', 2), ('cc-by', 1)])
+
+    def test_publisher_resources_reuses_parts(self):
+        with mock.patch.object(
+                publisher_resources_rollup, 'compute_part',
+                wraps=publisher_resources_rollup.compute_part) as compute_part:
+            with cached_parts():
+                publisher_resources('child-org')
+                report = publisher_resources('parent-org',
+                                             include_sub_organizations=True)
+        assert_equal(report['num_datasets'], 3)
+        assert_equal(sorted(set(row['publisher_name']
+                                for row in report['table'])),
+                     ['child-org', 'parent-org'])
+        # the child's part was only generated once
+        assert_equal(sorted(call[0][0] for call in compute_part.call_args_list),
+                     ['child-org', 'parent-org'])
+
+    def test_publisher_resources_tree_without_cached_parts(self):
+        with cached_parts():
+            expected = publisher_resources('parent-org',
+                                           include_sub_organizations=True)
+        with mock.patch.object(
+                publisher_resources_rollup, 'compute_part',
+                wraps=publisher_resources_rollup.compute_part) as compute_part:
+            report = publisher_resources('parent-org',
+                                         include_sub_organizations=True)
+        # generated in one go, not a part at a time
+        assert_equal(compute_part.call_count, 0)
+        assert_equal(report['num_datasets'], expected['num_datasets'])
+        assert_equal(report['num_resources'], expected['num_resources'])
+        key = lambda row: (row['package_name'], row['resource_id'])
+        assert_equal(sorted(report['table'], key=key),
+                     sorted(expected['table'], key=key))
+
+class TestCachePartsInScope(object):
+    def teardown(self):
+        report_rollup._local.parts = report_rollup._local.scope = None
+
+    def test_parts_kept_only_within_scope(self):
+        computed = []
+        def compute_part(organization_name):
+            computed.append(organization_name)
+            return [organization_name]
+        rollup = TreeRollup('test', compute_part, lambda parts: sum(parts, []))
+
+        cache_parts_in_scope('report-a')
+        rollup.get('org', False)
+        cache_parts_in_scope('report-a')
+        rollup.get('org', False)
+        assert_equal(computed, ['org'])
+
+        cache_parts_in_scope('report-b')
+        assert_equal(report_rollup._local.parts, {})
+        rollup.get('org', False)
+        assert_equal(computed, ['org', 'org'])
+
+    def test_parts_not_shared_between_threads(self):
+        other_thread_parts = []
+        def other_thread():
+            other_thread_parts.append(report_rollup._get_parts())
+        with cached_parts():
+            thread = threading.Thread(target=other_thread)
+            thread.start()
+            thread.join()
+            assert_equal(report_rollup._get_parts(), {})
+        assert_equal(other_thread_parts, [None])
@@ -0,0 +1,71 @@
+import mock
+from nose.tools import assert_equal
+
+from ckan import model
+from ckanext.dgu.lib import search_fingerprint
+from ckanext.dgu.lib.search_fingerprint import (FingerprintingConnection,
+                                                get_fingerprints,
+                                                skipping_disabled)
+import ckanext.dgu.model.index_fingerprint as fp_model
+
+
+def doc(id_, title='Title'):
+    return {'id': id_, 'name': id_, 'title': title,
+            'indexed_ts': 'changes every time'}
+
+
+class TestFingerprintingConnection(object):
+    @classmethod
+    def setup_class(cls):
+        fp_model.init_tables(model.meta.engine)
+
+    def setup(self):
+        search_fingerprint.clear_fingerprints()
+        search_fingerprint._pop_pending_fingerprints()
+        self.solr = mock.MagicMock()
+        self.conn = FingerprintingConnection(self.solr)
+
+    def _written_ids(self):
+        ids = [d['id'] for call in self.solr.add_many.call_args_list
+               for d in call[0][0]]
+        self.solr.add_many.reset_mock()
+        return ids
+
+    def test_unchanged_documents_are_skipped(self):
+        self.conn.add_many([doc('a'), doc('b')], _commit=True)
+        assert_equal(self._written_ids(), ['a', 'b'])
+
+        self.conn.add_many([doc('a'), doc('b', title='New title')],
+                           _commit=True)
+        assert_equal(self._written_ids(), ['b'])
+
+    def test_fingerprints_stored_only_after_commit(self):
+        self.conn.add_many([doc('a')], _commit=False)
+        assert_equal(get_fingerprints(['a']), {})
+        self.conn.add_many([doc('a')], _commit=False)
+        assert_equal(self._written_ids(), ['a', 'a'])
+
+        self.conn.commit()
+        assert_equal(get_fingerprints(['a']).keys(), ['a'])
+        self.conn.add_many([doc('a')], _commit=False)
+        assert_equal(self._written_ids(), [])
+
+    def test_rollback_forgets_fingerprints(self):
+        self.conn.add_many([doc('a')], _commit=False)
+        self.conn.rollback()
+        self.conn.commit()
+        assert_equal(get_fingerprints(['a']), {})
+        self.conn.add_many([doc('a')], _commit=True)
+        assert_equal(self._written_ids(), ['a', 'a'])
+
+    def test_skipping_disabled(self):
+        self.conn.add_many([doc('a')], _commit=True)
+        with skipping_disabled():
+            self.conn.add_many([doc('a')], _commit=True)
+        assert_equal(self._written_ids(), ['a', 'a'])
+
+    def test_delete_forgets_fingerprint(self):
+        self.conn.add_many([doc('a')], _commit=True)
+        self.conn.delete_query('+id:"a"')
+        self.conn.add_many([doc('a')], _commit=True)
+        assert_equal(self._written_ids(), ['a', 'a'])
@@ -1,11 +1,13 @@
 import time
 import datetime
+import threading
 
 from nose.tools import assert_equal
 
 from ckan import model
 
-from ckanext.dgu.authentication.drupal_auth import DrupalAuthMiddleware
+from ckanext.dgu.authentication.drupal_auth import DrupalAuthMiddleware, \
+    DrupalSessionCache
 from ckanext.dgu.tests import MockDrupalCase
 
 class TestCookie:
@@ -39,6 +41,50 @@ class TestCookie:
         res = DrupalAuthMiddleware._is_this_a_ckan_cookie(self.drupal_cookie)
         assert_equal(res, False)
 
+class TestDrupalSessionCache:
+    def setup(self):
+        self.lookups = []
+
+    def _lookup(self, session_id):
+        self.lookups.append(session_id)
+        time.sleep(0.1)  # so that concurrent requests overlap
+        return ('62', {'uid': '62'})
+
+    def test_cached(self):
+        cache = DrupalSessionCache(ttl=60, max_size=10)
+        assert_equal(cache.get('abc', self._lookup), ('62', {'uid': '62'}))
+        assert_equal(cache.get('abc', self._lookup), ('62', {'uid': '62'}))
+        assert_equal(self.lookups, ['abc'])
+        assert_equal(cache.stats['hits'], 1)
+
+    def test_expired(self):
+        cache = DrupalSessionCache(ttl=0, max_size=10)
+        cache.get('abc', self._lookup)
+        cache.get('abc', self._lookup)
+        assert_equal(self.lookups, ['abc', 'abc'])
+
+    def test_max_size(self):
+        cache = DrupalSessionCache(ttl=60, max_size=1)
+        cache.get('abc', self._lookup)
+        cache.get('def', self._lookup)
+        cache.get('abc', self._lookup)
+        assert_equal(self.lookups, ['abc', 'def', 'abc'])
+
+    def test_concurrent_requests_coalesced(self):
+        cache = DrupalSessionCache(ttl=60, max_size=10)
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(cache.get('abc', self._lookup)))
+            for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal(self.lookups, ['abc'])
+        assert_equal(len(results), 5)
+        assert_equal(cache.stats['coalesced'], 4)
+
+
 class MockApp:
     def __init__(self):
         self.calls = []
@@ -30,3 +30,37 @@ class TestResourceFormatCleanup:
     #def test_ical(self): self.assert_format_clean('ical', 'iCal')
     def test_shapefile(self): self.assert_format_clean('shapefile', 'SHP')
     def test_sql(self): self.assert_format_clean('sql', 'Database')
+
+
+class TestHarvestDocumentText:
+    gemini = '''<?xml version="1.0" encoding="UTF-8"?>
+<gmd:MD_Metadata xmlns:gmd="http://www.isotc211.org/2005/gmd"
+                 xmlns:gco="http://www.isotc211.org/2005/gco">
+  <gmd:identificationInfo>
+    <gmd:MD_DataIdentification>
+      <gmd:citation><gmd:CI_Citation><gmd:title>
+        <gco:CharacterString>Not indexed</gco:CharacterString>
+      </gmd:title></gmd:CI_Citation></gmd:citation>
+      <gmd:abstract><gco:CharacterString>Rivers in England</gco:CharacterString></gmd:abstract>
+      <gmd:descriptiveKeywords><gmd:MD_Keywords>
+        <gmd:keyword><gco:CharacterString>hydrography</gco:CharacterString></gmd:keyword>
+        <gmd:keyword><gco:CharacterString>water</gco:CharacterString></gmd:keyword>
+      </gmd:MD_Keywords></gmd:descriptiveKeywords>
+    </gmd:MD_DataIdentification>
+  </gmd:identificationInfo>
+  <gmd:dataQualityInfo><gmd:DQ_DataQuality><gmd:lineage><gmd:LI_Lineage>
+    <gmd:statement><gco:CharacterString>Surveyed in 2010</gco:CharacterString></gmd:statement>
+  </gmd:LI_Lineage></gmd:lineage></gmd:DQ_DataQuality></gmd:dataQualityInfo>
+</gmd:MD_Metadata>'''
+
+    def test_text_elements(self):
+        text = SearchIndexing.harvest_document_text(self.gemini, 1000)
+        assert_equal(text, u'Rivers in England hydrography water Surveyed in 2010')
+
+    def test_max_size(self):
+        text = SearchIndexing.harvest_document_text(self.gemini, 10)
+        assert_equal(text, u'Rivers in ')
+
+    def test_invalid_xml(self):
+        text = SearchIndexing.harvest_document_text('<gmd:abstract>', 1000)
+        assert_equal(text, u'')
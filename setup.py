@@ -77,11 +77,14 @@ setup(
         selenium_tests = ckanext.dgu.commands.selenium_tests:TestRunner
         build_void = ckanext.dgu.commands.void_constructor:VoidConstructor
         stress_solr = ckanext.dgu.commands.solr_stress:SolrStressTest
+        parallel_search_index = ckanext.dgu.commands.search_index:ParallelSearchIndex
+        parallel_report_cache = ckanext.dgu.commands.report_cache:ParallelReportCache
         remap_govuk_resources = ckanext.dgu.commands.remap_govuk_resources:ResourceRemapper
         derive_govuk_resources = ckanext.dgu.commands.derive_govuk_resources:GovUkResourceChecker
         refine_packages = ckanext.dgu.commands.refine_packages:RefinePackages
         inventory_init = ckanext.dgu.commands.inventory_init:InitDB
         commitment_init = ckanext.dgu.commands.commitment_init:InitDB
+        index_fingerprint_init = ckanext.dgu.commands.index_fingerprint_init:InitDB
         ingest = ckanext.dgu.commands.ingester:Ingester
         clean_resource_dates = ckanext.dgu.commands.clean_resource_dates:CleanResourceDates
         sync_apps = ckanext.dgu.commands.appsync:AppSync